@@ -0,0 +1,81 @@
+"""مقارنة تكلفة الرد الثابت: بناء الكيبورد مع كل رد مقابل القوالب الجاهزة.
+
+يقيس وقت المعالج لكل رد داخل python-telegram-bot حتى لحظة الإرسال
+(بناء الطلب + to_json + json.dumps لجسم الطلب)، بدون شبكة.
+
+التشغيل:
+    python benchmarks/bench_replies.py [عدد التكرارات]
+"""
+
+import json
+import os
+import sys
+import tempfile
+from timeit import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# bot.py ينشئ ملفات التخزين في المجلد الحالي عند الاستيراد
+os.chdir(tempfile.mkdtemp(prefix="bench_replies_"))
+os.environ.setdefault("STORAGE_BACKEND", "json")
+
+import bot as B  # noqa: E402
+from telegram import Bot, KeyboardButton, ReplyKeyboardMarkup  # noqa: E402
+
+
+class OfflineRequest:
+    """بديل telegram.utils.request.Request: يسلسل الجسم فقط بدون شبكة."""
+
+    con_pool_size = 1
+
+    def post(self, url, data, timeout=None):
+        json.dumps(data).encode("utf-8")
+        return True
+
+    def stop(self):
+        pass
+
+
+def _main_keyboard_per_call():
+    # نفس الكيبورد كما كان يُبنى قبل القوالب الجاهزة
+    return ReplyKeyboardMarkup(
+        [
+            [KeyboardButton(B.BTN_START), KeyboardButton(B.BTN_COUNTER)],
+            [KeyboardButton(B.BTN_TIP), KeyboardButton(B.BTN_EMERGENCY)],
+            [KeyboardButton(B.BTN_RELAPSE), KeyboardButton(B.BTN_DHIKR)],
+            [KeyboardButton(B.BTN_NOTES), KeyboardButton(B.BTN_RATING)],
+            [KeyboardButton(B.BTN_RESET), KeyboardButton(B.BTN_SET_START)],
+            [KeyboardButton(B.BTN_SUPPORT)],
+            [KeyboardButton(B.BTN_BROADCAST), KeyboardButton(B.BTN_STATS)],
+        ],
+        resize_keyboard=True,
+    )
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bot = Bot("123456:bench", request=OfflineRequest())
+    chat_id = 42
+
+    def before():
+        bot.send_message(
+            chat_id=chat_id,
+            text=B.EMERGENCY_PLAN,
+            reply_markup=_main_keyboard_per_call(),
+            parse_mode="Markdown",
+        )
+
+    def after():
+        bot.send_message(chat_id=chat_id, **B.EMERGENCY_REPLY.kwargs)
+
+    before_s = timeit(before, number=n)
+    after_s = timeit(after, number=n)
+    print(f"replies: {n}")
+    print(f"per-call keyboard: {before_s / n * 1e6:8.1f} us/reply")
+    print(f"prebuilt template: {after_s / n * 1e6:8.1f} us/reply")
+    print(f"saving:            {(1 - after_s / before_s) * 100:8.1f} %")
+
+
+if __name__ == "__main__":
+    main()
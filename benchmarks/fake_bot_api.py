@@ -0,0 +1,356 @@
+"""سيرفر Bot API وهمي محلي لاختبار البوت كاملًا بدون تليجرام.
+
+يحاكي الطرق التي يستخدمها البوت (getMe, getUpdates, sendMessage,
+editMessageText, answerCallbackQuery, sendDocument, setWebhook,
+deleteWebhook) عبر HTTP حقيقي،
+فيمر الطلب بكل طبقات python-telegram-bot (urllib3، إعادة استخدام الاتصال،
+تحويل 429 إلى RetryAfter و403 إلى Unauthorized).
+
+قابل للضبط:
+  --latency-ms / --jitter-ms   تأخير كل طلب
+  --error-rate                 نسبة ردود 500 العشوائية على الإرسال
+  --flood-rate                 حد رسائل/ثانية؛ ما فوقه يرجع 429 مع retry_after
+  --blocked-percent            نسبة المستخدمين الذين "حظروا البوت" (403)
+  --users / --update-rate      مستخدمون وهميون يضغطون الأزرار عبر getUpdates
+  --broadcast-after            بعد كم ثانية يبدأ الأدمن رسالة جماعية
+
+التشغيل:
+    python benchmarks/fake_bot_api.py --port 8081 --users 5000 --update-rate 200
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot BOT_TOKEN=123456:fake \\
+        DAILY_REMINDER_TIME=$(date -u -d '+1 min' +%H:%M) python bot.py
+
+الإحصائيات: GET http://127.0.0.1:8081/stats (وتُطبع عند الإيقاف).
+POST /backlog بـ {"updates": N} يضع N تحديث دفعة واحدة ويصفّر توقيتها
+(first_fetch → last_reply في /stats)، يستخدمه benchmarks/load.py --e2e.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_USER_ID = 100000
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Qaher", "username": "qaher_fake_bot"}
+
+
+def load_button_labels():
+    """نصوص الأزرار من bot.py مباشرة، بدون استيراده (الاستيراد ينشئ store)."""
+    with open(os.path.join(ROOT, "bot.py"), encoding="utf-8") as f:
+        labels = dict(re.findall(r'^(BTN_\w+) = "(.*)"$', f.read(), re.M))
+    return labels
+
+
+class FakeTelegram:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.sent_per_chat = Counter()
+        self.admin_texts = deque(maxlen=5)  # آخر ما وصل الأدمن (تقدّم/ملخص الرسالة الجماعية)
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.updates = deque()
+        self.updates_ready = threading.Condition(self.lock)
+        self.flood_window = deque()  # أوقات الإرسال خلال آخر ثانية
+        self.webhook_url = ""
+        self.labels = load_button_labels()
+        self.started = time.monotonic()
+        self.broadcast_sent = False
+        self.first_fetch = None  # أول getUpdates رجّع تحديثات
+        self.last_reply = None  # آخر رسالة وصلت لمستخدم (غير الأدمن)
+
+    # ---------- توليد التحديثات ----------
+
+    def _scripted_texts(self):
+        """قوائم خطوات؛ الخطوة ("cb", data) ضغطة زر inline."""
+        L = self.labels
+        r = self.rng
+        return r.choices(
+            [
+                [L["BTN_COUNTER"]],
+                [L["BTN_TIP"]],
+                [L["BTN_DHIKR"]],
+                [L["BTN_EMERGENCY"]],
+                [L["BTN_RATING"], str(r.randint(1, 5))],
+                [L["BTN_NOTES"], ("cb", "notes:add"), "ملاحظة من سيرفر الحمل"],
+                [L["BTN_START"]],
+            ],
+            [30, 15, 10, 8, 10, 8, 5],
+        )[0]
+
+    def _push_update(self, user_id, text):
+        """لازم تُستدعى و self.lock مقفول."""
+        if isinstance(text, tuple):
+            self._push_callback(user_id, text[1])
+            return
+        message = {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"u{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        self.updates.append({"update_id": self.next_update_id, "message": message})
+        self.next_update_id += 1
+        self.next_message_id += 1
+
+    def _push_callback(self, user_id, data):
+        """ضغطة زر inline على رسالة سابقة من البوت."""
+        user = {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+        self.updates.append(
+            {
+                "update_id": self.next_update_id,
+                "callback_query": {
+                    "id": str(self.next_update_id),
+                    "from": user,
+                    "chat_instance": str(user_id),
+                    "data": data,
+                    "message": {
+                        "message_id": self.next_message_id,
+                        "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"},
+                        "from": BOT_USER,
+                        "text": "📓",
+                    },
+                },
+            }
+        )
+        self.next_update_id += 1
+        self.next_message_id += 1
+
+    def generator_loop(self):
+        """ينتج --update-rate تحديث في الثانية من --users مستخدم."""
+        args = self.args
+        if not args.users or not args.update_rate:
+            return
+        tick = 0.05
+        carry = 0.0
+        while True:
+            time.sleep(tick)
+            carry += args.update_rate * tick
+            with self.lock:
+                while carry >= 1:
+                    carry -= 1
+                    user_id = FIRST_USER_ID + self.rng.randrange(args.users)
+                    if self.rng.random() < 0.02:
+                        self._push_update(user_id, "/start")
+                    else:
+                        for text in self._scripted_texts():
+                            self._push_update(user_id, text)
+                if (
+                    args.broadcast_after is not None
+                    and not self.broadcast_sent
+                    and time.monotonic() - self.started >= args.broadcast_after
+                ):
+                    self.broadcast_sent = True
+                    # زر الرسالة الجماعية يسأل عن الشريحة أولًا، ثم النص
+                    self._push_update(args.admin_id, self.labels["BTN_BROADCAST"])
+                    self._push_update(args.admin_id, self.labels["BTN_ALL_USERS"])
+                    self._push_update(args.admin_id, "رسالة جماعية من سيرفر الحمل")
+                self.updates_ready.notify_all()
+
+    def queue_backlog(self, count):
+        """يضع count تحديث من مستخدمي --users دفعة واحدة (لقياس سرعة التفريغ)."""
+        with self.lock:
+            target = len(self.updates) + count
+            while len(self.updates) < target:
+                user_id = FIRST_USER_ID + self.rng.randrange(max(self.args.users, 1))
+                for text in self._scripted_texts():
+                    self._push_update(user_id, text)
+            self.first_fetch = None
+            self.last_reply = None
+            self.updates_ready.notify_all()
+            return len(self.updates)
+
+    # ---------- الطرق ----------
+
+    def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.popleft()
+            while not self.updates and time.monotonic() < deadline:
+                self.updates_ready.wait(deadline - time.monotonic())
+                while self.updates and self.updates[0]["update_id"] < offset:
+                    self.updates.popleft()
+            if self.updates and self.first_fetch is None:
+                self.first_fetch = time.monotonic()
+            return 200, ok([u for _, u in zip(range(limit), self.updates)])
+
+    def send_message(self, method, params):
+        args = self.args
+        chat_id = int(params.get("chat_id") or 0)
+        now = time.monotonic()
+        with self.lock:
+            if args.flood_rate:
+                while self.flood_window and now - self.flood_window[0] > 1:
+                    self.flood_window.popleft()
+                if len(self.flood_window) >= args.flood_rate:
+                    return 429, error(
+                        429,
+                        f"Too Many Requests: retry after {args.retry_after}",
+                        {"retry_after": args.retry_after},
+                    )
+                self.flood_window.append(now)
+            if chat_id != args.admin_id and chat_id % 100 < args.blocked_percent:
+                return 403, error(403, "Forbidden: bot was blocked by the user")
+            if self.rng.random() < args.error_rate:
+                return 500, error(500, "Internal Server Error")
+            self.sent_per_chat[chat_id] += 1
+            if chat_id == args.admin_id:
+                self.admin_texts.append(params.get("text", ""))
+            else:
+                self.last_reply = now
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        return 200, ok(
+            {
+                "message_id": int(params.get("message_id") or message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        )
+
+    def dispatch(self, method, params):
+        if method == "getMe":
+            return 200, ok(BOT_USER)
+        if method == "getUpdates":
+            return self.get_updates(params)
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            return self.send_message(method, params)
+        if method == "answerCallbackQuery":
+            return 200, ok(True)
+        if method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+            return 200, ok(True)
+        if method == "deleteWebhook":
+            self.webhook_url = ""
+            return 200, ok(True)
+        return 404, error(404, f"Not Found: method {method} is not emulated")
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime_seconds": round(time.monotonic() - self.started, 1),
+                "requests": dict(self.stats),
+                "chats_reached": len(self.sent_per_chat),
+                "messages_delivered": sum(self.sent_per_chat.values()),
+                "updates_queued": len(self.updates),
+                "backlog_seconds": (
+                    round(self.last_reply - self.first_fetch, 3)
+                    if self.first_fetch is not None and self.last_reply is not None
+                    else None
+                ),
+                "webhook_url": self.webhook_url,
+                "admin_last_texts": list(self.admin_texts),
+            }
+
+
+def ok(result):
+    return {"ok": True, "result": result}
+
+
+def error(code, description, parameters=None):
+    body = {"ok": False, "error_code": code, "description": description}
+    if parameters:
+        body["parameters"] = parameters
+    return body
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive مثل تليجرام
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _reply(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _params(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            if self.headers.get("Content-Type", "").startswith("application/json") and raw:
+                return json.loads(raw)
+            return {}  # multipart (sendDocument): المحتوى غير مهم هنا
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, fake.snapshot())
+                return
+            self._reply(404, error(404, "Not Found"))
+
+        def do_POST(self):
+            if self.path == "/backlog":
+                count = int(self._params().get("updates") or 0)
+                self._reply(200, ok({"updates_queued": fake.queue_backlog(count)}))
+                return
+            match = re.match(r"^/bot[^/]+/(\w+)$", self.path)
+            if not match:
+                self._reply(404, error(404, "Not Found"))
+                return
+            method = match.group(1)
+            params = self._params()
+            args = fake.args
+            if method != "getUpdates" and (args.latency_ms or args.jitter_ms):
+                time.sleep((args.latency_ms + random.random() * args.jitter_ms) / 1000)
+            status, body = fake.dispatch(method, params)
+            with fake.lock:
+                fake.stats[f"{method} {status}"] += 1
+            self._reply(status, body)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--flood-rate", type=int, default=30, help="0 = بدون حد")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked-percent", type=int, default=5)
+    parser.add_argument("--users", type=int, default=0)
+    parser.add_argument("--update-rate", type=float, default=0)
+    parser.add_argument("--broadcast-after", type=float, default=None)
+    parser.add_argument("--admin-id", type=int, default=931350292)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args)
+    threading.Thread(target=fake.generator_loop, name="generator", daemon=True).start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(fake))
+    server.daemon_threads = True
+    print(f"Fake Bot API on http://{args.host}:{args.port}/bot<token>/", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(fake.snapshot(), ensure_ascii=False, indent=2), flush=True)
+
+
+if __name__ == "__main__":
+    main()
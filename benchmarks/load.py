@@ -0,0 +1,448 @@
+"""بنشمارك الحمل: مستخدمون وهميون يضغطون الأزرار داخل نفس العملية.
+
+لكل حجم بيانات:
+  1. يولّد user_data.json واقعي (ملاحظات وتقييمات) في مجلد مؤقت
+     (ويستورده لو STORAGE_BACKEND غير json).
+  2. يستورد bot.py في عملية فرعية مستقلة ويمرر Updates وهمية عبر
+     handle_text_message / start_command / handle_notes_callback بـ Bot
+     وهمي يسجّل الرسائل.
+  3. يطبع سطر JSON لكل حجم: updates/sec، p50/p99، بايتات مكتوبة لكل update.
+
+--e2e يشغّل bot.py الحقيقي (مع --workers N = WORKER_PROCESSES) ضد
+benchmarks/fake_bot_api.py على localhost: العملية الأمامية وطوابير
+multiprocessing والعمال وcall_workers كلها في المسار. بعد جاهزية البوت
+يوضع --updates تحديث دفعة واحدة، والسرعة = عددها على الوقت من أول
+getUpdates إلى آخر رد. (بدون p50/p99: التوقيت هنا من جهة السيرفر.)
+
+بدون شبكة خارجية. مثال:
+    python benchmarks/load.py --sizes 1000,10000 --updates 5000 > results.jsonl
+    STORAGE_BACKEND=sqlite python benchmarks/load.py --sizes 100000
+    python benchmarks/load.py --sizes 100000 --e2e --workers 1
+    python benchmarks/load.py --sizes 100000 --e2e --workers 4
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import types
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from time import perf_counter, sleep
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_SIZES = "1000,10000,100000,1000000"
+
+NOTE_SAMPLES = [
+    "اليوم كان صعب لكن ثبت الحمد لله",
+    "لاحظت أن السهر هو السبب الأكبر",
+    "مشيت نص ساعة بعد العشاء وارتحت",
+    "قرأت ورد القرآن بعد الفجر",
+    "ابتعدت عن الجوال قبل النوم",
+]
+FIRST_NAMES = ["أحمد", "محمد", "Omar", "Yusuf", "خالد", "Ali", "سعد", "Hassan"]
+
+
+# =================== توليد البيانات ===================
+
+
+def generate_dataset(path, users, seed=1):
+    """يكتب user_data.json بنفس شكل JsonStore (لقطة بدون journal)."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{")
+        for i in range(users):
+            uid = 100000 + i
+            created = now - timedelta(days=rng.randint(0, 365))
+            ratings = [
+                {
+                    "value": rng.randint(1, 5),
+                    "at": (now - timedelta(days=d, hours=rng.randint(0, 23))).isoformat(),
+                }
+                for d in sorted(rng.sample(range(60), rng.randint(0, 8)))
+            ]
+            record = {
+                "user_id": uid,
+                "first_name": rng.choice(FIRST_NAMES),
+                "username": f"user{uid}" if rng.random() < 0.6 else None,
+                "created_at": created.isoformat(),
+                "last_active": (now - timedelta(minutes=rng.randint(0, 60 * 24 * 30))).isoformat(),
+                "streak_start": (
+                    (now - timedelta(hours=rng.randint(1, 24 * 90))).isoformat()
+                    if rng.random() < 0.8
+                    else None
+                ),
+                "notes": rng.sample(NOTE_SAMPLES, rng.randint(0, 3)),
+                "ratings": ratings,
+            }
+            if i:
+                f.write(",")
+            f.write(json.dumps(str(uid)))
+            f.write(":")
+            f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        f.write("}")
+
+
+# =================== كائنات تليجرام وهمية ===================
+
+
+class FakeMessage:
+    _next_id = 1
+
+    def __init__(self, bot, chat_id, text, from_user=None):
+        FakeMessage._next_id += 1
+        self.message_id = FakeMessage._next_id
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+        self.from_user = from_user
+        self.reply_to_message = None
+        self.chat = types.SimpleNamespace(id=chat_id)
+
+    def reply_text(self, text, **kwargs):
+        return self.bot.send_message(chat_id=self.chat_id, text=text, **kwargs)
+
+
+class RecordingBot:
+    """Bot وهمي: يسجّل عدد الرسائل وحجمها فقط."""
+
+    id = 1
+
+    def __init__(self):
+        self.sent = 0
+        self.sent_chars = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        self.sent_chars += len(text)
+        return FakeMessage(self, chat_id, text)
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.sent += 1
+            return FakeMessage(self, kwargs.get("chat_id"), kwargs.get("text", ""))
+
+        return call
+
+
+class FakeCallbackQuery:
+    def __init__(self, bot, chat_id, data):
+        self.bot = bot
+        self.data = data
+        self.message = FakeMessage(bot, chat_id, "")
+
+    def answer(self, text=None, **kwargs):
+        return True
+
+    def edit_message_text(self, text, **kwargs):
+        self.bot.sent += 1
+        self.bot.sent_chars += len(text)
+        self.message.text = text
+        return self.message
+
+
+def make_update(bot, user_id, text):
+    user = types.SimpleNamespace(
+        id=user_id, first_name="bench", username=None, full_name="bench"
+    )
+    message = FakeMessage(bot, user_id, text, from_user=user)
+    return types.SimpleNamespace(
+        effective_user=user,
+        effective_chat=message.chat,
+        effective_message=message,
+        message=message,
+        callback_query=None,
+    )
+
+
+def make_callback_update(bot, user_id, data):
+    user = types.SimpleNamespace(
+        id=user_id, first_name="bench", username=None, full_name="bench"
+    )
+    query = FakeCallbackQuery(bot, user_id, data)
+    return types.SimpleNamespace(
+        effective_user=user,
+        effective_chat=query.message.chat,
+        effective_message=query.message,
+        message=None,
+        callback_query=query,
+    )
+
+
+# =================== تشغيل الحمل ===================
+
+
+def build_script(B, rng):
+    """سيناريوهات قصيرة بنسب تقريبية لاستخدام حقيقي.
+
+    الخطوة ("cb", data) ضغطة زر inline (callback_data).
+    """
+    return [
+        (30, [B.BTN_COUNTER]),
+        (15, [B.BTN_TIP]),
+        (10, [B.BTN_DHIKR]),
+        (8, [B.BTN_EMERGENCY]),
+        (5, [B.BTN_RELAPSE]),
+        (10, [B.BTN_RATING, lambda: str(rng.randint(1, 5))]),
+        (8, [B.BTN_NOTES, ("cb", "notes:add"), lambda: rng.choice(NOTE_SAMPLES)]),
+        (4, [B.BTN_NOTES, ("cb", "notes:page:1")]),
+        (5, [B.BTN_START]),
+        (3, [B.BTN_SET_START, lambda: str(rng.randint(0, 60))]),
+        (2, ["رسالة عشوائية"]),
+    ]
+
+
+def bytes_written(B):
+    """بايتات write() الفعلية من /proc/self/io (تشمل SQLite)، وإلا عدّاد bot.py."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return sum(B.STORE_BYTES_WRITTEN._values.values())
+
+
+def run_one(users, updates, seed):
+    workdir = tempfile.mkdtemp(prefix=f"qaher_load_{users}_")
+    os.chdir(workdir)
+    started = perf_counter()
+    generate_dataset("user_data.json", users, seed)
+    generate_seconds = perf_counter() - started
+
+    sys.path.insert(0, ROOT)
+    started = perf_counter()
+    import bot as B
+
+    if B.STORAGE_BACKEND != "json":
+        B.import_json("user_data.json", B.store)
+        # الفهارس بُنيت عند الاستيراد على قاعدة فارغة
+        rows = B.store.segment_fields()
+        B.STREAK_INDEX = B.build_streak_index(rows)
+        B.SEGMENTS = B.build_segment_index(rows)
+    load_seconds = perf_counter() - started
+    # سجلات INFO تُكتب أيضًا وتفسد قياس البايتات
+    logging.disable(logging.INFO)
+
+    rng = random.Random(seed)
+    bot = RecordingBot()
+    context = types.SimpleNamespace(bot=bot, args=[], job_queue=None)
+    scenarios = build_script(B, rng)
+    weights = [w for w, _ in scenarios]
+    new_user_id = 10**9
+
+    bytes_before = bytes_written(B)
+    latencies = []
+    done = 0
+    wall = perf_counter()
+    while done < updates:
+        if rng.random() < 0.02:
+            new_user_id += 1
+            user_id = new_user_id
+            steps = ["/start"]
+        else:
+            user_id = 100000 + rng.randrange(users)
+            steps = rng.choices(scenarios, weights)[0][1]
+        for step in steps:
+            text = step() if callable(step) else step
+            if isinstance(text, tuple):
+                update = make_callback_update(bot, user_id, text[1])
+            else:
+                update = make_update(bot, user_id, text)
+            t0 = perf_counter()
+            if update.callback_query is not None:
+                B.handle_notes_callback(update, context)
+            elif text == "/start":
+                B.start_command(update, context)
+            else:
+                B.handle_text_message(update, context)
+            latencies.append(perf_counter() - t0)
+            done += 1
+    B.flush_pending()
+    wall = perf_counter() - wall
+    written = bytes_written(B) - bytes_before
+    B.store.close()
+
+    latencies.sort()
+    n = len(latencies)
+    return {
+        "users": users,
+        "backend": B.STORAGE_BACKEND,
+        "updates": n,
+        "updates_per_sec": round(n / wall, 1),
+        "wall_seconds": round(wall, 3),
+        "p50_ms": round(latencies[n // 2] * 1000, 3),
+        "p99_ms": round(latencies[min(n - 1, int(n * 0.99))] * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "bytes_written_per_update": round(written / n, 1),
+        "messages_sent": bot.sent,
+        "generate_seconds": round(generate_seconds, 2),
+        "load_seconds": round(load_seconds, 2),
+    }
+
+
+# =================== المسار الكامل (--e2e) ===================
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def port_open(port):
+    with socket.socket() as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+def http_json(url, body=None):
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    request = urllib.request.Request(url, data, {"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+
+def wait_for(predicate, timeout, what):
+    deadline = perf_counter() + timeout
+    while not predicate():
+        if perf_counter() > deadline:
+            raise SystemExit(f"timed out waiting for {what}")
+        sleep(0.2)
+
+
+def run_e2e(users, updates, seed, workers, timeout):
+    """bot.py كامل (WORKER_PROCESSES=workers) ضد fake_bot_api.py، ويرجع سطر النتيجة."""
+    workdir = tempfile.mkdtemp(prefix=f"qaher_e2e_{users}_")
+    generate_dataset(os.path.join(workdir, "user_data.json"), users, seed)
+    env = {
+        **os.environ,
+        "BOT_TOKEN": "123456:bench",
+        "WORKER_PROCESSES": "1",
+        "WORKERS_DIR": os.path.join(workdir, "workers"),
+        "PORT": str(free_port()),
+    }
+    bot_py = os.path.join(ROOT, "bot.py")
+    if env.get("STORAGE_BACKEND", "json") != "json":
+        subprocess.run(
+            [sys.executable, bot_py, "import-json", "user_data.json"],
+            cwd=workdir, env=env, check=True, capture_output=True,
+        )
+
+    api_port = free_port()
+    api = f"http://127.0.0.1:{api_port}"
+    env["TELEGRAM_BASE_URL"] = f"{api}/bot"
+    env["WORKER_PROCESSES"] = str(workers)
+    fake = subprocess.Popen(
+        [
+            sys.executable, os.path.join(ROOT, "benchmarks", "fake_bot_api.py"),
+            "--port", str(api_port), "--users", str(users), "--seed", str(seed),
+            "--flood-rate", "0", "--blocked-percent", "0",
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    log_path = os.path.join(workdir, "bot.log")
+    log = open(log_path, "w")
+    bot = subprocess.Popen([sys.executable, bot_py], cwd=workdir, env=env, stdout=log, stderr=log)
+    try:
+        wait_for(lambda: port_open(api_port), 10, "fake Bot API")
+        started = perf_counter()
+
+        def ready():
+            if bot.poll() is not None:
+                raise SystemExit(f"bot.py exited with {bot.returncode}, see {log_path}")
+            with open(log_path, encoding="utf-8") as f:
+                text = f.read()
+            workers_ready = workers == 1 or text.count(" ready with ") >= workers
+            return workers_ready and "Bot is starting in polling mode" in text
+
+        wait_for(ready, timeout, "bot.py startup")
+        startup_seconds = perf_counter() - started
+
+        queued = http_json(f"{api}/backlog", {"updates": updates})["result"]["updates_queued"]
+        # انتهى لما يفرغ الطابور ويثبت عدد الرسائل المسلّمة ثانيتين
+        last = {"delivered": -1, "since": perf_counter()}
+
+        def drained():
+            stats = http_json(f"{api}/stats")
+            if stats["updates_queued"] or stats["messages_delivered"] != last["delivered"]:
+                last.update(delivered=stats["messages_delivered"], since=perf_counter())
+                return False
+            return perf_counter() - last["since"] >= 2
+
+        wait_for(drained, timeout, "backlog to drain")
+        stats = http_json(f"{api}/stats")
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(60)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        log.close()
+        fake.send_signal(signal.SIGINT)
+        fake.wait(10)
+
+    seconds = stats["backlog_seconds"]
+    return {
+        "users": users,
+        "backend": env.get("STORAGE_BACKEND", "json"),
+        "workers": workers,
+        "updates": queued,
+        "updates_per_sec": round(queued / seconds, 1),
+        "wall_seconds": seconds,
+        "messages_sent": stats["messages_delivered"],
+        "startup_seconds": round(startup_seconds, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="أحجام البيانات مفصولة بفواصل")
+    parser.add_argument("--updates", type=int, default=5000, help="عدد التحديثات لكل حجم")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--e2e", action="store_true", help="bot.py كامل ضد fake_bot_api.py")
+    parser.add_argument("--workers", type=int, default=1, help="WORKER_PROCESSES مع --e2e")
+    parser.add_argument("--timeout", type=float, default=600, help="مهلة التشغيل/التفريغ مع --e2e")
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1 and not args.e2e:
+        parser.error("--workers needs --e2e (the in-process run has no worker path)")
+
+    if args.run_one is not None:
+        print(json.dumps(run_one(args.run_one, args.updates, args.seed)))
+        return
+
+    for size in (int(s) for s in args.sizes.split(",")):
+        if args.e2e:
+            result = run_e2e(size, args.updates, args.seed, args.workers, args.timeout)
+            print(json.dumps(result), flush=True)
+            continue
+        # كل حجم في عملية مستقلة: bot.py ينشئ store عند الاستيراد
+        out = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--run-one",
+                str(size),
+                "--updates",
+                str(args.updates),
+                "--seed",
+                str(args.seed),
+            ],
+            check=True,
+            stdout=subprocess.PIPE,
+            text=True,
+            env={**os.environ, "BOT_TOKEN": os.environ.get("BOT_TOKEN", "bench")},
+        )
+        print(out.stdout.strip().splitlines()[-1], flush=True)
+
+
+if __name__ == "__main__":
+    main()
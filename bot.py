@@ -1,23 +1,50 @@
 import os
+import gzip
+import hashlib
+import hmac
 import json
 import logging
+import multiprocessing
 import random
 import re
-from datetime import datetime, timezone, timedelta, time
-from threading import Thread
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from heapq import heapify, heappop, heappush
+from itertools import compress
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, time
+from io import BytesIO
+from queue import Empty
+from threading import Event, Lock, RLock, Thread, get_ident, local
+from threading import enumerate as enumerate_threads
+from time import monotonic, sleep
 
 import pytz
-from flask import Flask
+from flask import Flask, request
 
 from telegram import (
+    Bot,
     Update,
     ReplyKeyboardMarkup,
     KeyboardButton,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
 )
+from telegram.error import BadRequest, RetryAfter, TimedOut, Unauthorized
+from telegram.utils.request import Request
 from telegram.ext import (
     Updater,
     CommandHandler,
     MessageHandler,
+    CallbackQueryHandler,
+    TypeHandler,
     Filters,
     CallbackContext,
 )
@@ -26,23 +53,47 @@ from telegram.ext import (
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATA_FILE = "user_data.json"
+# لتوجيه البوت لسيرفر محلي (benchmarks/fake_bot_api.py) بدل تليجرام
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
 
 # ضع هنا ID الأدمن
 ADMIN_ID = 931350292  # عدّل هذا للـ ID تبعك
 
-# حالات المستخدمين
-WAITING_FOR_SUPPORT = set()
-WAITING_FOR_BROADCAST = set()
-WAITING_FOR_NOTE = set()              # لإضافة ملاحظة جديدة فقط
-WAITING_FOR_NOTE_MENU = set()         # قائمة إدارة الملاحظات
-WAITING_FOR_NOTE_EDIT = set()         # اختيار رقم ملاحظة للتعديل
-WAITING_FOR_NOTE_EDIT_TEXT = set()    # إرسال نص جديد بعد اختيار الرقم
-WAITING_FOR_NOTE_DELETE = set()       # اختيار رقم ملاحظة للحذف
-WAITING_FOR_RATING = set()
-WAITING_FOR_CUSTOM_START = set()
-
-# خريطة لحفظ رقم الملاحظة المؤقت أثناء التعديل
-NOTE_EDIT_INDEX = {}
+# وضع العمليات المتعددة (انظر قسم "العمليات المتعددة"): لو WORKER_PROCESSES > 1
+# تشتغل كل عملية (الأمامية والعمال) داخل مجلدها في WORKERS_DIR، فكل مسارات
+# البيانات النسبية (DATA_FILE، SQLITE_FILE، SHARD_DIR...) تصير خاصة بها.
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+WORKERS_DIR = os.path.abspath(os.getenv("WORKERS_DIR", "workers"))
+BASE_DIR = os.getcwd()
+# تضبطه العملية الأمامية للعمال فقط
+WORKER_INDEX = os.getenv("QAHER_WORKER_INDEX")
+WORKER_INDEX = int(WORKER_INDEX) if WORKER_INDEX is not None else None
+PROCESS_DIR = None
+
+
+def _enter_process_dir():
+    """ينقل العملية لمجلدها قبل إنشاء store (الذي يُنشأ عند الاستيراد)."""
+    global PROCESS_DIR
+    # العمال يبدؤون من مجلد العملية الأمامية، فنمرر لهم المسار المطلق
+    os.environ["WORKERS_DIR"] = WORKERS_DIR
+    PROCESS_DIR = os.path.join(WORKERS_DIR, "front" if WORKER_INDEX is None else str(WORKER_INDEX))
+    os.makedirs(PROCESS_DIR, exist_ok=True)
+    os.chdir(PROCESS_DIR)
+
+
+# فقط عند التشغيل كبرنامج (python bot.py) أو كعامل (spawn يستورده كـ __mp_main__)؛
+# استيراده كموديول (اختبارات، benchmarks) لا يغيّر cwd ولا البيئة
+if WORKER_PROCESSES > 1 and __name__ in ("__main__", "__mp_main__"):
+    _enter_process_dir()
+
+# حالات المستخدمين (انظر CONVERSATIONS)
+STATE_SUPPORT = "support"
+STATE_BROADCAST_SEGMENT = "broadcast_segment"  # اختيار الشريحة قبل الرسالة الجماعية
+STATE_BROADCAST = "broadcast"              # data = {"segment", "count"}
+STATE_NOTE_ADD = "note_add"                # لإضافة ملاحظة جديدة فقط
+STATE_NOTE_EDIT_TEXT = "note_edit_text"    # إرسال نص جديد بعد الضغط على ✏️ (data = {"idx", "tag"})
+STATE_RATING = "rating"
+STATE_CUSTOM_START = "custom_start"
 
 # ملف اللوج
 logging.basicConfig(
@@ -65,95 +116,2619 @@ def run_flask():
     port = int(os.environ.get("PORT", "10000"))
     app.run(host="0.0.0.0", port=port)
 
+# =================== المقاييس (Prometheus) ===================
+#
+# عدّادات وهيستوجرامات بسيطة في الذاكرة، تُعرض بصيغة Prometheus النصية
+# على /metrics. القيم اللحظية (عدد المستخدمين، الحالات المعلّقة...) تُحسب
+# عند كل قراءة عبر دوال Gauge.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = []
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # label_values → [counts per bucket..., count, sum]
+        self._lock = Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            row = self._values.get(label_values)
+            if row is None:
+                row = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += 1
+            row[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(k, list(row)) for k, row in self._values.items()]
+        names = self.labels + ("le",)
+        for label_values, row in items:
+            for bound, count in zip(self.buckets, row):
+                labels = _format_labels(names, label_values + (bound,))
+                yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(names, label_values + ("+Inf",))
+            yield f"{self.name}_bucket{labels} {row[-2]}"
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_count{labels} {row[-2]}"
+            yield f"{self.name}_sum{labels} {row[-1]}"
+
+
+class Gauge:
+    """قيمة لحظية؛ fn ترجع رقم، أو dict من label_values → رقم."""
+
+    def __init__(self, name, help_text, fn, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.fn = fn
+        METRICS.append(self)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.error(f"Error collecting {self.name}: {e}")
+            return
+        if not isinstance(value, dict):
+            value = {(): value}
+        for label_values, v in value.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {v}"
+
+
+HANDLER_SECONDS = Histogram(
+    "qaher_handler_seconds", "Time spent in each update handler", ("handler",)
+)
+BUTTON_PRESSES = Counter(
+    "qaher_button_presses_total", "Main-menu buttons handled", ("handler",)
+)
+STATE_MESSAGES = Counter(
+    "qaher_state_messages_total", "Messages handled inside a conversation state", ("state",)
+)
+STORE_WRITE_SECONDS = Histogram(
+    "qaher_store_write_seconds", "Duration of storage writes", ("op",)
+)
+STORE_BYTES_WRITTEN = Counter(
+    "qaher_store_bytes_written_total", "Bytes written to data files", ("file",)
+)
+API_REQUESTS = Counter(
+    "qaher_api_requests_total", "Bot API calls by method and result", ("method", "result")
+)
+API_SECONDS = Histogram(
+    "qaher_api_seconds", "Bot API call latency", ("method",)
+)
+BULK_SENDS = Counter(
+    "qaher_bulk_sends_total", "Broadcast / daily-reminder deliveries by result", ("job", "result")
+)
+
+
+# القيم اللحظية: الكائنات المذكورة معرّفة لاحقًا في الملف، وتُقرأ عند الطلب فقط
+Gauge("qaher_users", "Known users", lambda: store.count())
+Gauge("qaher_pending_records", "User records waiting for the next flush", lambda: len(_pending))
+Gauge(
+    "qaher_conversation_states",
+    "Users currently inside each conversation state",
+    lambda: {(state,): n for state, n in CONVERSATIONS.counts().items()},
+    ("state",),
+)
+Gauge("qaher_queued_updates", "Updates waiting on UPDATE_EXECUTOR", lambda: UPDATE_EXECUTOR.queued())
+
+
+# ردود الهاندلرات لا تمر على OUTBOUND_BUCKET؛ لو رجع RetryAfter (رسالة جماعية
+# شغّالة مثلًا) نوقف الإرسال المحدود نفس المدة حتى يفسح المجال، وننتظر ونعيد
+# المحاولة بدل أن يضيع الرد، ما دامت المدة لا تتجاوز REPLY_RETRY_MAX_WAIT.
+REPLY_RETRY_MAX_WAIT = float(os.getenv("REPLY_RETRY_MAX_WAIT", "10"))
+REPLY_MAX_RETRIES = 3
+_throttled_send = local()  # send_throttled يعالج RetryAfter بنفسه عبر OUTBOUND_BUCKET
+
+
+class MeteredBot(Bot):
+    """Bot يسجّل كل طلب للـ API: المدة، والنتيجة حسب نوع الخطأ."""
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        for attempt in range(REPLY_MAX_RETRIES + 1):
+            try:
+                return self._post_once(endpoint, data, timeout, api_kwargs)
+            except RetryAfter as e:
+                OUTBOUND_BUCKET.pause(e.retry_after)
+                if (
+                    getattr(_throttled_send, "active", False)
+                    or attempt == REPLY_MAX_RETRIES
+                    or e.retry_after > REPLY_RETRY_MAX_WAIT
+                ):
+                    raise
+                logger.warning(f"Flood limit on {endpoint}, retrying in {e.retry_after}s")
+                sleep(e.retry_after)
+
+    def _post_once(self, endpoint, data, timeout, api_kwargs):
+        started = monotonic()
+        try:
+            result = super()._post(endpoint, data, timeout=timeout, api_kwargs=api_kwargs)
+        except Exception as e:
+            API_REQUESTS.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(monotonic() - started, endpoint)
+        API_REQUESTS.inc(endpoint, "ok")
+        return result
+
+
+def timed_call(fn, *args):
+    """ينفّذ fn ويسجّل مدتها في HANDLER_SECONDS باسم الدالة."""
+    started = monotonic()
+    try:
+        return fn(*args)
+    finally:
+        HANDLER_SECONDS.observe(monotonic() - started, fn.__name__)
+
+
+def _with_worker_label(line, worker):
+    name, value = line.rsplit(" ", 1)
+    label = f'worker="{worker}"'
+    if name.endswith("}"):
+        return f"{name[:-1]},{label}}} {value}"
+    return f"{name}{{{label}}} {value}"
+
+
+def metric_blocks(worker=None):
+    """سطور كل مقياس (HELP وTYPE ثم القيم)؛ worker يضيف label للقيم."""
+    blocks = []
+    for metric in METRICS:
+        lines = list(metric.render())
+        if worker is not None:
+            lines[2:] = [_with_worker_label(line, worker) for line in lines[2:]]
+        blocks.append(lines)
+    return blocks
+
+
+def render_metrics() -> str:
+    if WORKER_PROCESSES > 1 and WORKER_INDEX is None:
+        # العملية الأمامية: نفس المقاييس من كل عامل تحت HELP/TYPE واحد
+        parts = [metric_blocks("front")] + call_workers("metric_blocks")
+    else:
+        parts = [metric_blocks()]
+    lines = []
+    for blocks in zip(*parts):
+        lines.extend(blocks[0][:2])
+        for block in blocks:
+            lines.extend(block[2:])
+    return "\n".join(lines) + "\n"
+
+
+@app.route("/metrics")
+def metrics():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
 # =================== تخزين بيانات المستخدمين ===================
+#
+# كل الوصول للبيانات يمر عبر كائن store (واجهة UserStore).
+# الخلفية تُختار من متغير البيئة STORAGE_BACKEND:
+#   json    → لقطة JSON + سجل إضافي (الافتراضي)
+#   sqlite  → قاعدة SQLite بوضع WAL مع جداول للمستخدمين والملاحظات والتقييمات
+#   sharded → ملف لكل مستخدم، يُقرأ عند الحاجة فقط
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_FILE = os.getenv("SQLITE_FILE", "user_data.sqlite3")
+SHARD_DIR = os.getenv("SHARD_DIR", "user_data")
+SHARD_CACHE_SIZE = int(os.getenv("SHARD_CACHE_SIZE", "10000"))
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+
+# الحقول المحفوظة في صف المستخدم نفسه (بدون الملاحظات والتقييمات)
+USER_FIELDS = (
+    "user_id",
+    "first_name",
+    "username",
+    "created_at",
+    "last_active",
+    "streak_start",
+    "unreachable_at",
+)
+
+
+# =================== سجل المستخدم في الذاكرة ===================
+#
+# UserRecord بدل dict لكل مستخدم: __slots__ بدون __dict__، والأوقات
+# كأرقام صحيحة (epoch seconds) بدل نصوص ISO، والاسم واليوزر interned.
+# صيغة الملفات على القرص ما تغيّرت: التحويل من/إلى dict بنفس الشكل القديم
+# يتم فقط عند القراءة والكتابة. الأوقات تُحفظ بدقة الثانية.
+
+TIME_FIELDS = ("created_at", "last_active", "streak_start", "unreachable_at")
+# حقول اختيارية لا تُكتب في الملف إلا لو لها قيمة
+OPTIONAL_FIELDS = ("unreachable_at",)
+
+
+def now_ts() -> int:
+    return int(datetime.now(timezone.utc).timestamp())
+
+
+def ts_day(ts):
+    """رقم اليوم منذ epoch (بتوقيت UTC)."""
+    return None if ts is None else ts // 86400
+
+
+def iso_to_ts(value):
+    if value is None or isinstance(value, int):
+        return value
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def ts_to_iso(ts):
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Ratings:
+    """تقييم واحد لكل يوم كمصفوفتين متوازيتين مرتبتين حسب اليوم.
+
+    days: أيام epoch (2 بايت لكل يوم)، values: القيمة 1-5 (بايت واحد).
+    المصفوفات لا تُنشأ إلا مع أول تقييم. في الملف:
+    {"days": [أول يوم، ثم الفرق عن اليوم السابق...], "values": "43512"}
+    """
+
+    __slots__ = ("days", "values")
+
+    def __init__(self, days=None, values=None):
+        self.days = array("H", days) if days else None
+        self.values = array("B", values) if values else None
+
+    def __len__(self):
+        return len(self.days) if self.days else 0
+
+    def __iter__(self):
+        """يمر على (day, value) بالترتيب."""
+        if self.days:
+            yield from zip(self.days, self.values)
+
+    def since(self, day):
+        """(day, value) لكل تقييم من day فما بعد."""
+        if self.days:
+            start = bisect_left(self.days, day)
+            yield from zip(self.days[start:], self.values[start:])
+
+    def set(self, day, value):
+        """upsert لتقييم اليوم، ويرجع القيمة السابقة لنفس اليوم أو None."""
+        if self.days is None:
+            self.days, self.values = array("H"), array("B")
+        i = bisect_left(self.days, day)
+        if i < len(self.days) and self.days[i] == day:
+            old = self.values[i]
+            self.values[i] = value
+            return old
+        self.days.insert(i, day)
+        self.values.insert(i, value)
+        return None
 
+    def average(self, today, window):
+        """متوسط تقييمات آخر window يوم (شاملة اليوم)، أو None."""
+        if not self.days:
+            return None
+        start = bisect_left(self.days, today - window + 1)
+        values = self.values[start:]
+        return sum(values) / len(values) if values else None
+
+    def summary(self, today):
+        """(متوسط 7 أيام، متوسط 30 يوم، الاتجاه = الفرق بينهما)."""
+        avg7 = self.average(today, 7)
+        avg30 = self.average(today, 30)
+        trend = avg7 - avg30 if avg7 is not None and avg30 is not None else None
+        return avg7, avg30, trend
+
+    def to_json(self):
+        if not self.days:
+            return {"days": [], "values": ""}
+        days = [self.days[0]] + [b - a for a, b in zip(self.days, self.days[1:])]
+        return {"days": days, "values": "".join(map(str, self.values))}
+
+    @classmethod
+    def from_json(cls, data):
+        ratings = cls()
+        if not data:
+            return ratings
+        if isinstance(data, list):
+            # الصيغة القديمة: [{"value", "at"}...]، آخر تقييم في اليوم هو المعتمد
+            for r in data:
+                ratings.set(ts_day(iso_to_ts(r["at"])), r["value"])
+            return ratings
+        day = 0
+        days = []
+        for delta in data.get("days", []):
+            day += delta
+            days.append(day)
+        return cls(days, [int(v) for v in data.get("values", "")])
+
+
+class UserRecord:
+    __slots__ = (
+        "user_id",
+        "first_name",
+        "username",
+        "created_at",
+        "last_active",
+        "streak_start",
+        "notes",
+        "ratings",
+        "unreachable_at",
+        "extra",
+    )
+
+    def __init__(
+        self,
+        user_id,
+        first_name=None,
+        username=None,
+        created_at=None,
+        last_active=None,
+        streak_start=None,
+        notes=None,
+        ratings=None,
+        unreachable_at=None,
+        extra=None,
+    ):
+        self.user_id = int(user_id)
+        self.first_name = _intern(first_name)
+        self.username = _intern(username)
+        self.created_at = created_at
+        self.last_active = last_active
+        self.streak_start = streak_start
+        self.notes = notes if notes is not None else []
+        self.ratings = ratings if ratings is not None else Ratings()
+        # آخر مرة فشل الإرسال له لأنه حظر البوت أو حذف حسابه
+        self.unreachable_at = unreachable_at
+        # أي مفاتيح غير معروفة من الملف تُحفظ كما هي حتى لا نفقدها
+        self.extra = extra
+
+    def update(self, fields):
+        for key, value in fields.items():
+            if key in ("first_name", "username"):
+                value = _intern(value)
+            if key in UserRecord.__slots__ and key != "extra":
+                setattr(self, key, value)
+            else:
+                if self.extra is None:
+                    self.extra = {}
+                self.extra[key] = value
+
+    @classmethod
+    def from_dict(cls, d, user_id=None):
+        extra = {
+            k: v
+            for k, v in d.items()
+            if k not in UserRecord.__slots__ or k == "extra"
+        }
+        return cls(
+            user_id=d.get("user_id", user_id),
+            first_name=d.get("first_name"),
+            username=d.get("username"),
+            created_at=iso_to_ts(d.get("created_at")),
+            last_active=iso_to_ts(d.get("last_active")),
+            streak_start=iso_to_ts(d.get("streak_start")),
+            notes=list(d.get("notes") or []),
+            ratings=Ratings.from_json(d.get("ratings")),
+            unreachable_at=iso_to_ts(d.get("unreachable_at")),
+            extra=extra or None,
+        )
+
+    def to_dict(self):
+        d = {
+            "user_id": self.user_id,
+            "first_name": self.first_name,
+            "username": self.username,
+            "created_at": ts_to_iso(self.created_at),
+            "last_active": ts_to_iso(self.last_active),
+            "streak_start": ts_to_iso(self.streak_start),
+            "notes": list(self.notes),
+            "ratings": self.ratings.to_json(),
+        }
+        for key in OPTIONAL_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                d[key] = ts_to_iso(value) if key in TIME_FIELDS else value
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    @staticmethod
+    def fields_to_json(fields):
+        """يحوّل حقول تعديل جزئي إلى نفس شكل الملف (للسجل الإضافي وSQLite)."""
+        out = {}
+        for key, value in fields.items():
+            if key in TIME_FIELDS:
+                value = ts_to_iso(value)
+            elif key == "ratings":
+                value = value.to_json()
+            elif key == "notes":
+                value = list(value)
+            out[key] = value
+        return out
+
+
+def _temp_file(path):
+    """ملف مؤقت باسم فريد بجانب path (كاتبان في نفس الوقت لا يتصادمان)."""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    return os.fdopen(fd, "w", encoding="utf-8"), tmp_path
 
-def load_data():
-    if not os.path.exists(DATA_FILE):
-        return {}
+
+def _write_lines(path, rows):
+    """يكتب ملف JSONL (سطر لكل صف) بشكل ذري."""
+    f, tmp_path = _temp_file(path)
+    try:
+        with f:
+            for row in rows:
+                f.write(json.dumps(row, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _read_json_file(path, default=None):
+    if not os.path.exists(path):
+        return default
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             return json.load(f)
     except Exception as e:
-        logger.error(f"Error loading data: {e}")
-        return {}
+        logger.error(f"Error loading {path}: {e}")
+        return default
+
+
+def _write_json_file(path, obj):
+    """كتابة ذرّية: ملف مؤقت (باسم فريد) ثم rename."""
+    tmp_path = None
+    try:
+        f, tmp_path = _temp_file(path)
+        with f:
+            json.dump(obj, f, ensure_ascii=False, separators=(",", ":"))
+            STORE_BYTES_WRITTEN.inc("state", amount=f.tell())
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.error(f"Error saving {path}: {e}")
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class UserStore:
+    """الواجهة المشتركة لكل خلفيات التخزين."""
+
+    # ملف صغير لبيانات عامة غير مرتبطة بمستخدم (حالات المحادثة وغيرها)
+    meta_path = None
+    _meta = None
+    # save_meta والمهام الدورية (المراحل، إعادة التواصل، فحص الإحصائيات) تكتب
+    # meta من ثريدات مختلفة؛ القفل يشمل تعديل القاموس وكتابة الملف معًا
+    _meta_lock = Lock()
+
+    def get(self, user_id):
+        """يرجع UserRecord أو None لو المستخدم غير موجود."""
+        raise NotImplementedError
+
+    def create(self, user_id, record):
+        raise NotImplementedError
+
+    def update(self, user_id, fields):
+        raise NotImplementedError
+
+    def update_many(self, items):
+        """items = [(user_id, fields), ...] تُكتب كدفعة واحدة."""
+        for user_id, fields in items:
+            self.update(user_id, fields)
+
+    def user_ids(self):
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def reachable_user_ids(self):
+        """المستخدمين الذين لم يُعلَّموا كـ unreachable (للإرسال الجماعي)."""
+        raise NotImplementedError
+
+    def count_reachable(self):
+        raise NotImplementedError
+
+    def iter_records(self):
+        """يمر على السجلات كاملة (مع الملاحظات والتقييمات) واحد واحد كـ UserRecord."""
+        raise NotImplementedError
+
+    def segment_fields(self):
+        """(user_id, created_at, last_active, streak_start, unreachable_at) لكل المستخدمين."""
+        return [
+            (r.user_id, r.created_at, r.last_active, r.streak_start, r.unreachable_at)
+            for r in self.iter_records()
+        ]
+
+    def recent_ratings(self, since_day):
+        """(user_id, day, value) لكل تقييم من since_day فما بعد."""
+        return [
+            (r.user_id, day, value)
+            for r in self.iter_records()
+            for day, value in r.ratings.since(since_day)
+        ]
+
+    def get_notes(self, user_id):
+        raise NotImplementedError
+
+    def get_notes_page(self, user_id, offset, limit):
+        """يرجع (ملاحظات الصفحة، العدد الكلي) بدون نسخ كل الملاحظات."""
+        record = self.get(user_id)
+        if record is None:
+            return [], 0
+        return record.notes[offset:offset + limit], len(record.notes)
+
+    def add_note(self, user_id, text):
+        raise NotImplementedError
+
+    def edit_note(self, user_id, idx, text):
+        """يرجع True لو الملاحظة موجودة وتم تعديلها."""
+        raise NotImplementedError
+
+    def delete_note(self, user_id, idx):
+        """يرجع نص الملاحظة المحذوفة أو None."""
+        raise NotImplementedError
+
+    def get_ratings(self, user_id):
+        record = self.get(user_id)
+        return record.ratings if record else Ratings()
+
+    def set_rating(self, user_id, day, value):
+        """تقييم واحد لكل يوم: يستبدل تقييم نفس اليوم ويرجع القيمة السابقة أو None."""
+        raise NotImplementedError
+
+    def get_meta(self, key, default=None):
+        with self._meta_lock:
+            if self._meta is None:
+                self._meta = _read_json_file(self.meta_path, {})
+            return self._meta.get(key, default)
+
+    def set_meta(self, key, value):
+        self.set_meta_many({key: value})
+
+    def set_meta_many(self, items):
+        """يحفظ عدة مفاتيح بكتابة واحدة لملف meta."""
+        with self._meta_lock:
+            if self._meta is None:
+                self._meta = _read_json_file(self.meta_path, {})
+            self._meta.update(items)
+            _write_json_file(self.meta_path, self._meta)
+
+    def close(self):
+        pass
+
+
+class JsonStore(UserStore):
+    """
+    لقطة كاملة (path) + سجل إضافي (path.journal).
+
+    كل تعديل على سجل مستخدم يُكتب كسطر JSON مضغوط في آخر السجل الإضافي،
+    وعند التشغيل نقرأ اللقطة ثم نعيد تطبيق السطور بالترتيب.
+    لما يكبر السجل الإضافي عن compact_bytes ندوّره إلى ملف ".old"
+    ونبني منه لقطة جديدة في ثريد خلفي بدون لمس البيانات الحية.
+    """
+
+    def __init__(self, path, compact_bytes=JOURNAL_COMPACT_BYTES):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.journal_old_path = self.journal_path + ".old"
+        self.meta_path = path + ".meta.json"
+        self.compact_bytes = compact_bytes
+        self._lock = Lock()  # لملف السجل الإضافي
+        self._data_lock = RLock()  # لـ self.data (dispatcher + job_queue + flusher)
+        self._fh = None
+        self._size = 0
+        self._compacting = False
+
+        self.data = self._load()
+        self._open_journal()
+        if os.path.exists(self.journal_old_path):
+            # تدوير سابق لم يكتمل (انطفاء أثناء الدمج)
+            self._compacting = True
+            Thread(
+                target=self._compact, name="journal-compaction", daemon=True
+            ).start()
+
+    # ---------- القراءة عند التشغيل ----------
+
+    @staticmethod
+    def _read_snapshot(path):
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading data: {e}")
+            return {}
+
+    @staticmethod
+    def _replay_journal(data, path):
+        """يطبّق سطور السجل الإضافي على data بالترتيب."""
+        if not os.path.exists(path):
+            return 0
+        applied = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # آخر سطر ممكن يكون ناقص لو انطفى السيرفر أثناء الكتابة
+                    logger.warning(f"Skipping corrupt journal line {line_no} in {path}")
+                    continue
+                data.setdefault(entry["u"], {}).update(entry["set"])
+                applied += 1
+        return applied
+
+    def _load(self):
+        data = self._read_snapshot(self.path)
+        try:
+            self._replay_journal(data, self.journal_old_path)
+            self._replay_journal(data, self.journal_path)
+        except Exception as e:
+            logger.error(f"Error replaying journal: {e}")
+        records = {}
+        for uid, d in data.items():
+            try:
+                records[uid] = UserRecord.from_dict(d, uid)
+            except ValueError:
+                # سجلات قديمة ممكن يكون فيها تاريخ بصيغة غريبة: نلغي الحقل بدل ما نوقف التشغيل
+                logger.warning(f"Malformed timestamp for user {uid}, dropping it")
+                records[uid] = UserRecord.from_dict(self._drop_bad_timestamps(d), uid)
+        return records
+
+    @staticmethod
+    def _drop_bad_timestamps(d):
+        d = dict(d)
+        for key in TIME_FIELDS:
+            try:
+                iso_to_ts(d.get(key))
+            except (ValueError, TypeError):
+                d[key] = None
+        return d
+
+    # ---------- الكتابة ----------
+
+    def _save_snapshot(self, data):
+        """يكتب لقطة كاملة بشكل ذرّي (ملف مؤقت ثم rename)."""
+        tmp_path = self.path + ".tmp"
+        started = monotonic()
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+                STORE_BYTES_WRITTEN.inc("snapshot", amount=f.tell())
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Error saving data: {e}")
+        STORE_WRITE_SECONDS.observe(monotonic() - started, "snapshot")
+
+    def _open_journal(self):
+        self._fh = open(self.journal_path, "a", encoding="utf-8")
+        self._size = self._fh.tell()
+
+    def _compact(self):
+        """يدمج السجل القديم في لقطة جديدة (يشتغل في ثريد خلفي)."""
+        try:
+            snapshot = self._read_snapshot(self.path)
+            applied = self._replay_journal(snapshot, self.journal_old_path)
+            self._save_snapshot(snapshot)
+            os.remove(self.journal_old_path)
+            logger.info(f"Journal compacted: {applied} entries folded into snapshot")
+        except Exception as e:
+            logger.error(f"Error compacting journal: {e}")
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def _start_compaction(self):
+        """لازم تُستدعى و self._lock مقفول."""
+        self._compacting = True
+        self._fh.close()
+        if not os.path.exists(self.journal_old_path):
+            os.replace(self.journal_path, self.journal_old_path)
+        self._open_journal()
+        Thread(target=self._compact, name="journal-compaction", daemon=True).start()
+
+    def _append(self, uid, fields):
+        """يضيف سطر واحد فيه الحقول المتغيّرة فقط لسجل مستخدم."""
+        self._append_lines([(uid, UserRecord.fields_to_json(fields))])
+
+    def _append_lines(self, items):
+        """items = [(uid, حقول بصيغة الملف)]، تُكتب كلها بعملية write واحدة."""
+        chunk = "".join(
+            json.dumps(
+                {"u": uid, "set": fields},
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+            + "\n"
+            for uid, fields in items
+        )
+        with self._lock:
+            try:
+                self._fh.write(chunk)
+                self._fh.flush()
+                written = len(chunk.encode("utf-8"))
+                self._size += written
+                STORE_BYTES_WRITTEN.inc("journal", amount=written)
+                if self._size >= self.compact_bytes and not self._compacting:
+                    self._start_compaction()
+            except Exception as e:
+                logger.error(f"Error writing journal: {e}")
+
+    # ---------- واجهة UserStore ----------
+
+    def get(self, user_id):
+        return self.data.get(str(user_id))
+
+    def _records(self):
+        with self._data_lock:
+            return list(self.data.values())
+
+    def create(self, user_id, record):
+        uid = str(user_id)
+        with self._data_lock:
+            self.data[uid] = record
+            self._append_lines([(uid, record.to_dict())])
+
+    def update(self, user_id, fields):
+        uid = str(user_id)
+        with self._data_lock:
+            if uid not in self.data:
+                return
+            self.data[uid].update(fields)
+            self._append(uid, fields)
+
+    def update_many(self, items):
+        lines = []
+        with self._data_lock:
+            for user_id, fields in items:
+                uid = str(user_id)
+                if uid in self.data:
+                    self.data[uid].update(fields)
+                    lines.append((uid, UserRecord.fields_to_json(fields)))
+            if lines:
+                self._append_lines(lines)
+
+    def user_ids(self):
+        with self._data_lock:
+            return [int(uid) for uid in self.data.keys()]
+
+    def count(self):
+        return len(self.data)
+
+    def reachable_user_ids(self):
+        return [r.user_id for r in self._records() if r.unreachable_at is None]
+
+    def count_reachable(self):
+        return sum(1 for r in self._records() if r.unreachable_at is None)
+
+    def iter_records(self):
+        yield from self._records()
+
+    def segment_fields(self):
+        return [
+            (r.user_id, r.created_at, r.last_active, r.streak_start, r.unreachable_at)
+            for r in self._records()
+        ]
+
+    def recent_ratings(self, since_day):
+        return [
+            (r.user_id, day, value)
+            for r in self._records()
+            for day, value in r.ratings.since(since_day)
+        ]
+
+    def get_notes(self, user_id):
+        record = self.get(user_id)
+        return list(record.notes) if record else []
+
+    def add_note(self, user_id, text):
+        with self._data_lock:
+            record = self.get(user_id)
+            if record is None:
+                return
+            record.notes.append(text)
+            self._append(str(user_id), {"notes": record.notes})
+
+    def edit_note(self, user_id, idx, text):
+        with self._data_lock:
+            record = self.get(user_id)
+            notes = record.notes if record else []
+            if idx < 0 or idx >= len(notes):
+                return False
+            notes[idx] = text
+            self._append(str(user_id), {"notes": notes})
+            return True
+
+    def delete_note(self, user_id, idx):
+        with self._data_lock:
+            record = self.get(user_id)
+            notes = record.notes if record else []
+            if idx < 0 or idx >= len(notes):
+                return None
+            deleted = notes.pop(idx)
+            self._append(str(user_id), {"notes": notes})
+            return deleted
+
+    def set_rating(self, user_id, day, value):
+        with self._data_lock:
+            record = self.get(user_id)
+            if record is None:
+                return None
+            old = record.ratings.set(day, value)
+            self._append(str(user_id), {"ratings": record.ratings})
+            return old
+
+    def close(self):
+        with self._lock:
+            if self._fh:
+                self._fh.close()
+                self._fh = None
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id      INTEGER PRIMARY KEY,
+    first_name   TEXT,
+    username     TEXT,
+    created_at   TEXT,
+    last_active  TEXT,
+    streak_start TEXT,
+    unreachable_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active);
+CREATE INDEX IF NOT EXISTS idx_users_streak_start ON users(streak_start);
+
+CREATE TABLE IF NOT EXISTS notes (
+    id      INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    text    TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_notes_user ON notes(user_id, id);
+
+CREATE TABLE IF NOT EXISTS daily_ratings (
+    user_id INTEGER NOT NULL,
+    day     INTEGER NOT NULL,
+    value   INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_daily_ratings_day ON daily_ratings(day);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class SqliteStore(UserStore):
+    """
+    SQLite بوضع WAL. كل كتابة = upsert لصف واحد،
+    واستعلامات الأدمن تمشي على الفهارس بدل المرور على كل المستخدمين.
+    الأعمدة بنفس صيغة ملف JSON (ISO)، والملاحظات والتقييمات لا تُحمَّل مع get.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = RLock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SQLITE_SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """يضيف أعمدة USER_FIELDS الجديدة لقواعد أنشئت بنسخة أقدم."""
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+        for col in USER_FIELDS:
+            if col not in existing:
+                self._conn.execute(f"ALTER TABLE users ADD COLUMN {col} TEXT")
+
+        # جدول ratings القديم (صف لكل ضغطة) → daily_ratings (صف لكل يوم)
+        legacy = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ratings'"
+        ).fetchone()
+        if legacy:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO daily_ratings (user_id, day, value) "
+                    "SELECT user_id, CAST(strftime('%s', at) AS INTEGER) / 86400, value "
+                    "FROM ratings ORDER BY id"
+                )
+                self._conn.execute("DROP TABLE ratings")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            logger.info("Migrated ratings to daily_ratings")
+
+    def _upsert_user(self, user_id, fields):
+        cols = [c for c in USER_FIELDS if c in fields and c != "user_id"]
+        values = [fields[c] for c in cols]
+        assignments = ", ".join(f"{c}=excluded.{c}" for c in cols) or "user_id=user_id"
+        self._conn.execute(
+            f"INSERT INTO users (user_id{''.join(', ' + c for c in cols)}) "
+            f"VALUES (?{', ?' * len(cols)}) "
+            f"ON CONFLICT(user_id) DO UPDATE SET {assignments}",
+            [int(user_id)] + values,
+        )
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM users WHERE user_id = ?", (int(user_id),)
+            ).fetchone()
+        return UserRecord.from_dict(dict(row)) if row else None
+
+    def create(self, user_id, record):
+        ratings = record.ratings
+        record = record.to_dict()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                # create يستبدل المستخدم بالكامل، فيبقى الاستيراد المتكرر آمن
+                self._upsert_user(user_id, record)
+                self._conn.execute("DELETE FROM notes WHERE user_id = ?", (int(user_id),))
+                self._conn.execute(
+                    "DELETE FROM daily_ratings WHERE user_id = ?", (int(user_id),)
+                )
+                self._conn.executemany(
+                    "INSERT INTO notes (user_id, text) VALUES (?, ?)",
+                    [(int(user_id), n) for n in record.get("notes") or []],
+                )
+                self._conn.executemany(
+                    "INSERT INTO daily_ratings (user_id, day, value) VALUES (?, ?, ?)",
+                    [(int(user_id), day, value) for day, value in ratings],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def update(self, user_id, fields):
+        cols = [c for c in USER_FIELDS if c in fields and c != "user_id"]
+        if not cols:
+            return
+        fields = UserRecord.fields_to_json({c: fields[c] for c in cols})
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE users SET {', '.join(c + ' = ?' for c in cols)} "
+                "WHERE user_id = ?",
+                [fields[c] for c in cols] + [int(user_id)],
+            )
+
+    def update_many(self, items):
+        # معاملة واحدة للدفعة كلها = fsync واحد بدل واحد لكل مستخدم
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for user_id, fields in items:
+                    self.update(user_id, fields)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def user_ids(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id FROM users").fetchall()
+        return [row[0] for row in rows]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def reachable_user_ids(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id FROM users WHERE unreachable_at IS NULL"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def count_reachable(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM users WHERE unreachable_at IS NULL"
+            ).fetchone()[0]
+
+    def segment_fields(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, created_at, last_active, streak_start, unreachable_at FROM users"
+            ).fetchall()
+        return [(row[0], *map(iso_to_ts, row[1:])) for row in rows]
+
+    def recent_ratings(self, since_day):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, day, value FROM daily_ratings WHERE day >= ?",
+                (since_day,),
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def iter_records(self):
+        # كل دفعة بقفل مستقل حتى ما نحجز القاعدة طول التصدير
+        last_id = None
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT * FROM users WHERE ? IS NULL OR user_id > ? "
+                    "ORDER BY user_id LIMIT 500",
+                    (last_id, last_id),
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                record = dict(row)
+                record["notes"] = self.get_notes(record["user_id"])
+                user = UserRecord.from_dict(record)
+                user.ratings = self.get_ratings(record["user_id"])
+                yield user
+            last_id = rows[-1]["user_id"]
+
+    def _note_id(self, user_id, idx):
+        if idx < 0:
+            return None
+        row = self._conn.execute(
+            "SELECT id FROM notes WHERE user_id = ? ORDER BY id LIMIT 1 OFFSET ?",
+            (int(user_id), idx),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_notes(self, user_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT text FROM notes WHERE user_id = ? ORDER BY id",
+                (int(user_id),),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_notes_page(self, user_id, offset, limit):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT text FROM notes WHERE user_id = ? ORDER BY id LIMIT ? OFFSET ?",
+                (int(user_id), limit, offset),
+            ).fetchall()
+            total = self._conn.execute(
+                "SELECT COUNT(*) FROM notes WHERE user_id = ?", (int(user_id),)
+            ).fetchone()[0]
+        return [row[0] for row in rows], total
+
+    def add_note(self, user_id, text):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO notes (user_id, text) VALUES (?, ?)", (int(user_id), text)
+            )
+
+    def edit_note(self, user_id, idx, text):
+        with self._lock:
+            note_id = self._note_id(user_id, idx)
+            if note_id is None:
+                return False
+            self._conn.execute("UPDATE notes SET text = ? WHERE id = ?", (text, note_id))
+            return True
+
+    def delete_note(self, user_id, idx):
+        with self._lock:
+            note_id = self._note_id(user_id, idx)
+            if note_id is None:
+                return None
+            row = self._conn.execute(
+                "SELECT text FROM notes WHERE id = ?", (note_id,)
+            ).fetchone()
+            self._conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+            return row[0]
+
+    def get_ratings(self, user_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, value FROM daily_ratings WHERE user_id = ? ORDER BY day",
+                (int(user_id),),
+            ).fetchall()
+        return Ratings([r[0] for r in rows], [r[1] for r in rows])
+
+    def set_rating(self, user_id, day, value):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM daily_ratings WHERE user_id = ? AND day = ?",
+                (int(user_id), day),
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO daily_ratings (user_id, day, value) VALUES (?, ?, ?)",
+                (int(user_id), day, value),
+            )
+        return row[0] if row else None
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, json.dumps(value, ensure_ascii=False)),
+            )
+
+    def set_meta_many(self, items):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO meta (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    [(key, json.dumps(value, ensure_ascii=False)) for key, value in items.items()],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ShardedStore(UserStore):
+    """
+    ملف صغير لكل مستخدم داخل مجلدات حسب أول حرفين من hash الـ ID:
+        root/ab/12345.json
+    السجل يُقرأ من القرص عند أول وصول ويبقى في LRU محدود الحجم،
+    وقائمة الـ IDs في ملف root/ids.txt (سطر لكل مستخدم) بدل فتح كل الملفات.
+    الـ IDs غير القابلة للوصول في root/unreachable.json (عادة قليلة).
+    الحقول الزمنية التي تحتاجها فهارس التشغيل في root/summary.jsonl: سطر
+    [user_id, created_at, last_active, streak_start] يُضاف مع كل تغيير لها
+    (آخر سطر للمستخدم هو المعتمد)، ويُضغط في ثريد خلفي لما يتجاوز ضعف عدد
+    المستخدمين (القفل يُحجز فقط لنقل ما أُضيف أثناء الضغط).
+    وتقييمات آخر SHARD_RATINGS_LOG_DAYS يوم في root/ratings.jsonl ([user_id, day, value]).
+    وقت التشغيل والذاكرة ثابتين مهما زاد عدد المستخدمين.
+    """
+
+    SUMMARY_FIELDS = ("created_at", "last_active", "streak_start")
+    SHARD_RATINGS_LOG_DAYS = 31
+
+    def __init__(self, root, cache_size=SHARD_CACHE_SIZE):
+        self.root = root
+        self.ids_path = os.path.join(root, "ids.txt")
+        self.unreachable_path = os.path.join(root, "unreachable.json")
+        self.meta_path = os.path.join(root, "meta.json")
+        self.summary_path = os.path.join(root, "summary.jsonl")
+        self.ratings_path = os.path.join(root, "ratings.jsonl")
+        self.cache_size = cache_size
+        self._lock = RLock()
+        self._cache = OrderedDict()  # uid → record
+        self._count = None
+        os.makedirs(root, exist_ok=True)
+        self._unreachable = set()
+        if os.path.exists(self.unreachable_path):
+            with open(self.unreachable_path, "r", encoding="utf-8") as f:
+                self._unreachable = set(json.load(f))
+        self._summary_lines = 0
+        self._summary_compacting = False
+        if os.path.exists(self.summary_path):
+            with open(self.summary_path, "rb") as f:
+                self._summary_lines = sum(1 for _ in f)
+        if os.path.exists(self.ids_path) and not (
+            os.path.exists(self.summary_path) and os.path.exists(self.ratings_path)
+        ):
+            self._rebuild_summary()
+
+    def _rebuild_summary(self):
+        """مرة واحدة لمجلد أقدم من summary.jsonl: يمر على ملفات المستخدمين."""
+        since = ts_day(now_ts()) - self.SHARD_RATINGS_LOG_DAYS
+        rows = []
+        ratings = []
+        for r in self.iter_records():
+            rows.append([r.user_id, r.created_at, r.last_active, r.streak_start])
+            ratings.extend([r.user_id, day, value] for day, value in r.ratings.since(since))
+        self._write_summary(rows)
+        _write_lines(self.ratings_path, ratings)
+        logger.info(f"Built {self.summary_path} for {len(rows)} users")
+
+    def _write_summary(self, rows):
+        _write_lines(self.summary_path, rows)
+        self._summary_lines = len(rows)
+
+    def _append_summary(self, uid, record):
+        """لازم تُستدعى و self._lock مقفول."""
+        row = [int(uid), record.created_at, record.last_active, record.streak_start]
+        with open(self.summary_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, separators=(",", ":")) + "\n")
+        self._summary_lines += 1
+        if self._summary_lines > 2 * self.count() + 1000 and not self._summary_compacting:
+            self._summary_compacting = True
+            size = os.path.getsize(self.summary_path)
+            Thread(
+                target=self._compact_summary, args=(size,), name="summary-compaction", daemon=True
+            ).start()
+
+    def _compact_summary(self, size):
+        """يضغط أول size بايت من summary.jsonl بدون القفل، ثم ينقل ما أُضيف بعدها."""
+        tmp_path = None
+        try:
+            rows = {}
+            with open(self.summary_path, "rb") as f:
+                while f.tell() < size:
+                    line = f.readline()
+                    if line.strip():
+                        row = json.loads(line)
+                        rows[row[0]] = row
+            out, tmp_path = _temp_file(self.summary_path)
+            with out:
+                for row in rows.values():
+                    out.write(json.dumps(row, separators=(",", ":")) + "\n")
+            with self._lock:
+                # السطور تُضاف كاملة تحت القفل، فـ size دائمًا على بداية سطر
+                with open(self.summary_path, "rb") as f:
+                    f.seek(size)
+                    tail = f.read()
+                with open(tmp_path, "ab") as out:
+                    out.write(tail)
+                os.replace(tmp_path, self.summary_path)
+                tmp_path = None
+                self._summary_lines = len(rows) + tail.count(b"\n")
+            logger.info(f"Compacted {self.summary_path} to {len(rows)} users")
+        except Exception as e:
+            logger.error(f"Error compacting {self.summary_path}: {e}")
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            with self._lock:
+                self._summary_compacting = False
+
+    def _summary_rows(self):
+        """[user_id, created_at, last_active, streak_start] لكل مستخدم (آخر سطر له)."""
+        rows = {}
+        with self._lock:
+            if os.path.exists(self.summary_path):
+                with open(self.summary_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            row = json.loads(line)
+                            rows[row[0]] = row
+        return list(rows.values())
+
+    def _track_unreachable(self, uid, unreachable_at):
+        was = uid in self._unreachable
+        if unreachable_at is None:
+            self._unreachable.discard(uid)
+        else:
+            self._unreachable.add(uid)
+        if was != (uid in self._unreachable):
+            _write_json_file(self.unreachable_path, sorted(self._unreachable))
+
+    def _path(self, uid):
+        prefix = hashlib.md5(uid.encode()).hexdigest()[:2]
+        return os.path.join(self.root, prefix, uid + ".json")
+
+    def _read(self, uid):
+        path = self._path(uid)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return UserRecord.from_dict(json.load(f), uid)
+        except Exception as e:
+            logger.error(f"Error loading user file {path}: {e}")
+            return None
+
+    def _write(self, uid, record):
+        path = self._path(uid)
+        tmp_path = path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    record.to_dict(), f, ensure_ascii=False, separators=(",", ":")
+                )
+                STORE_BYTES_WRITTEN.inc("shard", amount=f.tell())
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Error saving user file {path}: {e}")
+
+    def _remember(self, uid, record):
+        self._cache[uid] = record
+        self._cache.move_to_end(uid)
+        while len(self._cache) > self.cache_size:
+            # الكتابة فورية على القرص، فالسجل المطرود دائمًا محفوظ
+            self._cache.popitem(last=False)
+
+    def _load(self, uid):
+        record = self._cache.get(uid)
+        if record is not None:
+            self._cache.move_to_end(uid)
+            return record
+        record = self._read(uid)
+        if record is not None:
+            self._remember(uid, record)
+        return record
+
+    def get(self, user_id):
+        with self._lock:
+            return self._load(str(user_id))
+
+    def create(self, user_id, record):
+        uid = str(user_id)
+        with self._lock:
+            is_new = self._read(uid) is None
+            self._write(uid, record)
+            self._remember(uid, record)
+            self._track_unreachable(uid, record.unreachable_at)
+            self._append_summary(uid, record)
+            if is_new:
+                with open(self.ids_path, "a", encoding="utf-8") as f:
+                    f.write(uid + "\n")
+                if self._count is not None:
+                    self._count += 1
+
+    def update(self, user_id, fields):
+        uid = str(user_id)
+        with self._lock:
+            record = self._load(uid)
+            if record is None:
+                return
+            record.update(fields)
+            self._write(uid, record)
+            if "unreachable_at" in fields:
+                self._track_unreachable(uid, record.unreachable_at)
+            if any(key in fields for key in self.SUMMARY_FIELDS):
+                self._append_summary(uid, record)
+
+    def _iter_ids(self):
+        if not os.path.exists(self.ids_path):
+            return
+        with open(self.ids_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+    def user_ids(self):
+        return [int(uid) for uid in self._iter_ids()]
+
+    def count(self):
+        with self._lock:
+            if self._count is None:
+                self._count = sum(1 for _ in self._iter_ids())
+            return self._count
+
+    def segment_fields(self):
+        with self._lock:
+            unreachable = {int(uid) for uid in self._unreachable}
+        # الفهارس تحتاج "هل هو unreachable" فقط، والوقت الفعلي في ملف المستخدم
+        marked = now_ts()
+        return [
+            (uid, created, active, start, marked if uid in unreachable else None)
+            for uid, created, active, start in self._summary_rows()
+        ]
+
+    def recent_ratings(self, since_day):
+        """من ratings.jsonl؛ since_day لازم يكون داخل آخر SHARD_RATINGS_LOG_DAYS يوم."""
+        latest = {}
+        with self._lock:
+            if os.path.exists(self.ratings_path):
+                with open(self.ratings_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            uid, day, value = json.loads(line)
+                            latest[uid, day] = value
+            keep = ts_day(now_ts()) - self.SHARD_RATINGS_LOG_DAYS
+            kept = [[uid, day, value] for (uid, day), value in latest.items() if day >= keep]
+            if len(kept) < len(latest):
+                _write_lines(self.ratings_path, kept)
+        return [(uid, day, value) for uid, day, value in kept if day >= since_day]
+
+    def reachable_user_ids(self):
+        with self._lock:
+            unreachable = set(self._unreachable)
+        return [int(uid) for uid in self._iter_ids() if uid not in unreachable]
+
+    def count_reachable(self):
+        with self._lock:
+            return self.count() - len(self._unreachable)
+
+    def iter_records(self):
+        for uid in self._iter_ids():
+            with self._lock:
+                record = self._cache.get(uid) or self._read(uid)
+            if record is not None:
+                yield record
+
+    def get_notes(self, user_id):
+        record = self.get(user_id)
+        return list(record.notes) if record else []
+
+    def _modify(self, user_id, fn):
+        uid = str(user_id)
+        with self._lock:
+            record = self._load(uid)
+            if record is None:
+                return None
+            result = fn(record)
+            self._write(uid, record)
+            return result
+
+    def add_note(self, user_id, text):
+        self._modify(user_id, lambda r: r.notes.append(text))
+
+    def edit_note(self, user_id, idx, text):
+        def edit(record):
+            notes = record.notes
+            if idx < 0 or idx >= len(notes):
+                return False
+            notes[idx] = text
+            return True
+
+        return bool(self._modify(user_id, edit))
+
+    def delete_note(self, user_id, idx):
+        def delete(record):
+            notes = record.notes
+            if idx < 0 or idx >= len(notes):
+                return None
+            return notes.pop(idx)
+
+        return self._modify(user_id, delete)
+
+    def set_rating(self, user_id, day, value):
+        with self._lock:
+            old = self._modify(user_id, lambda r: r.ratings.set(day, value))
+            with open(self.ratings_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps([int(user_id), day, value]) + "\n")
+        return old
+
+
+def import_json(json_path=DATA_FILE, target=None):
+    """ينقل user_data.json (مع السجل الإضافي) إلى خلفية تخزين أخرى مرة واحدة."""
+    source = JsonStore(json_path)
+    imported = 0
+    try:
+        for record in source.iter_records():
+            target.create(record.user_id, record)
+            imported += 1
+    finally:
+        source.close()
+    logger.info(
+        f"Imported {imported} users from {json_path} into {type(target).__name__}"
+    )
+    return imported
+
+
+def create_store(base_dir=""):
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStore(os.path.join(base_dir, SQLITE_FILE))
+    if STORAGE_BACKEND == "sharded":
+        return ShardedStore(os.path.join(base_dir, SHARD_DIR))
+    if STORAGE_BACKEND != "json":
+        logger.warning(f"Unknown STORAGE_BACKEND={STORAGE_BACKEND!r}, using json")
+    return JsonStore(os.path.join(base_dir, DATA_FILE))
+
+
+store = create_store()
+
+# =================== إحصائيات تراكمية ===================
+#
+# بدل المرور على كل السجلات مع كل طلب إحصائيات، ANALYTICS يحفظ عدّادات
+# لكل يوم (epoch day) وتتحدث مع كل كتابة:
+#   active_days[d]  → عدد المستخدمين الذين آخر نشاط لهم في اليوم d
+#   created_days[d] → المستخدمين الجدد في اليوم d
+#   streak_days[d]  → عدد المستخدمين الذين بدأ عدادهم الحالي في اليوم d
+#   rating_sum[d] / rating_count[d] → مجموع وعدد تقييمات اليوم d
+# نقل مستخدم من يوم لآخر = إنقاص خانة وزيادة أخرى، فالتحديث O(1) والقراءة
+# تمر على أيام فقط (وليس مستخدمين). تُحفظ عبر store.set_meta، وفحص دوري
+# يعيد حسابها كاملة من التخزين ويسجّل أي فرق. المرور يأخذ وقتًا والبوت شغّال،
+# فتغييرات كل مستخدم أثناءه تُسجَّل (_since_scan): ما قبل وصول المرور إليه
+# موجود في السجل المقروء فيُحذف، وما بعده يُضاف فوق النتيجة الجديدة.
+
+ANALYTICS_META_KEY = "analytics"
+ANALYTICS_CHECK_INTERVAL = int(os.getenv("ANALYTICS_CHECK_INTERVAL", str(6 * 3600)))
+
+# حدود توزيع مدة الثبات بالأيام: [0,1) [1,7) [7,30) [30,90) [90,∞)
+STREAK_BUCKETS = (1, 7, 30, 90)
+
+
+class Analytics:
+    FIELDS = ("active_days", "created_days", "streak_days", "rating_sum", "rating_count")
+
+    def __init__(self):
+        self._lock = Lock()
+        self.active_days = {}
+        self.created_days = {}
+        self.streak_days = {}
+        self.rating_sum = {}
+        self.rating_count = {}
+        self.loaded = False
+        self.dirty = False
+        self.last_check = None  # (وقت الفحص، مقدار الفرق)
+        self._since_scan = None  # user_id → [(field, day, amount)] أثناء إعادة الحساب
+
+    @staticmethod
+    def _add(counts, day, amount):
+        if day is None:
+            return
+        value = counts.get(day, 0) + amount
+        if value:
+            counts[day] = value
+        else:
+            del counts[day]
+
+    def _bump(self, user_id, name, day, amount):
+        """لازم تُستدعى و self._lock مقفول."""
+        if day is None:
+            return
+        self._add(getattr(self, name), day, amount)
+        if self._since_scan is not None:
+            self._since_scan.setdefault(user_id, []).append((name, day, amount))
+
+    def _move(self, user_id, name, old_ts, new_ts):
+        old_day, new_day = ts_day(old_ts), ts_day(new_ts)
+        if old_day == new_day:
+            return
+        with self._lock:
+            self._bump(user_id, name, old_day, -1)
+            self._bump(user_id, name, new_day, 1)
+            self.dirty = True
+
+    # ---------- التحديث مع كل كتابة ----------
+
+    def on_create(self, record):
+        uid = record.user_id
+        with self._lock:
+            self._bump(uid, "created_days", ts_day(record.created_at), 1)
+            self._bump(uid, "active_days", ts_day(record.last_active), 1)
+            self._bump(uid, "streak_days", ts_day(record.streak_start), 1)
+            for day, value in record.ratings:
+                self._bump(uid, "rating_sum", day, value)
+                self._bump(uid, "rating_count", day, 1)
+            self.dirty = True
+
+    def on_active(self, user_id, old_ts, new_ts):
+        self._move(user_id, "active_days", old_ts, new_ts)
+
+    def on_streak(self, user_id, old_ts, new_ts):
+        self._move(user_id, "streak_days", old_ts, new_ts)
+
+    def on_rating(self, user_id, day, value, old=None):
+        with self._lock:
+            if old is not None:
+                self._bump(user_id, "rating_sum", day, -old)
+                self._bump(user_id, "rating_count", day, -1)
+            self._bump(user_id, "rating_sum", day, value)
+            self._bump(user_id, "rating_count", day, 1)
+            self.dirty = True
+
+    # ---------- القراءة ----------
+
+    def report(self, now=None):
+        today = ts_day(now or now_ts())
+        with self._lock:
+            week = range(today - 6, today + 1)
+            streaks = [0] * (len(STREAK_BUCKETS) + 1)
+            for day, count in self.streak_days.items():
+                streaks[bisect_right(STREAK_BUCKETS, today - day)] += count
+            return {
+                "dau": self.active_days.get(today, 0),
+                "wau": sum(self.active_days.get(d, 0) for d in week),
+                "new_today": self.created_days.get(today, 0),
+                "new_week": sum(self.created_days.get(d, 0) for d in week),
+                "streaks": streaks,
+                # (اليوم، المجموع، العدد) حتى يمكن جمعها بين العمال
+                "ratings": [
+                    (d, self.rating_sum[d], self.rating_count[d])
+                    for d in week
+                    if self.rating_count.get(d)
+                ],
+            }
+
+    # ---------- الحفظ وإعادة الحساب ----------
+
+    def snapshot(self):
+        with self._lock:
+            self.dirty = False
+            return {
+                name: {str(day): n for day, n in getattr(self, name).items()}
+                for name in self.FIELDS
+            }
+
+    def restore(self, saved):
+        if not saved:
+            return
+        with self._lock:
+            for name in self.FIELDS:
+                setattr(self, name, {int(day): n for day, n in saved.get(name, {}).items()})
+            self.loaded = True
+
+    @classmethod
+    def from_records(cls, records):
+        fresh = cls()
+        for record in records:
+            fresh.on_create(record)
+        fresh.loaded = True
+        return fresh
+
+    def begin_scan(self):
+        """من هنا حتى replace_with تُسجَّل تغييرات كل مستخدم (انظر scanned)."""
+        with self._lock:
+            self._since_scan = {}
+
+    def changed_during_scan(self, user_id):
+        with self._lock:
+            return self._since_scan is not None and user_id in self._since_scan
+
+    def scanned(self, user_id):
+        """المرور قرأ سجل user_id الآن: ما سُجّل له قبل ذلك موجود في السجل."""
+        with self._lock:
+            if self._since_scan is not None:
+                self._since_scan.pop(user_id, None)
+
+    def replace_with(self, fresh):
+        """يستبدل العدّادات بنسخة محسوبة كاملة + ما تغيّر بعد قراءة كل سجل، ويرجع مجموع الفروق."""
+        drift = {}
+        with self._lock:
+            counts = {name: dict(getattr(fresh, name)) for name in self.FIELDS}
+            for changes in (self._since_scan or {}).values():
+                for name, day, amount in changes:
+                    self._add(counts[name], day, amount)
+            self._since_scan = None
+            for name in self.FIELDS:
+                old, new = getattr(self, name), counts[name]
+                diff = sum(abs(old.get(d, 0) - new.get(d, 0)) for d in old.keys() | new.keys())
+                if diff:
+                    drift[name] = diff
+                setattr(self, name, new)
+            was_loaded = self.loaded
+            self.loaded = True
+            self.dirty = True
+            self.last_check = (now_ts(), sum(drift.values()) if was_loaded else 0)
+        return drift if was_loaded else {}
+
+
+ANALYTICS = Analytics()
+ANALYTICS.restore(store.get_meta(ANALYTICS_META_KEY))
+
+
+def save_analytics():
+    if ANALYTICS.dirty:
+        store.set_meta(ANALYTICS_META_KEY, ANALYTICS.snapshot())
+
+
+def _scan_records():
+    """كل السجلات كما يراها البوت الآن (مع المعلّق)، مع إبلاغ ANALYTICS بكل سجل."""
+    for record in store.iter_records():
+        uid = record.user_id
+        if ANALYTICS.changed_during_scan(uid):
+            # قد يكون مقروءًا قبل التغيير (SQLite يقرأ دفعات)، فنعيد قراءته
+            current = store.get(uid)
+            if current is not None:
+                current.ratings = store.get_ratings(uid)
+                record = current
+        _apply_pending(uid, record)
+        ANALYTICS.scanned(uid)
+        yield record
+
+
+def _check_analytics():
+    ANALYTICS.begin_scan()
+    flush_pending()
+    started = monotonic()
+    fresh = Analytics.from_records(_scan_records())
+    drift = ANALYTICS.replace_with(fresh)
+    save_analytics()
+    if drift:
+        logger.warning(f"Analytics drift corrected: {drift}")
+    logger.info(f"Analytics recomputed in {monotonic() - started:.1f}s")
+
+
+def check_analytics(context: CallbackContext):
+    # إعادة الحساب تمر على كل السجلات، فلا نحجز ثريد job_queue
+    Thread(target=_check_analytics, name="analytics-check", daemon=True).start()
+
+# =================== ترتيب مدة الثبات ===================
+#
+# كل بدايات العدادات الحالية في array مرتبة تصاعديًا (الأقدم = الأطول ثباتًا)،
+# فترتيب أي مستخدم ونسبته = bisect واحد O(log n) بدل ترتيب الكل مع كل ضغطة.
+# تُبنى مرة عند التشغيل من STARTUP_ROWS، ثم تتحدث مع كل تغيير لـ streak_start
+# في update_user_record (بدء الرحلة، إعادة الضبط، تعيين بداية مخصصة).
+# تغييرات نفس المستخدم متسلسلة عبر UPDATE_EXECUTOR، فالقيمة القديمة المحذوفة
+# هي دائمًا الموجودة فعلًا في الفهرس.
+
+# لا نعرض النسبة قبل أن يكون هناك عدد معقول من المستخدمين
+STREAK_RANK_MIN_USERS = int(os.getenv("STREAK_RANK_MIN_USERS", "10"))
+STREAK_TOP_COUNT = 10
+
+
+class StreakIndex:
+    def __init__(self, starts=()):
+        self._lock = Lock()
+        self._starts = array("q", sorted(starts))  # 8 بايت لكل مستخدم
+
+    def __len__(self):
+        return len(self._starts)
+
+    def move(self, old_ts, new_ts):
+        """يستبدل بداية قديمة (أو None) بأخرى جديدة (أو None)."""
+        if old_ts == new_ts:
+            return
+        with self._lock:
+            starts = self._starts
+            if old_ts is not None:
+                i = bisect_left(starts, old_ts)
+                if i < len(starts) and starts[i] == old_ts:
+                    del starts[i]
+            if new_ts is not None:
+                starts.insert(bisect_right(starts, new_ts), new_ts)
+
+    def rank(self, start_ts):
+        """يرجع (الترتيب، العدد الكلي، نسبة من ثباتهم أقصر منه %)."""
+        with self._lock:
+            starts = self._starts
+            total = len(starts)
+            longer = bisect_left(starts, start_ts)
+            shorter = total - bisect_right(starts, start_ts)
+        others = total - 1
+        percent = shorter * 100 // others if others > 0 else 0
+        return longer + 1, total, percent
+
+    def top(self, count):
+        """أقدم count بدايات (بدون أي بيانات تعريفية للمستخدمين)."""
+        with self._lock:
+            return list(self._starts[:count])
+
+
+def build_streak_index(rows):
+    started = monotonic()
+    index = StreakIndex(row[3] for row in rows if row[3] is not None)
+    logger.info(f"Streak index built: {len(index)} users in {monotonic() - started:.2f}s")
+    return index
+
+
+# store.segment_fields() مرة واحدة لكل الفهارس المبنية عند التشغيل (ترتيب الثبات،
+# الشرائح، مراحل الثبات، غير النشطين) بدل مرور مستقل على التخزين لكل فهرس
+STARTUP_ROWS = store.segment_fields()
+STREAK_INDEX = build_streak_index(STARTUP_ROWS)
+
+# =================== شرائح الجمهور ===================
+#
+# الرسالة الجماعية ممكن تُرسل لشريحة بدل الكل، بشروط تُجمع بـ "و":
+#   active<=N        نشط خلال آخر N يوم
+#   streak>=N        ثبات N يوم أو أكثر
+#   nostreak         لم يبدأ رحلته
+#   rating<=X        متوسط تقييمه آخر 7 أيام X أو أقل (من قيّم فقط)
+#   joined>=DATE     انضم في DATE (YYYY-MM-DD) أو بعده
+# SegmentIndex يعطي كل مستخدم slot ثابت، ويخزن لكل حقل عمودًا بايتات بالـ slot:
+# الأيام (UTC) كرقم 16 بت في مستويين (DayColumn)، ومتوسط التقييم كرمز لزوج
+# (المجموع، العدد) لآخر 7 أيام، وعمود للوصول (حظر البوت أو لا).
+# أي شرط على كل المستخدمين = bytes.translate بجدول 256 خانة (حلقة C) يعطي
+# بايت 0/1 لكل slot، ثم int.from_bytes؛ الجمع بين الشروط AND على أعداد
+# صحيحة كبيرة والعدد = bit_count()، فلا توجد حلقة Python على المستخدمين.
+# أصحاب الشريحة = itertools.compress على عمود user_id بنفس القناع.
+# last_active يتغير في العمود مرة باليوم لكل مستخدم (أول رسالة في يوم جديد).
+
+SEGMENT_USAGE = (
+    "اكتب شروط الشريحة مفصولة بمسافات (كلها لازم تتحقق):\n"
+    "• active<=7 — نشط خلال آخر 7 أيام\n"
+    "• streak>=30 — ثبات 30 يوم أو أكثر\n"
+    "• nostreak — لم يبدأ رحلته\n"
+    "• rating<=2 — متوسط تقييمه هذا الأسبوع 2 أو أقل\n"
+    "• joined>=2025-01-01 — انضم في هذا التاريخ أو بعده\n\n"
+    "أو اضغط «الكل 👥» للإرسال لجميع المستخدمين."
+)
+RATING_WINDOW_DAYS = 7
+# رمز 0 = لا تقييم في النافذة، وإلا RATING_PAIRS[رمز - 1] = (المجموع، العدد)
+RATING_PAIRS = [
+    (total, count)
+    for count in range(1, RATING_WINDOW_DAYS + 1)
+    for total in range(count, 5 * count + 1)
+]
+RATING_CODES = {pair: code for code, pair in enumerate(RATING_PAIRS, 1)}
+PARSE_SEGMENT_RE = re.compile(r"(active<=|streak>=|rating<=|joined>=)(\S+)|(nostreak)")
+
+
+def parse_segment(text):
+    """يحوّل نص الشروط لـ dict فلاتر (قابل للحفظ في JSON)؛ ValueError لو فيه خطأ."""
+    segment = {}
+    for token in text.split():
+        match = PARSE_SEGMENT_RE.fullmatch(token)
+        if not match:
+            raise ValueError(token)
+        key, value = match.group(1), match.group(2)
+        if match.group(3):
+            segment["nostreak"] = True
+        elif key == "active<=":
+            segment["active"] = int(value)
+        elif key == "streak>=":
+            segment["streak"] = int(value)
+        elif key == "rating<=":
+            segment["rating"] = float(value)
+        else:
+            joined = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            segment["joined"] = ts_day(int(joined.timestamp()))
+    if any(segment.get(k, 0) < 0 for k in ("active", "streak", "rating")):
+        raise ValueError(text)
+    return segment
+
+
+def describe_segment(segment):
+    if not segment:
+        return "جميع المستخدمين"
+    parts = []
+    if "active" in segment:
+        parts.append(f"نشط خلال آخر {segment['active']} يوم")
+    if "streak" in segment:
+        parts.append(f"ثبات {segment['streak']} يوم أو أكثر")
+    if segment.get("nostreak"):
+        parts.append("لم يبدأ رحلته")
+    if "rating" in segment:
+        parts.append(f"متوسط تقييم الأسبوع ≤ {segment['rating']:g}")
+    if "joined" in segment:
+        joined = datetime.fromtimestamp(segment["joined"] * 86400, timezone.utc)
+        parts.append(f"انضم منذ {joined.date().isoformat()}")
+    return "، ".join(parts)
+
+
+def _code_for_day(day):
+    """رمز DayColumn ليوم epoch (0 محجوز لـ "بدون قيمة")."""
+    return min(max(day + 1, 0), 0xFFFF)
+
+
+def _day_code(ts):
+    """رمز اليوم في DayColumn: 0 = بدون قيمة، وإلا يوم epoch + 1."""
+    return 0 if ts is None else _code_for_day(ts_day(ts))
+
+
+def _flags(test):
+    """جدول bytes.translate: 1 لكل بايت يحقق test وإلا 0."""
+    return bytes(1 if test(i) else 0 for i in range(256))
+
+
+def _as_mask(flags):
+    return int.from_bytes(flags, "little")
+
+
+class DayColumn:
+    """رمز يوم 16 بت لكل slot في مستويين: البايت العالي hi والمنخفض lo."""
+
+    def __init__(self, timestamps=()):
+        codes = array("H", map(_day_code, timestamps))
+        self.hi = bytearray(code >> 8 for code in codes)
+        self.lo = bytearray(code & 0xFF for code in codes)
 
+    def append(self, ts):
+        code = _day_code(ts)
+        self.hi.append(code >> 8)
+        self.lo.append(code & 0xFF)
 
-def save_data(data):
+    def set(self, slot, ts):
+        code = _day_code(ts)
+        self.hi[slot] = code >> 8
+        self.lo[slot] = code & 0xFF
+
+    def snapshot(self):
+        return bytes(self.hi), bytes(self.lo)
+
+    @staticmethod
+    def mask(planes, first, last):
+        """قناع من رمز يومه بين first وlast (شاملة) في snapshot()."""
+        if last < first:
+            return 0
+        hi, lo = planes
+        fh, fl = divmod(first, 256)
+        lh, ll = divmod(last, 256)
+        at_least = _as_mask(hi.translate(_flags(lambda h: h > fh))) | (
+            _as_mask(hi.translate(_flags(lambda h: h == fh)))
+            & _as_mask(lo.translate(_flags(lambda b: b >= fl)))
+        )
+        at_most = _as_mask(hi.translate(_flags(lambda h: h < lh))) | (
+            _as_mask(hi.translate(_flags(lambda h: h == lh)))
+            & _as_mask(lo.translate(_flags(lambda b: b <= ll)))
+        )
+        return at_least & at_most
+
+
+class SegmentIndex:
+    def __init__(self):
+        self._lock = Lock()
+        self._uids = array("q")  # user_id لكل slot
+        self._sorted = array("q")  # user_id مرتبة، للوصول لـ slot بـ bisect
+        self._sorted_slots = array("q")
+        self.created = DayColumn()
+        self.active = DayColumn()
+        self.streak = DayColumn()
+        self._rating = bytearray()  # رمز RATING_CODES لكل slot
+        self._reachable = bytearray()  # 1 = لم يحظر البوت
+        self._by_day = {}  # day → {user_id: value} للأيام داخل نافذة التقييم
+
+    def __len__(self):
+        return len(self._uids)
+
+    def load(self, rows, ratings, today):
+        """rows من store.segment_fields()، ratings من store.recent_ratings()."""
+        rows = sorted(rows)
+        with self._lock:
+            self._uids = array("q", (row[0] for row in rows))
+            self._sorted = array("q", self._uids)
+            self._sorted_slots = array("q", range(len(rows)))
+            self.created = DayColumn(row[1] for row in rows)
+            self.active = DayColumn(row[2] for row in rows)
+            self.streak = DayColumn(row[3] for row in rows)
+            self._rating = bytearray(len(rows))
+            self._reachable = bytearray(row[4] is None for row in rows)
+            self._by_day = {}
+        for user_id, day, value in ratings:
+            self.on_rating(user_id, day, value, today)
+
+    def _slot(self, user_id):
+        """لازم تُستدعى و self._lock مقفول."""
+        i = bisect_left(self._sorted, user_id)
+        if i < len(self._sorted) and self._sorted[i] == user_id:
+            return self._sorted_slots[i]
+        return None
+
+    def add(self, user_id, now):
+        with self._lock:
+            if self._slot(user_id) is not None:
+                return
+            slot = len(self._uids)
+            self._uids.append(user_id)
+            i = bisect_left(self._sorted, user_id)
+            self._sorted.insert(i, user_id)
+            self._sorted_slots.insert(i, slot)
+            self.created.append(now)
+            self.active.append(now)
+            self.streak.append(None)
+            self._rating.append(0)
+            self._reachable.append(1)
+
+    def _set_day(self, column, user_id, ts):
+        with self._lock:
+            slot = self._slot(user_id)
+            if slot is not None:
+                column.set(slot, ts)
+
+    def touch(self, user_id, now):
+        self._set_day(self.active, user_id, now)
+
+    def move_streak(self, user_id, start):
+        self._set_day(self.streak, user_id, start)
+
+    def set_reachable(self, user_id, reachable):
+        with self._lock:
+            slot = self._slot(user_id)
+            if slot is not None:
+                self._reachable[slot] = int(reachable)
+
+    def _rate(self, slot, delta_total, delta_count):
+        code = self._rating[slot]
+        total, count = RATING_PAIRS[code - 1] if code else (0, 0)
+        total += delta_total
+        count += delta_count
+        self._rating[slot] = RATING_CODES[(total, count)] if count else 0
+
+    def _advance(self, today):
+        """يسقط تقييمات الأيام التي خرجت من النافذة (لازم self._lock مقفول)."""
+        first = today - RATING_WINDOW_DAYS + 1
+        for day in [d for d in self._by_day if d < first]:
+            for user_id, value in self._by_day.pop(day).items():
+                slot = self._slot(user_id)
+                if slot is not None:
+                    self._rate(slot, -value, -1)
+
+    def on_rating(self, user_id, day, value, today):
+        with self._lock:
+            self._advance(today)
+            slot = self._slot(user_id)
+            if slot is None or day < today - RATING_WINDOW_DAYS + 1:
+                return
+            ratings = self._by_day.setdefault(day, {})
+            old = ratings.get(user_id)
+            ratings[user_id] = value
+            if old is None:
+                self._rate(slot, value, 1)
+            else:
+                self._rate(slot, value - old, 0)
+
+    def query(self, segment, today, count_only=False):
+        """عدد أصحاب الشريحة الذين لم يحظروا البوت، أو قائمة user_id لهم."""
+        with self._lock:
+            self._advance(today)
+            size = len(self._uids)
+            mask = _as_mask(self._reachable)
+            active = self.active.snapshot() if "active" in segment else None
+            streak = self.streak.snapshot() if "streak" in segment or "nostreak" in segment else None
+            created = self.created.snapshot() if "joined" in segment else None
+            rating = bytes(self._rating) if "rating" in segment else None
+            uids = None if count_only else array("q", self._uids)
+
+        # الأرخص أولًا (مستوى واحد ثم مستويين)، ونتوقف لو صار القناع فارغًا
+        conditions = []
+        if rating is not None:
+            max_avg = segment["rating"]
+            table = _flags(
+                lambda code: 0 < code <= len(RATING_PAIRS)
+                and RATING_PAIRS[code - 1][0] <= max_avg * RATING_PAIRS[code - 1][1]
+            )
+            conditions.append(lambda: _as_mask(rating.translate(table)))
+        if segment.get("nostreak"):
+            conditions.append(lambda: DayColumn.mask(streak, 0, 0))
+        # كل الحدود أيام epoch تتحول لرموز عبر _code_for_day، وبنفس تعريف ANALYTICS:
+        # active<=N = آخر N أيام شاملة اليوم (active<=7 = wau)، streak>=N = today - يوم البداية >= N
+        if "streak" in segment:
+            last = _code_for_day(today - segment["streak"])
+            conditions.append(lambda: DayColumn.mask(streak, 1, last))
+        if "active" in segment:
+            first = _code_for_day(today - segment["active"] + 1)
+            conditions.append(lambda: DayColumn.mask(active, first, 0xFFFF))
+        if "joined" in segment:
+            first = _code_for_day(segment["joined"])
+            conditions.append(lambda: DayColumn.mask(created, first, 0xFFFF))
+        for condition in conditions:
+            if not mask:
+                break
+            mask &= condition()
+
+        if count_only:
+            return mask.bit_count()
+        return list(compress(uids, mask.to_bytes(size, "little")))
+
+
+def build_segment_index(rows):
+    started = monotonic()
+    segments = SegmentIndex()
+    today = ts_day(now_ts())
+    segments.load(rows, store.recent_ratings(today - RATING_WINDOW_DAYS + 1), today)
+    logger.info(f"Segment index built: {len(segments)} users in {monotonic() - started:.2f}s")
+    return segments
+
+
+SEGMENTS = build_segment_index(STARTUP_ROWS)
+
+
+def _local_segment(segment, count_only):
+    return SEGMENTS.query(segment, ts_day(now_ts()), count_only)
+
+
+def count_segment(segment):
+    """عدد مستلمي الشريحة (من كل العمال)، أو كل من يمكن الوصول له لو segment فارغ."""
+    if not segment:
+        return sum(call_workers("count_reachable"))
+    return sum(call_workers("segment", segment, True))
+
+
+def get_segment_user_ids(segment):
+    """مستلمو الرسالة الجماعية: الشريحة، أو كل من يمكن الوصول له لو segment فارغ."""
+    if not segment:
+        return get_reachable_user_ids()
+    return [uid for ids in call_workers("segment", segment, False) for uid in ids]
+
+# =================== تجميع الكتابات (write coalescing) ===================
+#
+# التعديلات البسيطة (آخر نشاط، الاسم، اليوزر...) لا تُكتب فورًا،
+# بل تُعلَّم كـ "dirty" في _pending وتُكتب كدفعة واحدة كل FLUSH_INTERVAL ثانية
+# أو لما يوصل عدد المستخدمين المعلّقين إلى FLUSH_MAX_DIRTY.
+# التعديلات المهمة (بداية العداد مثلاً) تطلب flush=True فتُكتب فورًا.
+
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "5"))
+FLUSH_MAX_DIRTY = int(os.getenv("FLUSH_MAX_DIRTY", "500"))
+
+_pending = {}  # uid → الحقول التي لم تُكتب بعد
+_pending_lock = Lock()
+_flush_event = Event()
+_flusher_thread = None
+
+
+def _mark_dirty(user_id, fields):
+    uid = str(user_id)
+    with _pending_lock:
+        _pending.setdefault(uid, {}).update(fields)
+        too_many = len(_pending) >= FLUSH_MAX_DIRTY
+    if too_many:
+        if _flusher_thread is not None:
+            _flush_event.set()
+        else:
+            flush_pending()
+
+
+def _apply_pending(user_id, record):
+    """يركّب التعديلات المعلّقة فوق السجل المقروء من التخزين."""
+    with _pending_lock:
+        fields = _pending.get(str(user_id))
+        if fields:
+            record.update(fields)
+    return record
+
+
+def flush_user(user_id):
+    """يكتب التعديلات المعلّقة لمستخدم واحد فورًا."""
+    with _pending_lock:
+        fields = _pending.pop(str(user_id), None)
+    if fields:
+        started = monotonic()
+        try:
+            store.update(user_id, fields)
+        except Exception as e:
+            logger.error(f"Error flushing user {user_id}: {e}")
+        STORE_WRITE_SECONDS.observe(monotonic() - started, "flush_user")
+
+
+def flush_pending():
+    """يكتب كل التعديلات المعلّقة كدفعة واحدة."""
+    global _pending
+    with _pending_lock:
+        if not _pending:
+            return 0
+        batch, _pending = _pending, {}
+    started = monotonic()
     try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        store.update_many(list(batch.items()))
     except Exception as e:
-        logger.error(f"Error saving data: {e}")
+        logger.error(f"Error flushing {len(batch)} pending records: {e}")
+    STORE_WRITE_SECONDS.observe(monotonic() - started, "flush_batch")
+    return len(batch)
 
 
-data = load_data()
+def _flusher_loop():
+    while True:
+        _flush_event.wait(FLUSH_INTERVAL)
+        _flush_event.clear()
+        # خطأ واحد (قاعدة مقفولة، قرص ممتلئ...) لا يوقف الحفظ للأبد
+        try:
+            flush_pending()
+            save_meta()
+            save_support_threads()
+        except Exception:
+            logger.exception("Error in flusher loop")
+
+
+def start_flusher():
+    global _flusher_thread
+    if _flusher_thread is None:
+        _flusher_thread = Thread(target=_flusher_loop, name="flusher", daemon=True)
+        _flusher_thread.start()
 
 
 def get_user_record(user):
     """يرجع سجل المستخدم، ويحدّث الاسم / اليوزر / آخر نشاط."""
-    user_id = str(user.id)
-    now_iso = datetime.now(timezone.utc).isoformat()
-
-    if user_id not in data:
-        data[user_id] = {
-            "user_id": user.id,
-            "first_name": user.first_name,
-            "username": user.username,
-            "created_at": now_iso,
-            "last_active": now_iso,
-            "streak_start": None,
-            "notes": [],
-            "ratings": [],
-        }
-    else:
-        record = data[user_id]
-        record["first_name"] = user.first_name
-        record["username"] = user.username
-        record["last_active"] = now_iso
+    now = now_ts()
+    record = store.get(user.id)
+
+    if record is None:
+        record = UserRecord(
+            user_id=user.id,
+            first_name=user.first_name,
+            username=user.username,
+            created_at=now,
+            last_active=now,
+        )
+        store.create(user.id, record)
+        ANALYTICS.on_create(record)
+        RE_ENGAGE.touch(user.id, now)
+        SEGMENTS.add(user.id, now)
+        return record
+
+    _apply_pending(user.id, record)
+    ANALYTICS.on_active(user.id, record.last_active, now)
+    RE_ENGAGE.touch(user.id, now)
+    SEGMENTS.touch(user.id, now)
+    changes = {"last_active": now}
+    if record.first_name != user.first_name:
+        changes["first_name"] = user.first_name
+    if record.username != user.username:
+        changes["username"] = user.username
+    if record.unreachable_at is not None:
+        # رجع يراسلنا → نرجّعه لقائمة الإرسال الجماعي
+        changes["unreachable_at"] = None
+        SEGMENTS.set_reachable(user.id, True)
+        record.update(changes)
+        update_user_record(user.id, flush=True, **changes)
+        return record
+    record.update(changes)
+    _mark_dirty(user.id, changes)
+    return record
+
+
+def update_user_record(user_id: int, flush: bool = False, **kwargs):
+    """flush=True للتعديلات المهمة التي لا نريد خسارتها لو توقف البوت فجأة.
+
+    كل الهاندلرات تمر على get_user_record أولاً، فـ last_active هنا في نفس
+    اليوم؛ فقط تغيير بداية العداد يحتاج القيمة القديمة للإحصائيات.
+    """
+    if "streak_start" in kwargs:
+        record = store.get(user_id)
+        if record is not None:
+            _apply_pending(user_id, record)
+            ANALYTICS.on_streak(user_id, record.streak_start, kwargs["streak_start"])
+            STREAK_INDEX.move(record.streak_start, kwargs["streak_start"])
+            MILESTONES.push(user_id, kwargs["streak_start"])
+            SEGMENTS.move_streak(user_id, kwargs["streak_start"])
+    kwargs["last_active"] = now_ts()
+    _mark_dirty(user_id, kwargs)
+    if flush:
+        flush_user(user_id)
+
+
+def get_reachable_user_ids():
+    """كل المستخدمين ما عدا من حظر البوت أو حذف حسابه."""
+    return [uid for ids in call_workers("reachable_user_ids") for uid in ids]
+
+
+def mark_unreachable(user_id: int):
+    if not owns_user(user_id):
+        # مستخدم في شارد عامل آخر (رسالة جماعية من عامل الأدمن)
+        cast_to_owner(user_id, "mark_unreachable", user_id)
+        return
+    # بدون update_user_record حتى لا يتغيّر last_active
+    _mark_dirty(user_id, {"unreachable_at": now_ts()})
+    SEGMENTS.set_reachable(user_id, False)
+
+
+def get_notes(user_id: int):
+    return store.get_notes(user_id)
+
+
+# الملاحظات والتقييمات تُكتب فورًا مع أي تعديل معلّق لنفس المستخدم
 
-    save_data(data)
-    return data[user_id]
 
+def add_note(user_id: int, text: str):
+    store.add_note(user_id, text)
+    flush_user(user_id)
 
-def update_user_record(user_id: int, **kwargs):
-    uid = str(user_id)
-    if uid not in data:
+
+def edit_note(user_id: int, idx: int, text: str) -> bool:
+    ok = store.edit_note(user_id, idx, text)
+    flush_user(user_id)
+    return ok
+
+
+def delete_note(user_id: int, idx: int):
+    deleted = store.delete_note(user_id, idx)
+    flush_user(user_id)
+    return deleted
+
+
+def set_daily_rating(user_id: int, value: int):
+    """يسجّل تقييم اليوم (أو يستبدله) ويرجع (القيمة السابقة، Ratings المستخدم)."""
+    day = ts_day(now_ts())
+    old = store.set_rating(user_id, day, value)
+    ANALYTICS.on_rating(user_id, day, value, old)
+    SEGMENTS.on_rating(user_id, day, value, day)
+    flush_user(user_id)
+    return old, store.get_ratings(user_id)
+
+
+# =================== حالة المحادثة ===================
+#
+# حالة واحدة لكل مستخدم في CONVERSATIONS بدل set لكل حالة.
+# الحالة المتروكة أكثر من STATE_TTL ثانية تنتهي تلقائيًا، فالذاكرة محدودة
+# بعدد المستخدمين النشطين فعلاً. الخريطة تُحفظ (لو تغيّرت فقط) مع كل flush
+# في كتابة meta واحدة مع ANALYTICS (save_meta)، فتبقى بعد إعادة التشغيل.
+
+STATE_TTL = int(os.getenv("STATE_TTL", "1800"))
+STATES_META_KEY = "conversation_states"
+
+
+class ConversationStates:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._states = {}  # user_id → [state, data, updated_at]
+        self._lock = Lock()
+        self.dirty = False
+
+    def get(self, user_id):
+        """يرجع (state, data) أو (None, None) لو لا توجد حالة أو انتهت."""
+        with self._lock:
+            entry = self._states.get(user_id)
+            if entry is None:
+                return None, None
+            if now_ts() - entry[2] > self.ttl:
+                del self._states[user_id]
+                self.dirty = True
+                return None, None
+            return entry[0], entry[1]
+
+    def set(self, user_id, state, data=None):
+        with self._lock:
+            self._states[user_id] = [state, data, now_ts()]
+            self.dirty = True
+
+    def clear(self, user_id):
+        with self._lock:
+            if self._states.pop(user_id, None) is not None:
+                self.dirty = True
+
+    def expire(self):
+        cutoff = now_ts() - self.ttl
+        with self._lock:
+            expired = [uid for uid, entry in self._states.items() if entry[2] < cutoff]
+            for uid in expired:
+                del self._states[uid]
+            if expired:
+                self.dirty = True
+        return len(expired)
+
+    def counts(self):
+        """عدد المستخدمين في كل حالة."""
+        with self._lock:
+            result = {}
+            for state, _, _ in self._states.values():
+                result[state] = result.get(state, 0) + 1
+            return result
+
+    def snapshot(self):
+        with self._lock:
+            self.dirty = False
+            return {str(uid): entry for uid, entry in self._states.items()}
+
+    def restore(self, saved):
+        with self._lock:
+            self._states = {int(uid): list(entry) for uid, entry in (saved or {}).items()}
+
+
+CONVERSATIONS = ConversationStates(STATE_TTL)
+CONVERSATIONS.restore(store.get_meta(STATES_META_KEY))
+
+
+def get_state(user_id: int):
+    return CONVERSATIONS.get(user_id)
+
+
+def set_state(user_id: int, state: str, data=None):
+    CONVERSATIONS.set(user_id, state, data)
+
+
+def clear_state(user_id: int):
+    CONVERSATIONS.clear(user_id)
+
+
+def save_meta():
+    """ما تغيّر من CONVERSATIONS وANALYTICS في كتابة meta واحدة لكل flush."""
+    items = {}
+    if CONVERSATIONS.dirty:
+        items[STATES_META_KEY] = CONVERSATIONS.snapshot()
+    if ANALYTICS.dirty:
+        items[ANALYTICS_META_KEY] = ANALYTICS.snapshot()
+    if not items:
         return
-    data[uid].update(kwargs)
-    data[uid]["last_active"] = datetime.now(timezone.utc).isoformat()
-    save_data(data)
+    try:
+        store.set_meta_many(items)
+    except Exception:
+        # نعيد المحاولة في الـ flush القادم
+        if STATES_META_KEY in items:
+            CONVERSATIONS.dirty = True
+        if ANALYTICS_META_KEY in items:
+            ANALYTICS.dirty = True
+        raise
 
 
-def get_all_user_ids():
-    return [int(uid) for uid in data.keys()]
+def expire_states(context: CallbackContext):
+    expired = CONVERSATIONS.expire()
+    if expired:
+        logger.info(f"Expired {expired} idle conversation states")
 
 
 def is_admin(user_id: int) -> bool:
     return ADMIN_ID is not None and user_id == ADMIN_ID
 
+# =================== فهرس محادثات الدعم ===================
+#
+# كل رسالة يرسلها البوت للأدمن بخصوص مستخدم (رسالة دعم، رد على رسالة جماعية،
+# مستخدم جديد) تُسجَّل في SUPPORT_THREADS: message_id → user_id. رد الأدمن
+# على أي رسالة في المحادثة (ومنها رسائله السابقة وتأكيدات الإرسال) يُوجَّه
+# بـ lookup واحد O(1) بدل البحث عن سطر ID في النص، فيشتغل مهما تغيّر
+# التنسيق ومع الرسائل غير النصية. OrderedDict بترتيب الإرسال: الأقدم من
+# SUPPORT_THREAD_TTL أو ما زاد عن SUPPORT_THREAD_MAX يُحذف من البداية.
+# الفهرس قد يصل عشرات الآلاف، فلا يُحفظ في meta (تُعاد كتابتها كاملة) بل في
+# SUPPORT_THREADS_FILE: كل flush يضيف السطور الجديدة فقط، ويُضغط الملف لما
+# تزيد سطوره عن ضعف الفهرس.
+# مع العمال: الفهرس في عامل الأدمن، والعمال الآخرون يرسلون له ما يسجّلونه.
+
+SUPPORT_THREAD_TTL = int(os.getenv("SUPPORT_THREAD_TTL", str(30 * 86400)))
+SUPPORT_THREAD_MAX = int(os.getenv("SUPPORT_THREAD_MAX", "50000"))
+SUPPORT_THREADS_FILE = os.getenv("SUPPORT_THREADS_FILE", "support_threads.jsonl")
+SUPPORT_THREADS_META_KEY = "support_threads"  # المكان القديم، يُنقل للملف مرة واحدة
+
+
+class SupportThreads:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._threads = OrderedDict()  # message_id → (user_id, sent_at)، الأقدم أولًا
+        self._lock = Lock()
+        self._unsaved = []  # [message_id, user_id, sent_at] لم تُكتب في الملف بعد
+        self._lines = 0  # عدد السطور في الملف
+
+    def __len__(self):
+        return len(self._threads)
+
+    def _evict(self, now):
+        threads = self._threads
+        cutoff = now - self.ttl
+        while threads and (
+            len(threads) > self.max_entries or next(iter(threads.values()))[1] < cutoff
+        ):
+            threads.popitem(last=False)
+
+    def remember(self, message_id, user_id):
+        now = now_ts()
+        with self._lock:
+            self._threads.pop(message_id, None)
+            self._threads[message_id] = (user_id, now)
+            self._evict(now)
+            self._unsaved.append([message_id, user_id, now])
+
+    def lookup(self, message_id):
+        with self._lock:
+            entry = self._threads.get(message_id)
+        if entry is None or entry[1] < now_ts() - self.ttl:
+            return None
+        return entry[0]
+
+    def save(self, path):
+        """يضيف الجديد لآخر الملف، أو يعيد كتابته مضغوطًا لو كثرت السطور القديمة."""
+        with self._lock:
+            if not self._unsaved:
+                return
+            if self._lines + len(self._unsaved) > 2 * len(self._threads) + 1000:
+                rows = [[mid, uid, ts] for mid, (uid, ts) in self._threads.items()]
+                _write_lines(path, rows)
+                self._lines = len(rows)
+            else:
+                with open(path, "a", encoding="utf-8") as f:
+                    for row in self._unsaved:
+                        f.write(json.dumps(row, separators=(",", ":")) + "\n")
+                self._lines += len(self._unsaved)
+            self._unsaved = []
+
+    def load(self, path):
+        """يعيد الفهرس من الملف: السطور بترتيب الإرسال، وآخر سطر لكل رسالة هو المعتمد."""
+        threads = OrderedDict()
+        lines = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        mid, uid, ts = json.loads(line)
+                        threads.pop(mid, None)
+                        threads[mid] = (uid, ts)
+                        lines += 1
+        with self._lock:
+            self._threads = threads
+            self._lines = lines
+            self._evict(now_ts())
+
+    def restore(self, saved):
+        """من النسخة القديمة في meta؛ كل السطور تُكتب في الملف مع أول حفظ."""
+        with self._lock:
+            self._threads = OrderedDict((mid, (uid, ts)) for mid, uid, ts in saved or [])
+            self._evict(now_ts())
+            self._unsaved = [[mid, uid, ts] for mid, (uid, ts) in self._threads.items()]
+
+
+def _load_support_threads():
+    threads = SupportThreads(SUPPORT_THREAD_TTL, SUPPORT_THREAD_MAX)
+    legacy = store.get_meta(SUPPORT_THREADS_META_KEY)
+    if legacy and not os.path.exists(SUPPORT_THREADS_FILE):
+        threads.restore(legacy)
+        threads.save(SUPPORT_THREADS_FILE)
+        store.set_meta(SUPPORT_THREADS_META_KEY, None)
+    else:
+        threads.load(SUPPORT_THREADS_FILE)
+    return threads
+
+
+SUPPORT_THREADS = _load_support_threads()
+
+
+def remember_support_thread(message_id: int, user_id: int):
+    if not owns_user(ADMIN_ID):
+        cast_to_owner(ADMIN_ID, "support_thread", message_id, user_id)
+        return
+    SUPPORT_THREADS.remember(message_id, user_id)
+
+
+def notify_admin(bot, user_id: int, text: str, **kwargs):
+    """يرسل للأدمن رسالة تخص user_id ويسجّلها في فهرس الدعم."""
+    sent = bot.send_message(chat_id=ADMIN_ID, text=text, **kwargs)
+    remember_support_thread(sent.message_id, user_id)
+    return sent
+
+
+def support_thread_user(message):
+    """صاحب المحادثة للرسالة التي رد عليها الأدمن، أو None."""
+    user_id = SUPPORT_THREADS.lookup(message.message_id)
+    if user_id is not None:
+        return user_id
+    forwarded = message.forward_from
+    if forwarded is not None and not forwarded.is_bot:
+        return forwarded.id
+    # رسائل أقدم من الفهرس: سطر ID في النص
+    m = re.search(r"ID:\s*`?(\d+)", message.text or message.caption or "")
+    return int(m.group(1)) if m else None
+
+
+def save_support_threads():
+    SUPPORT_THREADS.save(SUPPORT_THREADS_FILE)
+
 # =================== حساب مدة الثبات ===================
 
 
-def get_streak_delta(record):
-    start_iso = record.get("streak_start")
-    if not start_iso:
-        return None
-    try:
-        start_dt = datetime.fromisoformat(start_iso)
-        if start_dt.tzinfo is None:
-            start_dt = start_dt.replace(tzinfo=timezone.utc)
-        now = datetime.now(timezone.utc)
-        return now - start_dt
-    except Exception as e:
-        logger.error(f"Error parsing streak_start: {e}")
+def get_streak_seconds(record):
+    """مدة الثبات بالثواني، أو None لو العداد لم يبدأ."""
+    if record.streak_start is None:
         return None
+    return max(now_ts() - record.streak_start, 0)
 
 
-def format_streak_text(delta: timedelta) -> str:
-    total_minutes = int(delta.total_seconds() // 60)
-    total_hours = int(delta.total_seconds() // 3600)
-    total_days = int(delta.total_seconds() // 86400)
+def format_streak_text(seconds: int) -> str:
+    total_minutes = seconds // 60
+    total_hours = seconds // 3600
+    total_days = seconds // 86400
     # تقريب الأشهر 30 يوم
     months = total_days // 30
     days = total_days % 30
@@ -188,23 +2763,46 @@ BTN_SUPPORT = "تواصل مع الدعم ✉️"
 BTN_BROADCAST = "رسالة جماعية 📢"
 BTN_STATS = "عدد المستخدمين 👥"
 BTN_CANCEL = "إلغاء ❌"
+BTN_ALL_USERS = "الكل 👥"
 
-# أزرار إدارة الملاحظات
+# زر إضافة ملاحظة (inline تحت صفحة الملاحظات)
 BTN_NOTE_ADD = "➕ إضافة ملاحظة جديدة"
-BTN_NOTE_EDIT = "✏️ تعديل ملاحظة"
-BTN_NOTE_DELETE = "🗑 حذف ملاحظة"
 
-MAIN_KEYBOARD = ReplyKeyboardMarkup(
+
+def _prebuilt_keyboard(rows) -> str:
+    """يبني الكيبورد مرة واحدة ويرجعه JSON جاهز.
+
+    Bot._message يرسل reply_markup النصي كما هو، فلا يتكرر to_json()
+    مع كل رد.
+    """
+    return ReplyKeyboardMarkup(
+        [[KeyboardButton(label) for label in row] for row in rows],
+        resize_keyboard=True,
+    ).to_json()
+
+
+MAIN_KEYBOARD = _prebuilt_keyboard(
+    [
+        [BTN_START, BTN_COUNTER],
+        [BTN_TIP, BTN_EMERGENCY],
+        [BTN_RELAPSE, BTN_DHIKR],
+        [BTN_NOTES, BTN_RATING],
+        [BTN_RESET, BTN_SET_START],
+        [BTN_SUPPORT],
+        [BTN_BROADCAST, BTN_STATS],
+    ]
+)
+
+CANCEL_KEYBOARD = _prebuilt_keyboard([[BTN_CANCEL]])
+
+SEGMENT_KEYBOARD = _prebuilt_keyboard([[BTN_ALL_USERS], [BTN_CANCEL]])
+
+RATING_KEYBOARD = _prebuilt_keyboard(
     [
-        [KeyboardButton(BTN_START), KeyboardButton(BTN_COUNTER)],
-        [KeyboardButton(BTN_TIP), KeyboardButton(BTN_EMERGENCY)],
-        [KeyboardButton(BTN_RELAPSE), KeyboardButton(BTN_DHIKR)],
-        [KeyboardButton(BTN_NOTES), KeyboardButton(BTN_RATING)],
-        [KeyboardButton(BTN_RESET), KeyboardButton(BTN_SET_START)],
-        [KeyboardButton(BTN_SUPPORT)],
-        [KeyboardButton(BTN_BROADCAST), KeyboardButton(BTN_STATS)],
-    ],
-    resize_keyboard=True,
+        ["1", "2", "3"],
+        ["4", "5"],
+        [BTN_CANCEL],
+    ]
 )
 
 # =================== رسائل جاهزة ===================
@@ -252,12 +2850,47 @@ ADHKAR_TEXTS = [
     ),
 ]
 
+
+class StaticReply:
+    """رد ثابت (نص + كيبورد + تنسيق) يُجهَّز مرة واحدة ويُعاد استخدامه."""
+
+    __slots__ = ("kwargs",)
+
+    def __init__(self, text, reply_markup=MAIN_KEYBOARD, parse_mode=None):
+        self.kwargs = {"text": text, "reply_markup": reply_markup}
+        if parse_mode is not None:
+            self.kwargs["parse_mode"] = parse_mode
+
+    def send(self, update: Update):
+        return update.message.reply_text(**self.kwargs)
+
+
+TIP_REPLIES = [StaticReply(f"💡 نصيحة اليوم:\n{tip}") for tip in TIPS]
+EMERGENCY_REPLY = StaticReply(EMERGENCY_PLAN, parse_mode="Markdown")
+RELAPSE_REPLY = StaticReply(RELAPSE_REASONS, parse_mode="Markdown")
+ADHKAR_REPLIES = [StaticReply(text, parse_mode="Markdown") for text in ADHKAR_TEXTS]
+HELP_REPLY = StaticReply(
+    "استخدم الأزرار بالأسفل للتنقل بين مميزات البوت ✨\n"
+    "ولو احتجت مساعدة خاصة اضغط على زر «تواصل مع الدعم ✉️»."
+)
+NO_JOURNEY_REPLY = StaticReply(
+    "لم تبدأ رحلتك بعد.\n"
+    "اضغط على زر «بدء الرحلة 🚀» لبدء العداد ✨."
+)
+CANCELLED_REPLY = StaticReply("تم الإلغاء ✅\nرجعتك للقائمة الرئيسية ✨")
+UNROUTED_REPLY = StaticReply(
+    "⚠️ تنبيه: رسالتك هذه لا تصل للأدمن بشكل مباشر.\n"
+    "لو حاب تتواصل مع الدعم:\n"
+    "1️⃣ اضغط على زر «تواصل مع الدعم ✉️»\n"
+    "2️⃣ أو اضغط على الرسالة، ثم اختر Reply / الرد واكتب رسالتك"
+)
+
 # =================== أوامر البوت ===================
 
 
 def start_command(update: Update, context: CallbackContext):
     user = update.effective_user
-    is_new = str(user.id) not in data
+    is_new = store.get(user.id) is None
     get_user_record(user)
 
     text = (
@@ -271,14 +2904,13 @@ def start_command(update: Update, context: CallbackContext):
     # إشعار للأدمن عند دخول مستخدم جديد لأول مرة
     if is_new and ADMIN_ID is not None:
         try:
-            context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=(
-                    "👤 *مستخدم جديد دخل البوت!*\n\n"
-                    f"الاسم: {user.full_name}\n"
-                    f"اليوزر: @{user.username if user.username else 'لا يوجد'}\n"
-                    f"ID: `{user.id}`"
-                ),
+            notify_admin(
+                context.bot,
+                user.id,
+                "👤 *مستخدم جديد دخل البوت!*\n\n"
+                f"الاسم: {user.full_name}\n"
+                f"اليوزر: @{user.username if user.username else 'لا يوجد'}\n"
+                f"ID: `{user.id}`",
                 parse_mode="Markdown",
             )
         except Exception as e:
@@ -286,11 +2918,7 @@ def start_command(update: Update, context: CallbackContext):
 
 
 def help_command(update: Update, context: CallbackContext):
-    update.message.reply_text(
-        "استخدم الأزرار بالأسفل للتنقل بين مميزات البوت ✨\n"
-        "ولو احتجت مساعدة خاصة اضغط على زر «تواصل مع الدعم ✉️».",
-        reply_markup=MAIN_KEYBOARD,
-    )
+    HELP_REPLY.send(update)
 
 # =================== وظائف الأزرار ===================
 
@@ -299,18 +2927,17 @@ def handle_start_journey(update: Update, context: CallbackContext):
     user = update.effective_user
     record = get_user_record(user)
 
-    if record.get("streak_start"):
-        delta = get_streak_delta(record)
-        if delta:
-            human = format_streak_text(delta)
+    if record.streak_start is not None:
+        seconds = get_streak_seconds(record)
+        if seconds:
+            human = format_streak_text(seconds)
             update.message.reply_text(
                 f"🚀 رحلتك بدأت من قبل.\nمدة ثباتك الحالية: {human} 💪",
                 reply_markup=MAIN_KEYBOARD,
             )
             return
 
-    now = datetime.now(timezone.utc).isoformat()
-    update_user_record(user.id, streak_start=now)
+    update_user_record(user.id, flush=True, streak_start=now_ts())
 
     update.message.reply_text(
         "🚀 تم بدء رحلتك بنجاح!\n"
@@ -324,92 +2951,193 @@ def handle_days_counter(update: Update, context: CallbackContext):
     user = update.effective_user
     record = get_user_record(user)
 
-    delta = get_streak_delta(record)
-    if not delta:
-        update.message.reply_text(
-            "لم تبدأ رحلتك بعد.\n"
-            "اضغط على زر «بدء الرحلة 🚀» لبدء العداد ✨.",
-            reply_markup=MAIN_KEYBOARD,
-        )
+    seconds = get_streak_seconds(record)
+    if seconds is None:
+        NO_JOURNEY_REPLY.send(update)
         return
 
-    human = format_streak_text(delta)
+    human = format_streak_text(seconds)
+    rank_text = ""
+    position, total, percent = STREAK_INDEX.rank(record.streak_start)
+    if total >= STREAK_RANK_MIN_USERS:
+        rank_text = f"🏅 أنت متقدم على {percent}% من المستخدمين"
+        if WORKER_PROCESSES > 1:
+            # كل شارد عينة عشوائية (user_id % N) فالنسبة تمثّل الكل؛
+            # الترتيب الدقيق يحتاج سؤال كل العمال مع كل ضغطة
+            rank_text += ".\n\n"
+        else:
+            rank_text += f" (ترتيبك {position} من {total}).\n\n"
     update.message.reply_text(
         f"⏱ مدة ثباتك حتى الآن:\n{human}\n\n"
+        f"{rank_text}"
         "استمر… كل دقيقة تضيفها تقرّبك من النسخة التي تتمناها من نفسك 💪",
         reply_markup=MAIN_KEYBOARD,
     )
 
 
 def handle_tip(update: Update, context: CallbackContext):
-    tip = random.choice(TIPS)
-    update.message.reply_text(
-        f"💡 نصيحة اليوم:\n{tip}", reply_markup=MAIN_KEYBOARD
-    )
+    random.choice(TIP_REPLIES).send(update)
 
 
 def handle_emergency(update: Update, context: CallbackContext):
-    update.message.reply_text(
-        EMERGENCY_PLAN, reply_markup=MAIN_KEYBOARD, parse_mode="Markdown"
-    )
+    EMERGENCY_REPLY.send(update)
 
 
 def handle_relapse_reasons(update: Update, context: CallbackContext):
-    update.message.reply_text(
-        RELAPSE_REASONS, reply_markup=MAIN_KEYBOARD, parse_mode="Markdown"
-    )
+    RELAPSE_REPLY.send(update)
 
 
 def handle_adhkar(update: Update, context: CallbackContext):
-    text = random.choice(ADHKAR_TEXTS)
-    update.message.reply_text(
-        text, reply_markup=MAIN_KEYBOARD, parse_mode="Markdown"
+    random.choice(ADHKAR_REPLIES).send(update)
+
+
+# صفحات الملاحظات.
+# الملاحظات تُعرض صفحة صفحة مع أزرار inline: ✏️/🗑 بجانب كل ملاحظة
+# و«السابق/التالي» للتنقل. callback_data:
+#   notes:page:<n>            → عرض صفحة n (تعديل نفس الرسالة)
+#   notes:add                 → إضافة ملاحظة
+#   notes:edit:<idx>:<tag>    → تعديل الملاحظة رقم idx
+#   notes:del:<idx>:<tag>     → حذف الملاحظة رقم idx
+# tag = crc32 لنص الملاحظة: لو تغيّرت القائمة بعد عرض الصفحة (حذف من رسالة
+# أقدم مثلًا) لا نعدّل أو نحذف ملاحظة غير التي ضغط عليها المستخدم.
+
+NOTES_PAGE_SIZE = int(os.getenv("NOTES_PAGE_SIZE", "5"))
+# حد تليجرام 4096 حرف للرسالة؛ نقصّ الملاحظات الطويلة في العرض فقط، بحيث
+# تبقى الصفحة كاملة (العنوان والتذييل ~200 حرف، ورقم + "…" لكل ملاحظة)
+# تحت الحد مهما كان NOTES_PAGE_SIZE
+TELEGRAM_TEXT_LIMIT = 4096
+NOTE_PREVIEW_CHARS = max(1, min(700, (TELEGRAM_TEXT_LIMIT - 200) // NOTES_PAGE_SIZE - 12))
+
+
+def _note_tag(text: str) -> str:
+    return format(zlib.crc32(text.encode("utf-8")), "08x")
+
+
+def _notes_page(user_id: int, page: int):
+    """يرجع (النص، InlineKeyboardMarkup) لصفحة واحدة؛ الصفحة خارج المدى تُقصّ لآخر صفحة."""
+    size = NOTES_PAGE_SIZE
+    page = max(page, 0)
+    notes, total = store.get_notes_page(user_id, page * size, size)
+    pages = max(1, -(-total // size))
+    if page >= pages:
+        page = pages - 1
+        notes, total = store.get_notes_page(user_id, page * size, size)
+
+    add_row = [InlineKeyboardButton(BTN_NOTE_ADD, callback_data="notes:add")]
+    if not total:
+        text = "📓 ملاحظاتك:\n\nلا توجد ملاحظات بعد."
+        return text, InlineKeyboardMarkup([add_row])
+
+    start = page * size
+    lines = []
+    rows = []
+    for idx, note in enumerate(notes, start):
+        if len(note) > NOTE_PREVIEW_CHARS:
+            note_text = note[:NOTE_PREVIEW_CHARS] + "…"
+        else:
+            note_text = note
+        lines.append(f"{idx+1}. {note_text}")
+        tag = _note_tag(note)
+        rows.append(
+            [
+                InlineKeyboardButton(f"✏️ {idx+1}", callback_data=f"notes:edit:{idx}:{tag}"),
+                InlineKeyboardButton(f"🗑 {idx+1}", callback_data=f"notes:del:{idx}:{tag}"),
+            ]
+        )
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=f"notes:page:{page-1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=f"notes:page:{page+1}"))
+    if nav:
+        rows.append(nav)
+    rows.append(add_row)
+
+    header = f"📓 ملاحظاتك ({total})"
+    if pages > 1:
+        header += f" — صفحة {page+1} من {pages}"
+    text = (
+        f"{header}:\n\n" + "\n\n".join(lines) + "\n\n"
+        "اضغط ✏️ أو 🗑 بجانب رقم الملاحظة 👇"
     )
+    return text, InlineKeyboardMarkup(rows)
 
 
-def _format_notes_list(notes):
-    if not notes:
-        return "لا توجد ملاحظات بعد."
-    return "\n\n".join(f"{idx+1}. {n}" for idx, n in enumerate(notes))
+def _show_notes_page(query, user_id: int, page: int):
+    text, markup = _notes_page(user_id, page)
+    try:
+        query.edit_message_text(text, reply_markup=markup)
+    except BadRequest as e:
+        # "Message is not modified" لو ضغط نفس الزر مرتين
+        if "not modified" not in str(e):
+            raise
 
 
 def handle_notes(update: Update, context: CallbackContext):
-    """فتح شاشة إدارة الملاحظات (عرض / إضافة / تعديل / حذف)."""
+    """عرض أول صفحة من الملاحظات مع أزرار التنقل والتعديل والحذف."""
     user = update.effective_user
-    record = get_user_record(user)
-    notes = record.get("notes", [])
-
-    # تفعيل وضع قائمة إدارة الملاحظات
-    WAITING_FOR_NOTE_MENU.add(user.id)
-    WAITING_FOR_NOTE.discard(user.id)
-    WAITING_FOR_NOTE_EDIT.discard(user.id)
-    WAITING_FOR_NOTE_EDIT_TEXT.discard(user.id)
-    WAITING_FOR_NOTE_DELETE.discard(user.id)
-    NOTE_EDIT_INDEX.pop(user.id, None)
-
-    notes_text = _format_notes_list(notes)
-
-    kb = ReplyKeyboardMarkup(
-        [
-            [KeyboardButton(BTN_NOTE_ADD)],
-            [KeyboardButton(BTN_NOTE_EDIT), KeyboardButton(BTN_NOTE_DELETE)],
-            [KeyboardButton(BTN_CANCEL)],
-        ],
-        resize_keyboard=True,
-    )
+    get_user_record(user)
+    # لو كان في منتصف إضافة/تعديل ملاحظة نرجعه للعرض
+    clear_state(user.id)
 
-    update.message.reply_text(
-        f"📓 ملاحظاتك:\n\n{notes_text}\n\n"
-        "اختر ما تريد فعله من الأزرار 👇",
-        reply_markup=kb,
-    )
+    text, markup = _notes_page(user.id, 0)
+    update.message.reply_text(text, reply_markup=markup)
+
+
+def handle_notes_callback(update: Update, context: CallbackContext):
+    """ضغطات أزرار صفحة الملاحظات (notes:...)."""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    parts = query.data.split(":")
+    action = parts[1] if len(parts) > 1 else ""
+
+    if action == "page":
+        query.answer()
+        _show_notes_page(query, user_id, int(parts[2]))
+        return
+
+    if action == "add":
+        query.answer()
+        set_state(user_id, STATE_NOTE_ADD)
+        update.effective_message.reply_text(
+            "📝 أرسل الآن الملاحظة التي تريد حفظها.\n"
+            "لو حاب تلغي اضغط «إلغاء ❌».",
+            reply_markup=CANCEL_KEYBOARD,
+        )
+        return
+
+    if action not in ("edit", "del") or len(parts) != 4:
+        query.answer()
+        return
+
+    idx, tag = int(parts[2]), parts[3]
+    page = idx // NOTES_PAGE_SIZE
+    notes, _ = store.get_notes_page(user_id, idx, 1)
+    if not notes or _note_tag(notes[0]) != tag:
+        query.answer("القائمة تغيّرت، حدّثتها لك 🔄")
+        _show_notes_page(query, user_id, page)
+        return
+
+    if action == "edit":
+        query.answer()
+        set_state(user_id, STATE_NOTE_EDIT_TEXT, {"idx": idx, "tag": tag})
+        update.effective_message.reply_text(
+            f"✏️ أرسل النص الجديد للملاحظة رقم {idx+1}:",
+            reply_markup=CANCEL_KEYBOARD,
+        )
+        return
+
+    delete_note(user_id, idx)
+    query.answer("🗑 تم حذف الملاحظة")
+    _show_notes_page(query, user_id, page)
 
 
 def handle_reset_counter(update: Update, context: CallbackContext):
     user = update.effective_user
     record = get_user_record(user)
 
-    if not record.get("streak_start"):
+    if record.streak_start is None:
         update.message.reply_text(
             "العداد لم يُضبط بعد.\n"
             "يمكنك البدء من جديد عبر زر «بدء الرحلة 🚀».",
@@ -417,8 +3145,7 @@ def handle_reset_counter(update: Update, context: CallbackContext):
         )
         return
 
-    now = datetime.now(timezone.utc).isoformat()
-    update_user_record(user.id, streak_start=now)
+    update_user_record(user.id, flush=True, streak_start=now_ts())
 
     update.message.reply_text(
         "♻️ تم إعادة ضبط العداد.\n"
@@ -431,15 +3158,13 @@ def handle_contact_support(update: Update, context: CallbackContext):
     user = update.effective_user
     get_user_record(user)
 
-    WAITING_FOR_SUPPORT.add(user.id)
-
-    cancel_kb = ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True)
+    set_state(user.id, STATE_SUPPORT)
 
     update.message.reply_text(
         "✉️ اكتب الآن رسالتك التي تريد إرسالها للدعم.\n"
         "حاول أن تشرح وضعك أو سؤالك بهدوء… وسنقرأه باهتمام 🤍\n\n"
         "لو حاب تلغي اضغط «إلغاء ❌».",
-        reply_markup=cancel_kb,
+        reply_markup=CANCEL_KEYBOARD,
     )
 
 
@@ -451,17 +3176,52 @@ def handle_broadcast_button(update: Update, context: CallbackContext):
         )
         return
 
-    WAITING_FOR_BROADCAST.add(user.id)
-    cancel_kb = ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True)
+    set_state(user.id, STATE_BROADCAST_SEGMENT)
 
     update.message.reply_text(
-        "📢 اكتب الآن الرسالة التي تريد إرسالها لجميع مستخدمي البوت.\n"
-        "يمكنك مثلاً إرسال تذكير، تشجيع، أو إعلان هام.\n\n"
-        "للإلغاء اضغط «إلغاء ❌».",
-        reply_markup=cancel_kb,
+        "📢 لمن تريد إرسال الرسالة الجماعية؟\n\n" + SEGMENT_USAGE,
+        reply_markup=SEGMENT_KEYBOARD,
     )
 
 
+def local_stats():
+    """إحصائيات هذه العملية (أو شارد هذا العامل)؛ merge_stats يجمعها."""
+    return {
+        "users": store.count(),
+        "reachable": store.count_reachable(),
+        "report": ANALYTICS.report(),
+        "top": STREAK_INDEX.top(STREAK_TOP_COUNT),
+        "last_check": ANALYTICS.last_check,
+    }
+
+
+def merge_stats(parts):
+    report = {"dau": 0, "wau": 0, "new_today": 0, "new_week": 0}
+    streaks = [0] * (len(STREAK_BUCKETS) + 1)
+    ratings = {}
+    for part in parts:
+        for key in report:
+            report[key] += part["report"][key]
+        for i, n in enumerate(part["report"]["streaks"]):
+            streaks[i] += n
+        for day, total, count in part["report"]["ratings"]:
+            old = ratings.get(day, (0, 0))
+            ratings[day] = (old[0] + total, old[1] + count)
+    report["streaks"] = streaks
+    report["ratings"] = [(day, total / count) for day, (total, count) in sorted(ratings.items())]
+    checks = [part["last_check"] for part in parts]
+    return {
+        "users": sum(part["users"] for part in parts),
+        "reachable": sum(part["reachable"] for part in parts),
+        "report": report,
+        "top": sorted(start for part in parts for start in part["top"])[:STREAK_TOP_COUNT],
+        # أقدم فحص بين العمال، ومجموع الفروق
+        "last_check": (
+            (min(c[0] for c in checks), sum(c[1] for c in checks)) if all(checks) else None
+        ),
+    }
+
+
 def handle_stats_button(update: Update, context: CallbackContext):
     user = update.effective_user
     if not is_admin(user.id):
@@ -470,9 +3230,38 @@ def handle_stats_button(update: Update, context: CallbackContext):
         )
         return
 
-    total_users = len(get_all_user_ids())
+    merged = merge_stats(call_workers("stats"))
+    total_users = merged["users"]
+    reachable = merged["reachable"]
+    stats = merged["report"]
+    streaks = stats["streaks"]
+    ratings = "، ".join(
+        f"{datetime.fromtimestamp(day * 86400, timezone.utc):%m/%d}: {avg:.1f}"
+        for day, avg in stats["ratings"]
+    ) or "لا يوجد"
+    if merged["last_check"]:
+        checked_at, drift = merged["last_check"]
+        check_text = f"{ts_to_iso(checked_at)[:16]} (فرق: {drift})"
+    else:
+        check_text = "لم يتم بعد"
+    now = now_ts()
+    top = "، ".join(f"{(now - start) // 86400}" for start in merged["top"]) or "لا يوجد"
+
     update.message.reply_text(
-        f"👥 عدد المستخدمين المسجلين في البوت: *{total_users}*",
+        f"👥 عدد المستخدمين المسجلين في البوت: *{total_users}*\n"
+        f"📬 يمكن الوصول لهم: *{reachable}* "
+        f"(حظروا البوت أو حذفوا حساباتهم: {total_users - reachable})\n"
+        f"🔥 النشطين اليوم: *{stats['dau']}* | آخر 7 أيام: *{stats['wau']}*\n"
+        f"🆕 جدد اليوم: *{stats['new_today']}* | آخر 7 أيام: *{stats['new_week']}*\n\n"
+        "⏱ توزيع مدة الثبات الحالية:\n"
+        f"• أقل من يوم: {streaks[0]}\n"
+        f"• 1-6 أيام: {streaks[1]}\n"
+        f"• 7-29 يوم: {streaks[2]}\n"
+        f"• 30-89 يوم: {streaks[3]}\n"
+        f"• 90 يوم فأكثر: {streaks[4]}\n"
+        f"🏆 أطول {STREAK_TOP_COUNT} فترات ثبات (بالأيام، بدون أسماء): {top}\n\n"
+        f"⭐ متوسط التقييم آخر 7 أيام: {ratings}\n"
+        f"🔎 آخر فحص للإحصائيات: {check_text}",
         parse_mode="Markdown",
         reply_markup=MAIN_KEYBOARD,
     )
@@ -480,408 +3269,1173 @@ def handle_stats_button(update: Update, context: CallbackContext):
 
 def handle_rating_button(update: Update, context: CallbackContext):
     user = update.effective_user
-    WAITING_FOR_RATING.add(user.id)
-
-    kb = ReplyKeyboardMarkup(
-        [
-            [KeyboardButton("1"), KeyboardButton("2"), KeyboardButton("3")],
-            [KeyboardButton("4"), KeyboardButton("5")],
-            [KeyboardButton(BTN_CANCEL)],
-        ],
-        resize_keyboard=True,
-    )
+    set_state(user.id, STATE_RATING)
 
     update.message.reply_text(
         "⭐ قيّم يومك من 1 إلى 5:\n"
         "1 = كان صعب جدًا\n"
         "5 = ممتاز وثابت ولله الحمد 🌟\n\n"
         "اختر رقمًا أو اضغط «إلغاء ❌».",
-        reply_markup=kb,
+        reply_markup=RATING_KEYBOARD,
     )
 
 
 def handle_set_start_button(update: Update, context: CallbackContext):
     user = update.effective_user
-    WAITING_FOR_CUSTOM_START.add(user.id)
-
-    kb = ReplyKeyboardMarkup([[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True)
+    set_state(user.id, STATE_CUSTOM_START)
 
     update.message.reply_text(
         "⏱ اكتب عدد *الأيام* التي ثبَتَّ فيها حتى الآن قبل استخدام البوت.\n"
         "مثال: اكتب فقط الرقم: 7\n\n"
         "للإلغاء اضغط «إلغاء ❌».",
-        reply_markup=kb,
+        reply_markup=CANCEL_KEYBOARD,
     )
 
-# =================== تذكير يومي ===================
+# =================== الإرسال المحدود والرسائل الجماعية ===================
+#
+# كل الإرسال الجماعي يمر عبر OUTBOUND_BUCKET (token bucket) حتى نبقى تحت
+# حد تيليجرام العام (~30 رسالة/ثانية)، ولو رجع RetryAfter نوقف كل الإرسال
+# المدة المطلوبة ثم نعيد المحاولة.
+#
+# الرسالة الجماعية تشتغل في ثريد مستقل بعيدًا عن هاندلر الأدمن، وتحفظ
+# المؤشر (آخر ID تم الإرسال له) في BROADCAST_STATE_FILE، فلو أُعيد تشغيل
+# البوت في النص تكمل من نفس المكان.
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # رسالة/ثانية
+BROADCAST_STATE_FILE = os.getenv("BROADCAST_STATE_FILE", "broadcast_state.json")
+BROADCAST_SAVE_EVERY = 50  # حفظ المؤشر كل كم رسالة
+BROADCAST_PROGRESS_INTERVAL = 10  # ثواني بين تحديثات التقدّم للأدمن
+SEND_MAX_RETRIES = 5
+
+SEND_SENT = "sent"
+SEND_FAILED = "failed"
+SEND_BLOCKED = "blocked"
+
+
+class TokenBucket:
+    """حد معدل بسيط: rate توكن في الثانية وسعة capacity.
+
+    الحالة [التوكنات، آخر تعبئة، موقوف حتى] في list عادي، أو في
+    multiprocessing.Array (shared) لما يتشارك العمال نفس الحد.
+    """
+
+    TOKENS, LAST, PAUSED_UNTIL = range(3)
+
+    def __init__(self, rate, capacity=None, shared=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        if shared is None:
+            self._state = [self.capacity, monotonic(), 0.0]
+            self._lock = Lock()
+        else:
+            self._state = shared
+            self._lock = shared.get_lock()
+
+    @staticmethod
+    def shared_state(mp_context, capacity):
+        # monotonic() على مستوى النظام، فالأوقات صالحة بين العمليات
+        return mp_context.Array("d", [capacity, monotonic(), 0.0])
+
+    def acquire(self):
+        state = self._state
+        while True:
+            with self._lock:
+                now = monotonic()
+                if now < state[self.PAUSED_UNTIL]:
+                    wait = state[self.PAUSED_UNTIL] - now
+                else:
+                    state[self.TOKENS] = min(
+                        self.capacity,
+                        state[self.TOKENS] + (now - state[self.LAST]) * self.rate,
+                    )
+                    state[self.LAST] = now
+                    if state[self.TOKENS] >= 1:
+                        state[self.TOKENS] -= 1
+                        return
+                    wait = (1 - state[self.TOKENS]) / self.rate
+            sleep(wait)
+
+    def pause(self, seconds):
+        """يوقف كل المرسلين seconds ثانية (بعد RetryAfter من تيليجرام)."""
+        state = self._state
+        with self._lock:
+            state[self.PAUSED_UNTIL] = max(state[self.PAUSED_UNTIL], monotonic() + seconds)
+            state[self.LAST] = state[self.PAUSED_UNTIL]
+            state[self.TOKENS] = 0
+
+
+OUTBOUND_BUCKET = TokenBucket(BROADCAST_RATE)
+
+
+# أخطاء BadRequest التي تعني أن المحادثة لم تعد موجودة
+_UNREACHABLE_MESSAGES = (
+    "chat not found",
+    "user is deactivated",
+    "bot was blocked",
+    "bot can't initiate conversation",
+    "peer_id_invalid",
+)
 
 
-def send_daily_reminders(context: CallbackContext):
-    logger.info("Running daily reminders job...")
-    user_ids = get_all_user_ids()
-    for uid in user_ids:
+def is_unreachable_error(error) -> bool:
+    """True لو الخطأ معناه أن المستخدم حظر البوت أو حذف حسابه."""
+    if isinstance(error, Unauthorized):
+        return True
+    if isinstance(error, BadRequest):
+        message = str(error).lower()
+        return any(m in message for m in _UNREACHABLE_MESSAGES)
+    return False
+
+
+def send_throttled(bot, chat_id, text, **kwargs):
+    """يرسل رسالة عبر OUTBOUND_BUCKET ويرجع SEND_SENT / SEND_BLOCKED / SEND_FAILED."""
+    for _ in range(SEND_MAX_RETRIES):
+        OUTBOUND_BUCKET.acquire()
+        _throttled_send.active = True
         try:
-            context.bot.send_message(
-                chat_id=uid,
-                text=(
-                    "🤍 تذكير لطيف:\n"
-                    "أنت لست وحدك في هذه الرحلة.\n"
-                    "خذ دقيقة لتتذكر سبب إقلاعك، واضغط على أي زر تحتاجه الآن ✨."
-                ),
-            )
+            bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            return SEND_SENT
+        except RetryAfter as e:
+            logger.warning(f"Flood limit hit, pausing sends for {e.retry_after}s")
+            OUTBOUND_BUCKET.pause(e.retry_after)
+        except TimedOut:
+            continue
         except Exception as e:
-            logger.error(f"Error sending daily reminder to {uid}: {e}")
+            if is_unreachable_error(e):
+                mark_unreachable(chat_id)
+                return SEND_BLOCKED
+            logger.error(f"Error sending message to {chat_id}: {e}")
+            return SEND_FAILED
+        finally:
+            _throttled_send.active = False
+    return SEND_FAILED
 
-# =================== هاندلر الرسائل ===================
 
+_broadcast_lock = Lock()
+_broadcast_thread = None
+_broadcast_stop = Event()
 
-def handle_text_message(update: Update, context: CallbackContext):
-    user = update.effective_user
-    user_id = user.id
-    msg = update.message
-    text = (msg.text or "").strip()
 
-    record = get_user_record(user)
+def _save_broadcast_state(job):
+    _write_json_file(BROADCAST_STATE_FILE, job)
 
-    # 1️⃣ زر الإلغاء العام
-    if text == BTN_CANCEL:
-        WAITING_FOR_SUPPORT.discard(user_id)
-        WAITING_FOR_BROADCAST.discard(user_id)
-        WAITING_FOR_NOTE.discard(user_id)
-        WAITING_FOR_NOTE_MENU.discard(user_id)
-        WAITING_FOR_NOTE_EDIT.discard(user_id)
-        WAITING_FOR_NOTE_EDIT_TEXT.discard(user_id)
-        WAITING_FOR_NOTE_DELETE.discard(user_id)
-        WAITING_FOR_RATING.discard(user_id)
-        WAITING_FOR_CUSTOM_START.discard(user_id)
-        NOTE_EDIT_INDEX.pop(user_id, None)
 
-        msg.reply_text(
-            "تم الإلغاء ✅\nرجعتك للقائمة الرئيسية ✨",
-            reply_markup=MAIN_KEYBOARD,
-        )
-        return
+def _load_broadcast_state():
+    return _read_json_file(BROADCAST_STATE_FILE)
 
-    # 2️⃣ رد الأدمن على رسالة فيها ID → يرسل للمستخدم
-    if is_admin(user_id) and msg.reply_to_message:
-        original = msg.reply_to_message.text or ""
-        m = re.search(r"ID:\s*`(\d+)`", original)
-        if m:
-            target_id = int(m.group(1))
-            try:
-                context.bot.send_message(
-                    chat_id=target_id,
-                    text=f"💌 رد من الدعم:\n\n{text}",
-                    reply_markup=MAIN_KEYBOARD,
-                )
-                msg.reply_text(
-                    "✅ تم إرسال ردّك للمستخدم.",
-                    reply_markup=MAIN_KEYBOARD,
-                )
-            except Exception as e:
-                logger.error(f"Error sending admin reply to {target_id}: {e}")
-                msg.reply_text(
-                    "حدث خطأ أثناء إرسال الرد للمستخدم ⚠️.",
-                    reply_markup=MAIN_KEYBOARD,
-                )
-            return
 
-    # 3️⃣ قائمة إدارة الملاحظات
-    if user_id in WAITING_FOR_NOTE_MENU:
-        notes = record.get("notes", [])
+def _broadcast_progress_text(job):
+    done = job[SEND_SENT] + job[SEND_FAILED] + job[SEND_BLOCKED]
+    return (
+        f"📢 جاري إرسال الرسالة الجماعية… {done}/{job['total']}\n"
+        f"✅ وصلت: {job[SEND_SENT]}\n"
+        f"🚫 حظروا البوت: {job[SEND_BLOCKED]}\n"
+        f"⚠️ فشلت: {job[SEND_FAILED]}"
+    )
+
 
-        if text == BTN_NOTE_ADD:
-            WAITING_FOR_NOTE_MENU.discard(user_id)
-            WAITING_FOR_NOTE.add(user_id)
-            kb = ReplyKeyboardMarkup(
-                [[KeyboardButton(BTN_CANCEL)]],
-                resize_keyboard=True,
+def _report_broadcast_progress(bot, job):
+    try:
+        if job.get("progress_message_id"):
+            bot.edit_message_text(
+                chat_id=job["admin_chat_id"],
+                message_id=job["progress_message_id"],
+                text=_broadcast_progress_text(job),
             )
-            msg.reply_text(
-                "📝 أرسل الآن الملاحظة التي تريد حفظها.\n"
-                "لو حاب تلغي اضغط «إلغاء ❌».",
-                reply_markup=kb,
+        else:
+            sent = bot.send_message(
+                chat_id=job["admin_chat_id"], text=_broadcast_progress_text(job)
             )
-            return
+            job["progress_message_id"] = sent.message_id
+    except Exception as e:
+        logger.warning(f"Error reporting broadcast progress: {e}")
 
-        if text == BTN_NOTE_EDIT:
-            if not notes:
-                msg.reply_text(
-                    "📓 لا توجد ملاحظات لتعديلها حاليًا.",
-                    reply_markup=MAIN_KEYBOARD,
-                )
-                WAITING_FOR_NOTE_MENU.discard(user_id)
+
+def _run_broadcast(bot, job):
+    global _broadcast_thread
+    try:
+        user_ids = sorted(get_segment_user_ids(job.get("segment")))
+        start = 0 if job["cursor"] is None else bisect_right(user_ids, job["cursor"])
+        job["total"] = job[SEND_SENT] + job[SEND_FAILED] + job[SEND_BLOCKED]
+        job["total"] += len(user_ids) - start
+        _report_broadcast_progress(bot, job)
+        last_report = monotonic()
+        text = f"📢 رسالة من الدعم:\n\n{job['text']}"
+
+        for i, uid in enumerate(user_ids[start:], 1):
+            if _broadcast_stop.is_set():
+                _save_broadcast_state(job)
+                logger.info(f"Broadcast paused at user {job['cursor']}")
                 return
+            result = send_throttled(bot, uid, text)
+            job[result] += 1
+            BULK_SENDS.inc("broadcast", result)
+            job["cursor"] = uid
+            if i % BROADCAST_SAVE_EVERY == 0:
+                _save_broadcast_state(job)
+            if monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                _report_broadcast_progress(bot, job)
+                last_report = monotonic()
+
+        _report_broadcast_progress(bot, job)
+        try:
+            os.remove(BROADCAST_STATE_FILE)
+        except FileNotFoundError:
+            pass
+        logger.info(
+            f"Broadcast finished: sent={job[SEND_SENT]} failed={job[SEND_FAILED]} "
+            f"blocked={job[SEND_BLOCKED]}"
+        )
+        bot.send_message(
+            chat_id=job["admin_chat_id"],
+            text=(
+                "✅ انتهى إرسال الرسالة الجماعية.\n"
+                f"وصلت إلى: {job[SEND_SENT]} مستخدم\n"
+                f"حظروا البوت: {job[SEND_BLOCKED]}\n"
+                f"فشل الإرسال: {job[SEND_FAILED]}"
+            ),
+            reply_markup=MAIN_KEYBOARD,
+        )
+    except Exception as e:
+        logger.error(f"Broadcast crashed: {e}")
+        _save_broadcast_state(job)
+    finally:
+        with _broadcast_lock:
+            _broadcast_thread = None
+
+
+def _start_broadcast_thread(bot, job):
+    """لازم تُستدعى و _broadcast_lock مقفول."""
+    global _broadcast_thread
+    _broadcast_stop.clear()
+    _save_broadcast_state(job)
+    _broadcast_thread = Thread(
+        target=_run_broadcast, args=(bot, job), name="broadcast", daemon=True
+    )
+    _broadcast_thread.start()
+
+
+def start_broadcast(bot, admin_chat_id, text, segment=None) -> bool:
+    """يبدأ رسالة جماعية جديدة (للكل أو لشريحة)، ويرجع False لو فيه واحدة شغّالة."""
+    with _broadcast_lock:
+        if _broadcast_thread is not None:
+            return False
+        job = {
+            "text": text,
+            "segment": segment,
+            "admin_chat_id": admin_chat_id,
+            "cursor": None,
+            "total": 0,
+            "progress_message_id": None,
+            SEND_SENT: 0,
+            SEND_FAILED: 0,
+            SEND_BLOCKED: 0,
+        }
+        _start_broadcast_thread(bot, job)
+        return True
 
-            WAITING_FOR_NOTE_MENU.discard(user_id)
-            WAITING_FOR_NOTE_EDIT.add(user_id)
-            notes_text = _format_notes_list(notes)
-            kb = ReplyKeyboardMarkup(
-                [[KeyboardButton(BTN_CANCEL)]],
-                resize_keyboard=True,
-            )
-            msg.reply_text(
-                f"✏️ اختر رقم الملاحظة التي تريد تعديلها:\n\n{notes_text}\n\n"
-                "أرسل الرقم الآن، أو اضغط «إلغاء ❌».",
-                reply_markup=kb,
-            )
+
+def resume_broadcast(bot):
+    """يكمل رسالة جماعية انقطعت بسبب إعادة التشغيل."""
+    job = _load_broadcast_state()
+    if not job:
+        return
+    with _broadcast_lock:
+        if _broadcast_thread is not None:
             return
+        logger.info(f"Resuming broadcast after user {job['cursor']}")
+        job["progress_message_id"] = None
+        _start_broadcast_thread(bot, job)
 
-        if text == BTN_NOTE_DELETE:
-            if not notes:
-                msg.reply_text(
-                    "📓 لا توجد ملاحظات لحذفها حاليًا.",
-                    reply_markup=MAIN_KEYBOARD,
-                )
-                WAITING_FOR_NOTE_MENU.discard(user_id)
-                return
 
-            WAITING_FOR_NOTE_MENU.discard(user_id)
-            WAITING_FOR_NOTE_DELETE.add(user_id)
-            notes_text = _format_notes_list(notes)
-            kb = ReplyKeyboardMarkup(
-                [[KeyboardButton(BTN_CANCEL)]],
-                resize_keyboard=True,
-            )
-            msg.reply_text(
-                f"🗑 اختر رقم الملاحظة التي تريد حذفها:\n\n{notes_text}\n\n"
-                "أرسل الرقم الآن، أو اضغط «إلغاء ❌».",
-                reply_markup=kb,
-            )
-            return
+def stop_broadcast(timeout=5):
+    """يوقف الرسالة الجماعية مع حفظ المؤشر (عند إيقاف البوت)."""
+    _broadcast_stop.set()
+    thread = _broadcast_thread
+    if thread is not None:
+        thread.join(timeout)
 
-        # لو كتب شيء آخر داخل القائمة
-        msg.reply_text(
-            "اختر من الأزرار المتاحة لإدارة ملاحظاتك 👇",
-            reply_markup=ReplyKeyboardMarkup(
-                [
-                    [KeyboardButton(BTN_NOTE_ADD)],
-                    [KeyboardButton(BTN_NOTE_EDIT), KeyboardButton(BTN_NOTE_DELETE)],
-                    [KeyboardButton(BTN_CANCEL)],
-                ],
-                resize_keyboard=True,
-            ),
-        )
-        return
+# =================== تذكير يومي ===================
 
-    # 4️⃣ اختيار رقم ملاحظة للتعديل
-    if user_id in WAITING_FOR_NOTE_EDIT:
-        notes = record.get("notes", [])
-        try:
-            idx = int(text) - 1
-            if idx < 0 or idx >= len(notes):
-                raise ValueError()
-        except ValueError:
-            kb = ReplyKeyboardMarkup(
-                [[KeyboardButton(BTN_CANCEL)]],
-                resize_keyboard=True,
-            )
-            msg.reply_text(
-                "رجاءً أرسل رقم صحيح من القائمة، أو اضغط «إلغاء ❌».",
-                reply_markup=kb,
-            )
-            return
 
-        NOTE_EDIT_INDEX[user_id] = idx
-        WAITING_FOR_NOTE_EDIT.discard(user_id)
-        WAITING_FOR_NOTE_EDIT_TEXT.add(user_id)
+# وقت التذكير اليومي بتوقيت UTC بصيغة HH:MM
+DAILY_REMINDER_TIME = os.getenv("DAILY_REMINDER_TIME", "20:00")
 
-        kb = ReplyKeyboardMarkup(
-            [[KeyboardButton(BTN_CANCEL)]],
-            resize_keyboard=True,
-        )
-        msg.reply_text(
-            f"✏️ أرسل النص الجديد للملاحظة رقم {idx+1}:",
-            reply_markup=kb,
+DAILY_REMINDER_TEXT = (
+    "🤍 تذكير لطيف:\n"
+    "أنت لست وحدك في هذه الرحلة.\n"
+    "خذ دقيقة لتتذكر سبب إقلاعك، واضغط على أي زر تحتاجه الآن ✨."
+)
+
+
+def _send_daily_reminders(bot):
+    counts = {SEND_SENT: 0, SEND_FAILED: 0, SEND_BLOCKED: 0}
+    # مع العمال: كل عامل يذكّر مستخدمي شارده فقط
+    for uid in store.reachable_user_ids():
+        result = send_throttled(bot, uid, DAILY_REMINDER_TEXT)
+        counts[result] += 1
+        BULK_SENDS.inc("daily_reminder", result)
+    logger.info(
+        f"Daily reminders done: sent={counts[SEND_SENT]} "
+        f"failed={counts[SEND_FAILED]} newly_blocked={counts[SEND_BLOCKED]}"
+    )
+
+
+def send_daily_reminders(context: CallbackContext):
+    logger.info("Running daily reminders job...")
+    # الإرسال محدود المعدل وقد يأخذ دقائق، فلا نحجز ثريد job_queue
+    Thread(
+        target=_send_daily_reminders,
+        args=(context.bot,),
+        name="daily-reminders",
+        daemon=True,
+    ).start()
+
+# =================== تهنئة مراحل الثبات ===================
+#
+# min-heap من (موعد المرحلة القادمة، user_id، streak_start) لكل من بدأ رحلته.
+# job_queue فيه job واحد فقط (run_once) على موعد أقرب عنصر في الـ heap،
+# فلا يوجد أي مرور على المستخدمين ولا polling وقت الانتظار.
+# إعادة الضبط تضيف عنصرًا جديدًا فقط؛ العنصر القديم يبقى ويُتجاهل عند خروجه
+# لأن streak_start المحفوظ فيه لم يعد يطابق السجل (lazy invalidation).
+# آخر وقت تم تفريغه يُحفظ في meta، فالمراحل التي حلّت والبوت متوقف تُرسل
+# عند التشغيل (مرة واحدة بأعلى مرحلة وصلها المستخدم).
+
+MILESTONE_DAYS = tuple(
+    sorted(int(d) for d in os.getenv("MILESTONE_DAYS", "7,30,90").split(",") if d.strip())
+)
+MILESTONES_META_KEY = "milestones_checked_at"
+
+MILESTONE_TEXT = (
+    "🎉 ما شاء الله! أتممت {days} يوم من الثبات.\n"
+    "هذه خطوة كبيرة تستحق أن تفخر بها، استمر والله معك 💪"
+)
+
+
+class MilestoneQueue:
+    def __init__(self, days):
+        self.days = days
+        self._lock = Lock()
+        self._heap = []
+        self._job_queue = None
+        self._job = None
+        self._job_due = None
+
+    def next_due(self, start, after):
+        """موعد أول مرحلة بعد after، أو None لو تجاوز كل المراحل."""
+        for days in self.days:
+            due = start + days * 86400
+            if due > after:
+                return due
+        return None
+
+    def reached(self, start, now):
+        """أعلى مرحلة (بالأيام) وصلها حتى now، أو None."""
+        best = None
+        for days in self.days:
+            if start + days * 86400 <= now:
+                best = days
+        return best
+
+    def __len__(self):
+        return len(self._heap)
+
+    def load(self, streaks, after):
+        heap = []
+        for user_id, start in streaks:
+            due = self.next_due(start, after)
+            if due is not None:
+                heap.append((due, user_id, start))
+        heapify(heap)
+        with self._lock:
+            self._heap = heap
+            self._schedule()
+
+    def push(self, user_id, start, after=None):
+        if start is None:
+            return
+        due = self.next_due(start, now_ts() if after is None else after)
+        if due is None:
+            return
+        with self._lock:
+            heappush(self._heap, (due, user_id, start))
+            self._schedule()
+
+    def attach(self, job_queue):
+        with self._lock:
+            self._job_queue = job_queue
+            self._schedule()
+
+    def _schedule(self):
+        """يضمن وجود job على موعد أقرب عنصر. لازم تُستدعى و self._lock مقفول."""
+        if self._job_queue is None or not self._heap:
+            return
+        due = self._heap[0][0]
+        if self._job is not None:
+            if self._job_due <= due:
+                return
+            self._job.schedule_removal()
+        self._job_due = due
+        self._job = self._job_queue.run_once(
+            send_milestones, max(0, due - now_ts()), name="milestones"
         )
-        return
 
-    # 5️⃣ استلام النص الجديد بعد اختيار رقم الملاحظة
-    if user_id in WAITING_FOR_NOTE_EDIT_TEXT:
-        notes = record.get("notes", [])
-        idx = NOTE_EDIT_INDEX.get(user_id)
-        if idx is None or idx < 0 or idx >= len(notes):
-            # لو حصل لخبطة نرجع للقائمة الرئيسية
-            WAITING_FOR_NOTE_EDIT_TEXT.discard(user_id)
-            NOTE_EDIT_INDEX.pop(user_id, None)
-            msg.reply_text(
-                "حصل خطأ بسيط في اختيار الملاحظة، جرّب مرة أخرى من «ملاحظاتي 📓».",
-                reply_markup=MAIN_KEYBOARD,
+    def pop_due(self, now):
+        """يخرج كل العناصر التي حلّ موعدها ويجدول الـ job التالي."""
+        due_items = []
+        with self._lock:
+            self._job = None
+            self._job_due = None
+            while self._heap and self._heap[0][0] <= now:
+                due_items.append(heappop(self._heap))
+            self._schedule()
+        return due_items
+
+
+def _load_milestones(rows):
+    started = monotonic()
+    queue = MilestoneQueue(MILESTONE_DAYS)
+    checked_at = store.get_meta(MILESTONES_META_KEY)
+    if checked_at is None:
+        # أول تشغيل: لا نهنئ بمراحل قديمة
+        checked_at = now_ts()
+        store.set_meta(MILESTONES_META_KEY, checked_at)
+    queue.load([(row[0], row[3]) for row in rows if row[3] is not None], checked_at)
+    logger.info(f"Milestone heap built: {len(queue)} users in {monotonic() - started:.2f}s")
+    return queue
+
+
+MILESTONES = _load_milestones(STARTUP_ROWS)
+
+
+def _send_milestones(bot, entries, now):
+    counts = {SEND_SENT: 0, SEND_FAILED: 0, SEND_BLOCKED: 0}
+    stale = 0
+    for _, user_id, start in entries:
+        record = store.get(user_id)
+        if record is not None:
+            _apply_pending(user_id, record)
+        if record is None or record.streak_start != start:
+            stale += 1  # أعاد الضبط بعد إضافة العنصر
+            continue
+        days = MILESTONES.reached(start, now)
+        if days is not None and record.unreachable_at is None:
+            result = send_throttled(
+                bot, user_id, MILESTONE_TEXT.format(days=days), reply_markup=MAIN_KEYBOARD
             )
-            return
+            counts[result] += 1
+            BULK_SENDS.inc("milestone", result)
+        MILESTONES.push(user_id, start, now)
+    store.set_meta(MILESTONES_META_KEY, now)
+    logger.info(
+        f"Milestones done: sent={counts[SEND_SENT]} failed={counts[SEND_FAILED]} "
+        f"newly_blocked={counts[SEND_BLOCKED]} stale={stale}"
+    )
 
-        notes[idx] = text
-        update_user_record(user_id, notes=notes)
 
-        WAITING_FOR_NOTE_EDIT_TEXT.discard(user_id)
-        NOTE_EDIT_INDEX.pop(user_id, None)
+def send_milestones(context: CallbackContext):
+    now = now_ts()
+    entries = MILESTONES.pop_due(now)
+    if not entries:
+        return
+    # بعد توقف طويل قد تكون الدفعة كبيرة، فلا نحجز ثريد job_queue
+    Thread(
+        target=_send_milestones,
+        args=(context.bot, entries, now),
+        name="milestones",
+        daemon=True,
+    ).start()
+
+# =================== تذكير غير النشطين ===================
+#
+# المستخدمون موزعون على مستويات حسب آخر نشاط: _tiers[0] النشطون، و_tiers[i]
+# من وصلتهم رسالة المستوى i (غياب RE_ENGAGE_DAYS[i-1] يوم). كل مستوى
+# OrderedDict مرتب حسب last_active (الأقدم أولًا)، وget_user_record ينقل
+# المستخدم لآخر _tiers[0] بـ O(1) مع كل رسالة.
+# المسح كل RE_ENGAGE_INTERVAL ثانية يأخذ من بداية كل مستوى فقط من تجاوز
+# حده منذ المسح السابق ويتوقف عند أول من لم يتجاوزه، فتكلفته بعدد من
+# عبروا حدًا وليس بعدد المستخدمين. كل مستخدم يصله كل مستوى مرة واحدة لكل
+# فترة غياب؛ لو رجع يعود لـ _tiers[0] من جديد.
+
+RE_ENGAGE_DAYS = tuple(
+    sorted(int(d) for d in os.getenv("RE_ENGAGE_DAYS", "3,7,30").split(",") if d.strip())
+)
+RE_ENGAGE_INTERVAL = int(os.getenv("RE_ENGAGE_INTERVAL", "3600"))
+RE_ENGAGE_META_KEY = "re_engage_swept_at"
+
+# نص لكل مستوى بالترتيب؛ المستويات الزائدة تأخذ آخر نص
+RE_ENGAGE_TEXTS = (
+    "👋 افتقدناك! مرت {days} أيام من آخر زيارة لك.\n"
+    "كيف حالك؟ اضغط «عداد الأيام 🗓» وشوف كم قطعت من رحلتك 🤍",
+    "🌱 مر أسبوع ({days} أيام) بدون ما نسمع منك.\n"
+    "لو مرّيت بوقت صعب فهذا طبيعي، المهم أن ترجع. نحن هنا متى احتجت 💪",
+    "🤍 مر {days} يوم من آخر زيارة.\n"
+    "الباب مفتوح دائمًا، وكل بداية جديدة تُحسب. اضغط أي زر لنكمل معًا.",
+)
 
-        msg.reply_text(
-            "✅ تم تعديل الملاحظة بنجاح.\n"
-            "تقدر ترجع لـ «ملاحظاتي 📓» لو حاب تشوف التغييرات.",
+
+class InactivityTiers:
+    def __init__(self, days):
+        self.days = days
+        self.thresholds = [d * 86400 for d in days]
+        self._lock = Lock()
+        self._tiers = [OrderedDict() for _ in range(len(days) + 1)]
+
+    def __len__(self):
+        return sum(len(tier) for tier in self._tiers)
+
+    def load(self, pairs, swept_at):
+        """يوزّع المستخدمين حسب آخر مسح: من تجاوز حدًا قبله وصلته رسالته."""
+        tiers = [OrderedDict() for _ in range(len(self.days) + 1)]
+        for user_id, last_active in sorted(pairs, key=lambda p: p[1] or 0):
+            last_active = last_active or 0
+            level = sum(1 for t in self.thresholds if last_active <= swept_at - t)
+            tiers[level][user_id] = last_active
+        with self._lock:
+            self._tiers = tiers
+
+    def touch(self, user_id, ts):
+        with self._lock:
+            active = self._tiers[0]
+            if user_id in active:
+                active.move_to_end(user_id)
+            else:
+                for tier in self._tiers[1:]:
+                    if tier.pop(user_id, None) is not None:
+                        break
+            active[user_id] = ts
+
+    def is_active(self, user_id):
+        with self._lock:
+            return user_id in self._tiers[0]
+
+    def sweep(self, now):
+        """ينقل من تجاوز حدًا للمستوى التالي، ويرجع {user_id: أعلى مستوى وصله}."""
+        crossed = {}
+        with self._lock:
+            for level, threshold in enumerate(self.thresholds):
+                src, dst = self._tiers[level], self._tiers[level + 1]
+                cutoff = now - threshold
+                while src:
+                    user_id, last_active = next(iter(src.items()))
+                    if last_active > cutoff:
+                        break
+                    del src[user_id]
+                    dst[user_id] = last_active
+                    crossed[user_id] = level + 1
+        return crossed
+
+
+def _load_re_engage(rows):
+    started = monotonic()
+    tiers = InactivityTiers(RE_ENGAGE_DAYS)
+    swept_at = store.get_meta(RE_ENGAGE_META_KEY)
+    if swept_at is None:
+        # أول تشغيل: لا نرسل لكل الغائبين دفعة واحدة
+        swept_at = now_ts()
+        store.set_meta(RE_ENGAGE_META_KEY, swept_at)
+    tiers.load([(row[0], row[2]) for row in rows], swept_at)
+    logger.info(f"Inactivity tiers built: {len(tiers)} users in {monotonic() - started:.2f}s")
+    return tiers
+
+
+RE_ENGAGE = _load_re_engage(STARTUP_ROWS)
+# آخر فهرس يُبنى من مرور التشغيل المشترك
+del STARTUP_ROWS
+
+
+def _send_re_engagement(bot, crossed, now):
+    counts = {SEND_SENT: 0, SEND_FAILED: 0, SEND_BLOCKED: 0}
+    for user_id, level in crossed.items():
+        if RE_ENGAGE.is_active(user_id):
+            continue  # رجع بعد المسح
+        record = store.get(user_id)
+        if record is None:
+            continue
+        _apply_pending(user_id, record)
+        if record.unreachable_at is not None:
+            continue
+        text = RE_ENGAGE_TEXTS[min(level, len(RE_ENGAGE_TEXTS)) - 1]
+        result = send_throttled(
+            bot,
+            user_id,
+            text.format(days=RE_ENGAGE_DAYS[level - 1]),
             reply_markup=MAIN_KEYBOARD,
         )
+        counts[result] += 1
+        BULK_SENDS.inc("re_engage", result)
+    store.set_meta(RE_ENGAGE_META_KEY, now)
+    logger.info(
+        f"Re-engagement done: crossed={len(crossed)} sent={counts[SEND_SENT]} "
+        f"failed={counts[SEND_FAILED]} newly_blocked={counts[SEND_BLOCKED]}"
+    )
+
+
+def re_engage_inactive(context: CallbackContext):
+    now = now_ts()
+    crossed = RE_ENGAGE.sweep(now)
+    if not crossed:
         return
+    Thread(
+        target=_send_re_engagement,
+        args=(context.bot, crossed, now),
+        name="re-engage",
+        daemon=True,
+    ).start()
+
+# =================== البروفايلر (أخذ عينات) ===================
+#
+# /profile [ثواني] (للأدمن فقط) يشغّل ثريد يأخذ عينة من stack كل الثريدات
+# (dispatcher، workers، job_queue، Flask...) كل PROFILE_INTERVAL ثانية عبر
+# sys._current_frames()، ثم يرسل النتيجة كملف collapsed stacks
+# (سطر لكل stack: "thread;func;func… عدد") يُفتح مباشرة في flamegraph.pl
+# أو speedscope. لا يوجد أي hook أو تكلفة لما البروفايلر متوقف.
+
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+
+_profile_lock = Lock()
+_profile_thread = None
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    """يرجع (dict من collapsed stack → عدد العينات، عدد الجولات)."""
+    me = get_ident()
+    stacks = {}
+    rounds = 0
+    deadline = monotonic() + seconds
+    while monotonic() < deadline:
+        names = {t.ident: t.name for t in enumerate_threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            parts = []
+            while frame is not None:
+                parts.append(_frame_label(frame))
+                frame = frame.f_back
+            parts.append(names.get(ident, str(ident)))
+            key = ";".join(reversed(parts))
+            stacks[key] = stacks.get(key, 0) + 1
+        rounds += 1
+        sleep(interval)
+    return stacks, rounds
+
+
+def _run_profile(bot, seconds):
+    global _profile_thread
+    try:
+        stacks, rounds = sample_stacks(seconds)
+        body = "".join(
+            f"{stack} {count}\n"
+            for stack, count in sorted(stacks.items(), key=lambda kv: -kv[1])
+        )
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        bot.send_document(
+            chat_id=ADMIN_ID,
+            document=BytesIO(body.encode("utf-8")),
+            filename=f"profile-{stamp}.collapsed",
+            caption=f"🧪 {rounds} عينة خلال {seconds} ثانية ({len(stacks)} stack مختلف)",
+        )
+        logger.info(f"Profile finished: {rounds} rounds, {len(stacks)} distinct stacks")
+    except Exception as e:
+        logger.error(f"Profiling failed: {e}")
+    finally:
+        with _profile_lock:
+            _profile_thread = None
 
-    # 6️⃣ اختيار رقم ملاحظة للحذف
-    if user_id in WAITING_FOR_NOTE_DELETE:
-        notes = record.get("notes", [])
-        try:
-            idx = int(text) - 1
-            if idx < 0 or idx >= len(notes):
-                raise ValueError()
-        except ValueError:
-            kb = ReplyKeyboardMarkup(
-                [[KeyboardButton(BTN_CANCEL)]],
-                resize_keyboard=True,
-            )
-            msg.reply_text(
-                "رجاءً أرسل رقم صحيح من القائمة، أو اضغط «إلغاء ❌».",
-                reply_markup=kb,
-            )
+
+def profile_command(update: Update, context: CallbackContext):
+    user = update.effective_user
+    if not is_admin(user.id):
+        update.message.reply_text("هذه الميزة خاصة بالمشرف فقط 👨‍💻", reply_markup=MAIN_KEYBOARD)
+        return
+
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+        if seconds <= 0:
+            raise ValueError()
+    except ValueError:
+        update.message.reply_text("الاستخدام: /profile [عدد الثواني]")
+        return
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+
+    global _profile_thread
+    with _profile_lock:
+        if _profile_thread is not None:
+            update.message.reply_text("⏳ فيه بروفايل شغّال حاليًا، انتظر حتى ينتهي.")
             return
+        _profile_thread = Thread(
+            target=_run_profile, args=(context.bot, seconds), name="profiler", daemon=True
+        )
+        _profile_thread.start()
+
+    update.message.reply_text(f"🧪 بدأ أخذ العينات لمدة {seconds} ثانية، سيصلك الملف عند الانتهاء.")
+
+# =================== تصدير البيانات ===================
+#
+# /export [active=أيام] [streak=أيام] [reachable] [only=user,note,rating]
+# (للأدمن فقط) يكتب ملف JSONL مضغوط بـ gzip، سطر لكل سجل:
+#   {"type": "user", "user_id", ...}  بيانات المستخدم بدون الملاحظات والتقييمات
+#   {"type": "note", "user_id", "idx", "text"}
+#   {"type": "rating", "user_id", "date", "value"}
+# ثم يرسله للأدمن كمستند. السجلات تُقرأ من store.iter_records() وتُكتب
+# واحد واحد، فالذاكرة ثابتة مهما كان عدد المستخدمين، والتصدير كله في ثريد
+# مستقل فلا يعطّل تحديثات باقي المستخدمين.
+# مع العمال: كل عامل يكتب ملف شارده، وعامل الأدمن يلصقها (ملفات gzip
+# المتتالية ملف gzip صالح) بدون فك الضغط.
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+EXPORT_TIMEOUT = float(os.getenv("EXPORT_TIMEOUT", "600"))
+EXPORT_KINDS = ("user", "note", "rating")
+EXPORT_USAGE = "الاستخدام: /export [active=أيام] [streak=أيام] [reachable] [only=user,note,rating]"
+
+_export_lock = Lock()
+_export_thread = None
+
+
+def parse_export_args(args):
+    """يحوّل وسائط /export لـ dict فلاتر؛ ValueError لو فيها خطأ."""
+    filters = {"active_days": None, "streak_days": None, "reachable": False, "kinds": EXPORT_KINDS}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if key == "active" and value:
+            filters["active_days"] = int(value)
+        elif key == "streak" and value:
+            filters["streak_days"] = int(value)
+        elif key == "reachable" and not value:
+            filters["reachable"] = True
+        elif key == "only" and value:
+            kinds = tuple(value.split(","))
+            if not set(kinds) <= set(EXPORT_KINDS):
+                raise ValueError(value)
+            filters["kinds"] = kinds
+        else:
+            raise ValueError(arg)
+    return filters
+
+
+def _export_match(record, filters, now):
+    if filters["reachable"] and record.unreachable_at is not None:
+        return False
+    days = filters["active_days"]
+    if days is not None and (record.last_active or 0) < now - days * 86400:
+        return False
+    days = filters["streak_days"]
+    if days is not None and (
+        record.streak_start is None or record.streak_start > now - days * 86400
+    ):
+        return False
+    return True
+
+
+def _export_lines(record, kinds):
+    if "user" in kinds:
+        d = record.to_dict()
+        del d["notes"], d["ratings"]
+        yield {"type": "user", **d}
+    if "note" in kinds:
+        for idx, text in enumerate(list(record.notes)):
+            yield {"type": "note", "user_id": record.user_id, "idx": idx, "text": text}
+    if "rating" in kinds:
+        for day, value in list(record.ratings):
+            yield {
+                "type": "rating",
+                "user_id": record.user_id,
+                "date": datetime.fromtimestamp(day * 86400, timezone.utc).date().isoformat(),
+                "value": value,
+            }
 
-        deleted = notes.pop(idx)
-        update_user_record(user_id, notes=notes)
-        WAITING_FOR_NOTE_DELETE.discard(user_id)
 
-        msg.reply_text(
-            f"🗑 تم حذف الملاحظة:\n\n{deleted}",
-            reply_markup=MAIN_KEYBOARD,
+def export_shard(name, filters, now):
+    """يكتب سجلات هذه العملية المطابقة للفلاتر ويرجع (المسار، عدد الأسطر لكل نوع)."""
+    # التعديلات المعلّقة تُكتب أولًا حتى يكون التصدير محدّثًا
+    flush_pending()
+    if WORKER_INDEX is not None:
+        name = f"{name}.part{WORKER_INDEX}"
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.abspath(os.path.join(EXPORT_DIR, name))
+    counts = dict.fromkeys(EXPORT_KINDS, 0)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for record in store.iter_records():
+            if not _export_match(record, filters, now):
+                continue
+            for line in _export_lines(record, filters["kinds"]):
+                f.write(json.dumps(line, ensure_ascii=False))
+                f.write("\n")
+                counts[line["type"]] += 1
+    return path, counts
+
+
+def _run_export(bot, filters):
+    global _export_thread
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    filename = f"qaher-export-{stamp}.jsonl.gz"
+    started = monotonic()
+    parts = []
+    path = None
+    try:
+        parts = call_workers("export", filename, filters, now_ts(), timeout=EXPORT_TIMEOUT)
+        if len(parts) < WORKER_PROCESSES:
+            raise RuntimeError(f"only {len(parts)} of {WORKER_PROCESSES} workers exported")
+        if len(parts) == 1:
+            path = parts[0][0]
+        else:
+            path = os.path.abspath(os.path.join(EXPORT_DIR, filename))
+            with open(path, "wb") as out:
+                for part, _ in parts:
+                    with open(part, "rb") as f:
+                        shutil.copyfileobj(f, out)
+        counts = dict.fromkeys(EXPORT_KINDS, 0)
+        for _, part_counts in parts:
+            for kind, count in part_counts.items():
+                counts[kind] += count
+        with open(path, "rb") as f:
+            bot.send_document(
+                chat_id=ADMIN_ID,
+                document=f,
+                filename=filename,
+                caption=(
+                    f"📦 المستخدمين: {counts['user']} — الملاحظات: {counts['note']} "
+                    f"— التقييمات: {counts['rating']}"
+                ),
+            )
+        logger.info(
+            f"Export finished in {monotonic() - started:.1f}s: {counts}, "
+            f"{os.path.getsize(path)} bytes"
         )
+    except Exception as e:
+        logger.error(f"Export failed: {e}")
+        try:
+            bot.send_message(chat_id=ADMIN_ID, text=f"❌ فشل التصدير: {e}")
+        except Exception:
+            pass
+    finally:
+        for leftover in {part for part, _ in parts} | ({path} if path else set()):
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
+        with _export_lock:
+            _export_thread = None
+
+
+def export_command(update: Update, context: CallbackContext):
+    user = update.effective_user
+    if not is_admin(user.id):
+        update.message.reply_text("هذه الميزة خاصة بالمشرف فقط 👨‍💻", reply_markup=MAIN_KEYBOARD)
         return
 
-    # 7️⃣ وضع "تواصل مع الدعم"
-    if user_id in WAITING_FOR_SUPPORT:
-        WAITING_FOR_SUPPORT.discard(user_id)
+    try:
+        filters = parse_export_args(context.args or [])
+    except ValueError:
+        update.message.reply_text(EXPORT_USAGE)
+        return
 
-        support_msg = (
-            "📩 *رسالة جديدة للدعم:*\n\n"
-            f"👤 الاسم: {user.full_name}\n"
-            f"🆔 ID: `{user_id}`\n"
-            f"🔹 اسم المستخدم: @{user.username if user.username else 'لا يوجد'}\n\n"
-            f"✉️ محتوى الرسالة:\n{text}"
+    global _export_thread
+    with _export_lock:
+        if _export_thread is not None:
+            update.message.reply_text("⏳ فيه تصدير شغّال حاليًا، انتظر حتى ينتهي.")
+            return
+        _export_thread = Thread(
+            target=_run_export, args=(context.bot, filters), name="export", daemon=True
         )
+        _export_thread.start()
 
-        if ADMIN_ID is not None:
-            try:
-                context.bot.send_message(
-                    chat_id=ADMIN_ID, text=support_msg, parse_mode="Markdown"
-                )
-            except Exception as e:
-                logger.error(f"Error sending support message to admin: {e}")
+    update.message.reply_text("📦 بدأ التصدير، سيصلك الملف عند الانتهاء.")
 
-        msg.reply_text(
-            "✅ تم إرسال رسالتك للدعم.\n"
-            "سيتم التواصل معك إن لزم الأمر 🤍",
+# =================== هاندلر الرسائل ===================
+#
+# كل رسالة = lookup واحد لحالة المستخدم ثم lookup واحد في جدول التوجيه:
+#   STATE_HANDLERS[(state, text)] → زر محدد داخل حالة
+#   STATE_DEFAULT_HANDLERS[state] → أي نص آخر داخل الحالة
+#   BUTTON_HANDLERS[text]         → الأزرار الرئيسية بدون حالة
+# هاندلرات الحالات تأخذ (update, context, text, data).
+
+
+# 5️⃣ استلام النص الجديد بعد الضغط على ✏️ في صفحة الملاحظات
+
+
+def _note_edit_text(update, context, text, data):
+    user_id = update.effective_user.id
+    clear_state(user_id)
+    data = data or {}
+    idx = data.get("idx")
+    notes, _ = store.get_notes_page(user_id, idx, 1) if idx is not None else ([], 0)
+    # الملاحظة تغيّرت أو انحذفت منذ الضغط على ✏️ → لا نعدّل ملاحظة أخرى
+    stale = not notes or ("tag" in data and _note_tag(notes[0]) != data["tag"])
+    if stale or not edit_note(user_id, idx, text):
+        # لو حصل لخبطة نرجع للقائمة الرئيسية
+        update.message.reply_text(
+            "حصل خطأ بسيط في اختيار الملاحظة، جرّب مرة أخرى من «ملاحظاتي 📓».",
             reply_markup=MAIN_KEYBOARD,
         )
         return
 
-    # 8️⃣ وضع "رسالة جماعية"
-    if user_id in WAITING_FOR_BROADCAST:
-        WAITING_FOR_BROADCAST.discard(user_id)
+    update.message.reply_text(
+        "✅ تم تعديل الملاحظة بنجاح.\n"
+        "تقدر ترجع لـ «ملاحظاتي 📓» لو حاب تشوف التغييرات.",
+        reply_markup=MAIN_KEYBOARD,
+    )
 
-        if not is_admin(user_id):
-            msg.reply_text(
-                "هذه الميزة خاصة بالمشرف فقط 👨‍💻", reply_markup=MAIN_KEYBOARD
-            )
-            return
 
-        user_ids = get_all_user_ids()
-        sent = 0
-        for uid in user_ids:
-            try:
-                context.bot.send_message(
-                    chat_id=uid,
-                    text=f"📢 رسالة من الدعم:\n\n{text}",
-                )
-                sent += 1
-            except Exception as e:
-                logger.error(f"Error sending broadcast to {uid}: {e}")
+# 7️⃣ وضع "تواصل مع الدعم"
 
-        msg.reply_text(
-            f"✅ تم إرسال الرسالة إلى {sent} مستخدم.",
-            reply_markup=MAIN_KEYBOARD,
-        )
+
+def _support_message(update, context, text, data):
+    user = update.effective_user
+    clear_state(user.id)
+
+    support_msg = (
+        "📩 *رسالة جديدة للدعم:*\n\n"
+        f"👤 الاسم: {user.full_name}\n"
+        f"🆔 ID: `{user.id}`\n"
+        f"🔹 اسم المستخدم: @{user.username if user.username else 'لا يوجد'}\n\n"
+        f"✉️ محتوى الرسالة:\n{text}"
+    )
+
+    if ADMIN_ID is not None:
+        try:
+            notify_admin(context.bot, user.id, support_msg, parse_mode="Markdown")
+        except Exception as e:
+            logger.error(f"Error sending support message to admin: {e}")
+
+    update.message.reply_text(
+        "✅ تم إرسال رسالتك للدعم.\n"
+        "سيتم التواصل معك إن لزم الأمر 🤍",
+        reply_markup=MAIN_KEYBOARD,
+    )
+
+
+# 8️⃣ وضع "رسالة جماعية": اختيار الشريحة ومعاينة عددها، ثم نص الرسالة
+
+
+def _broadcast_segment(update, context, text, data):
+    user_id = update.effective_user.id
+    msg = update.message
+
+    if not is_admin(user_id):
+        clear_state(user_id)
+        msg.reply_text("هذه الميزة خاصة بالمشرف فقط 👨‍💻", reply_markup=MAIN_KEYBOARD)
         return
 
-    # 9️⃣ وضع "إضافة ملاحظة جديدة"
-    if user_id in WAITING_FOR_NOTE:
-        notes = record.get("notes", [])
-        notes.append(text)
-        update_user_record(user_id, notes=notes)
+    try:
+        segment = {} if text == BTN_ALL_USERS else parse_segment(text)
+    except ValueError:
+        msg.reply_text("⚠️ لم أفهم الشروط.\n\n" + SEGMENT_USAGE, reply_markup=SEGMENT_KEYBOARD)
+        return
 
+    started = monotonic()
+    count = count_segment(segment)
+    logger.info(f"Segment preview {segment}: {count} users in {monotonic() - started:.3f}s")
+    if count == 0:
         msg.reply_text(
-            "📝 تم حفظ ملاحظتك.\n"
-            "استخدم زر «ملاحظاتي 📓» لعرض آخر ما كتبت.",
-            reply_markup=MAIN_KEYBOARD,
+            f"👥 الشريحة ({describe_segment(segment)}) فارغة، جرّب شروطًا أخرى.",
+            reply_markup=SEGMENT_KEYBOARD,
         )
-        WAITING_FOR_NOTE.discard(user_id)
         return
 
-    # 🔟 وضع "تقييم اليوم"
-    if user_id in WAITING_FOR_RATING:
-        if text not in {"1", "2", "3", "4", "5"}:
-            msg.reply_text(
-                "رجاءً اختر رقم من 1 إلى 5 ⭐\nأو اضغط «إلغاء ❌».",
-                reply_markup=ReplyKeyboardMarkup(
-                    [
-                        [KeyboardButton("1"), KeyboardButton("2"), KeyboardButton("3")],
-                        [KeyboardButton("4"), KeyboardButton("5")],
-                        [KeyboardButton(BTN_CANCEL)],
-                    ],
-                    resize_keyboard=True,
-                ),
-            )
-            return
+    set_state(user_id, STATE_BROADCAST, {"segment": segment, "count": count})
+    msg.reply_text(
+        f"👥 الشريحة: {describe_segment(segment)}\n"
+        f"عدد المستلمين: {count}\n\n"
+        "📢 اكتب الآن الرسالة لإرسالها لهم، أو اضغط «إلغاء ❌».",
+        reply_markup=CANCEL_KEYBOARD,
+    )
 
-        rating_value = int(text)
-        ratings = record.get("ratings", [])
-        ratings.append(
-            {
-                "value": rating_value,
-                "at": datetime.now(timezone.utc).isoformat(),
-            }
-        )
-        update_user_record(user_id, ratings=ratings)
 
+def _broadcast_message(update, context, text, data):
+    user_id = update.effective_user.id
+    msg = update.message
+    clear_state(user_id)
+
+    if not is_admin(user_id):
+        msg.reply_text("هذه الميزة خاصة بالمشرف فقط 👨‍💻", reply_markup=MAIN_KEYBOARD)
+        return
+
+    segment = (data or {}).get("segment")
+    if not start_broadcast(context.bot, msg.chat_id, text, segment):
         msg.reply_text(
-            f"⭐ تم تسجيل تقييمك لليوم: {rating_value}/5\n"
-            "شكرًا لصدقك مع نفسك، هذا يساعدك تفهم نمط أيامك أكثر 🌿.",
+            "⏳ فيه رسالة جماعية قيد الإرسال حاليًا، انتظر حتى تنتهي.",
             reply_markup=MAIN_KEYBOARD,
         )
-        WAITING_FOR_RATING.discard(user_id)
         return
 
-    # 1️⃣1️⃣ وضع "تعيين بداية التعافي"
-    if user_id in WAITING_FOR_CUSTOM_START:
-        try:
-            days = int(text)
-            if days < 0:
-                raise ValueError()
-        except ValueError:
-            msg.reply_text(
-                "رجاءً أرسل رقم أيام صحيح (مثال: 7) أو اضغط «إلغاء ❌».",
-                reply_markup=ReplyKeyboardMarkup(
-                    [[KeyboardButton(BTN_CANCEL)]], resize_keyboard=True
-                ),
-            )
-            return
+    msg.reply_text(
+        "📢 بدأ إرسال الرسالة الجماعية في الخلفية.\n"
+        "سيصلك تحديث بالتقدّم وملخص عند الانتهاء.",
+        reply_markup=MAIN_KEYBOARD,
+    )
 
-        now = datetime.now(timezone.utc)
-        start_dt = now - timedelta(days=days)
-        update_user_record(user_id, streak_start=start_dt.isoformat())
 
-        human = format_streak_text(now - start_dt)
-        msg.reply_text(
-            f"⏱ تم تعيين بداية التعافي منذ {human}.\n"
-            "سيتم احتساب العداد بناءً على هذه المدة 🌟.",
-            reply_markup=MAIN_KEYBOARD,
+# 9️⃣ وضع "إضافة ملاحظة جديدة"
+
+
+def _note_add_text(update, context, text, data):
+    user_id = update.effective_user.id
+    add_note(user_id, text)
+    clear_state(user_id)
+    update.message.reply_text(
+        "📝 تم حفظ ملاحظتك.\n"
+        "استخدم زر «ملاحظاتي 📓» لعرض آخر ما كتبت.",
+        reply_markup=MAIN_KEYBOARD,
+    )
+
+
+# 🔟 وضع "تقييم اليوم"
+
+
+def _rating_value(update, context, text, data):
+    user_id = update.effective_user.id
+    rating_value = int(text)
+    old, ratings = set_daily_rating(user_id, rating_value)
+    clear_state(user_id)
+
+    avg7, avg30, trend = ratings.summary(ts_day(now_ts()))
+    replaced = f" (بدل {old}/5)" if old is not None else ""
+    if trend is None or abs(trend) < 0.25:
+        trend_text = "➡️ مستقر"
+    elif trend > 0:
+        trend_text = "📈 في تحسّن"
+    else:
+        trend_text = "📉 في تراجع"
+
+    update.message.reply_text(
+        f"⭐ تم تسجيل تقييمك لليوم: {rating_value}/5{replaced}\n"
+        "شكرًا لصدقك مع نفسك، هذا يساعدك تفهم نمط أيامك أكثر 🌿.\n\n"
+        f"📊 متوسط آخر 7 أيام: {avg7:.1f} | آخر 30 يوم: {avg30:.1f}\n"
+        f"الاتجاه: {trend_text}",
+        reply_markup=MAIN_KEYBOARD,
+    )
+
+
+def _rating_other(update, context, text, data):
+    update.message.reply_text(
+        "رجاءً اختر رقم من 1 إلى 5 ⭐\nأو اضغط «إلغاء ❌».",
+        reply_markup=RATING_KEYBOARD,
+    )
+
+
+# 1️⃣1️⃣ وضع "تعيين بداية التعافي"
+
+
+def _custom_start_days(update, context, text, data):
+    user_id = update.effective_user.id
+    try:
+        days = int(text)
+        if days < 0:
+            raise ValueError()
+    except ValueError:
+        update.message.reply_text(
+            "رجاءً أرسل رقم أيام صحيح (مثال: 7) أو اضغط «إلغاء ❌».",
+            reply_markup=CANCEL_KEYBOARD,
         )
-        WAITING_FOR_CUSTOM_START.discard(user_id)
         return
 
+    seconds = days * 86400
+    update_user_record(user_id, flush=True, streak_start=now_ts() - seconds)
+    clear_state(user_id)
+
+    human = format_streak_text(seconds)
+    update.message.reply_text(
+        f"⏱ تم تعيين بداية التعافي منذ {human}.\n"
+        "سيتم احتساب العداد بناءً على هذه المدة 🌟.",
+        reply_markup=MAIN_KEYBOARD,
+    )
+
+
+STATE_HANDLERS = {
+    (STATE_RATING, "1"): _rating_value,
+    (STATE_RATING, "2"): _rating_value,
+    (STATE_RATING, "3"): _rating_value,
+    (STATE_RATING, "4"): _rating_value,
+    (STATE_RATING, "5"): _rating_value,
+}
+
+STATE_DEFAULT_HANDLERS = {
+    STATE_NOTE_EDIT_TEXT: _note_edit_text,
+    STATE_SUPPORT: _support_message,
+    STATE_BROADCAST_SEGMENT: _broadcast_segment,
+    STATE_BROADCAST: _broadcast_message,
+    STATE_NOTE_ADD: _note_add_text,
+    STATE_RATING: _rating_other,
+    STATE_CUSTOM_START: _custom_start_days,
+}
+
+# 1️⃣3️⃣ الأزرار الرئيسية
+BUTTON_HANDLERS = {
+    BTN_START: start_command,
+    BTN_COUNTER: handle_days_counter,
+    BTN_TIP: handle_tip,
+    BTN_EMERGENCY: handle_emergency,
+    BTN_RELAPSE: handle_relapse_reasons,
+    BTN_DHIKR: handle_adhkar,
+    BTN_NOTES: handle_notes,
+    BTN_RESET: handle_reset_counter,
+    BTN_SUPPORT: handle_contact_support,
+    BTN_BROADCAST: handle_broadcast_button,
+    BTN_STATS: handle_stats_button,
+    BTN_RATING: handle_rating_button,
+    BTN_SET_START: handle_set_start_button,
+}
+
+
+def handle_text_message(update: Update, context: CallbackContext):
+    user = update.effective_user
+    user_id = user.id
+    msg = update.message
+    text = (msg.text or "").strip()
+
+    get_user_record(user)
+
+    # 1️⃣ زر الإلغاء العام
+    if text == BTN_CANCEL:
+        clear_state(user_id)
+        CANCELLED_REPLY.send(update)
+        return
+
+    # 2️⃣ رد الأدمن على رسالة في محادثة دعم → يرسل للمستخدم
+    if is_admin(user_id) and msg.reply_to_message:
+        target_id = support_thread_user(msg.reply_to_message)
+        if target_id is not None:
+            try:
+                context.bot.send_message(
+                    chat_id=target_id,
+                    text=f"💌 رد من الدعم:\n\n{text}",
+                    reply_markup=MAIN_KEYBOARD,
+                )
+                confirmation = msg.reply_text(
+                    "✅ تم إرسال ردّك للمستخدم.",
+                    reply_markup=MAIN_KEYBOARD,
+                )
+                # الرد على رد الأدمن أو على التأكيد يكمل نفس المحادثة
+                remember_support_thread(msg.message_id, target_id)
+                remember_support_thread(confirmation.message_id, target_id)
+            except Exception as e:
+                logger.error(f"Error sending admin reply to {target_id}: {e}")
+                msg.reply_text(
+                    "حدث خطأ أثناء إرسال الرد للمستخدم ⚠️.",
+                    reply_markup=MAIN_KEYBOARD,
+                )
+            return
+
+    # 3️⃣ - 1️⃣1️⃣ المستخدم داخل حالة محادثة
+    state, data = get_state(user_id)
+    if state is not None:
+        handler = STATE_HANDLERS.get((state, text)) or STATE_DEFAULT_HANDLERS.get(state)
+        if handler is None:
+            # حالة محفوظة من نسخة أقدم لم تعد موجودة → نتجاهلها ونكمل التوجيه
+            clear_state(user_id)
+        else:
+            STATE_MESSAGES.inc(state)
+            timed_call(handler, update, context, text, data)
+            return
+
     # 1️⃣2️⃣ رد المستخدم على رسالة من البوت (دعم/رسالة جماعية)
     if (
         not is_admin(user_id)
@@ -902,11 +4456,7 @@ def handle_text_message(update: Update, context: CallbackContext):
 
             if ADMIN_ID is not None:
                 try:
-                    context.bot.send_message(
-                        chat_id=ADMIN_ID,
-                        text=support_msg,
-                        parse_mode="Markdown",
-                    )
+                    notify_admin(context.bot, user_id, support_msg, parse_mode="Markdown")
                 except Exception as e:
                     logger.error(f"Error sending reply-on-broadcast to admin: {e}")
 
@@ -918,89 +4468,499 @@ def handle_text_message(update: Update, context: CallbackContext):
             return
 
     # 1️⃣3️⃣ الأزرار الرئيسية
-    if text == BTN_START:
-        start_command(update, context)
-        return
-    elif text == BTN_COUNTER:
-        handle_days_counter(update, context)
-        return
-    elif text == BTN_TIP:
-        handle_tip(update, context)
-        return
-    elif text == BTN_EMERGENCY:
-        handle_emergency(update, context)
-        return
-    elif text == BTN_RELAPSE:
-        handle_relapse_reasons(update, context)
-        return
-    elif text == BTN_DHIKR:
-        handle_adhkar(update, context)
-        return
-    elif text == BTN_NOTES:
-        handle_notes(update, context)
-        return
-    elif text == BTN_RESET:
-        handle_reset_counter(update, context)
-        return
-    elif text == BTN_SUPPORT:
-        handle_contact_support(update, context)
-        return
-    elif text == BTN_BROADCAST:
-        handle_broadcast_button(update, context)
-        return
-    elif text == BTN_STATS:
-        handle_stats_button(update, context)
-        return
-    elif text == BTN_RATING:
-        handle_rating_button(update, context)
-        return
-    elif text == BTN_SET_START:
-        handle_set_start_button(update, context)
+    handler = BUTTON_HANDLERS.get(text)
+    if handler is not None:
+        BUTTON_PRESSES.inc(handler.__name__)
+        timed_call(handler, update, context)
         return
 
     # 1️⃣4️⃣ أي رسالة عشوائية ليست زر ولا وضع خاص → تنبيه
-    msg.reply_text(
-        "⚠️ تنبيه: رسالتك هذه لا تصل للأدمن بشكل مباشر.\n"
-        "لو حاب تتواصل مع الدعم:\n"
-        "1️⃣ اضغط على زر «تواصل مع الدعم ✉️»\n"
-        "2️⃣ أو اضغط على الرسالة، ثم اختر Reply / الرد واكتب رسالتك",
-        reply_markup=MAIN_KEYBOARD,
-    )
+    UNROUTED_REPLY.send(update)
+
+# =================== معالجة التحديثات بالتوازي ===================
+#
+# الهاندلرات لا تشتغل على ثريد الـ dispatcher مباشرة، بل على ThreadPool
+# بحجم WORKERS. تحديثات نفس المستخدم تدخل طابور خاص به وتُنفَّذ بالترتيب
+# واحد بعد الآخر، فحالة المستخدم (CONVERSATIONS وغيرها) لا يلمسها إلا
+# ثريد واحد في أي لحظة، بينما مستخدم بطيء لا يعطّل باقي المستخدمين.
+
+WORKERS = int(os.getenv("WORKERS", "8"))
+
+
+class UserSerialExecutor:
+    def __init__(self, workers):
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="update-worker"
+        )
+        self._queues = {}  # user_id → deque من (fn, args)
+        self._lock = Lock()
+
+    def submit(self, user_id, fn, *args):
+        with self._lock:
+            queue = self._queues.get(user_id)
+            if queue is not None:
+                # فيه worker شغّال على هذا المستخدم، سيأخذها بعد الحالية
+                queue.append((fn, args))
+                return
+            self._queues[user_id] = deque([(fn, args)])
+        self._pool.submit(self._drain, user_id)
+
+    def _drain(self, user_id):
+        while True:
+            with self._lock:
+                queue = self._queues[user_id]
+                if not queue:
+                    del self._queues[user_id]
+                    return
+                fn, args = queue.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception(f"Error handling update for user {user_id}")
+
+    def queued(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+UPDATE_EXECUTOR = UserSerialExecutor(WORKERS)
+
+
+def run_per_user(handler):
+    """يغلّف هاندلر حتى يُنفَّذ على UPDATE_EXECUTOR بترتيب كل مستخدم."""
+
+    def callback(update: Update, context: CallbackContext):
+        user = update.effective_user
+        key = user.id if user else None
+        UPDATE_EXECUTOR.submit(key, timed_call, handler, update, context)
+
+    return callback
+
+# =================== استقبال التحديثات (Webhook) ===================
+#
+# لو WEBHOOK_URL موجود يسجّل البوت Webhook عند تليجرام ويستقبل التحديثات
+# على مسار WEBHOOK_PATH في نفس تطبيق Flask، وإلا يرجع لـ polling.
+# المسار يتحقق من ترويسة السر، يضع التحديث في طابور الـ dispatcher ويرد
+# فورًا؛ المعالجة نفسها على UPDATE_EXECUTOR كالعادة.
+#
+# للتجربة محليًا:
+#   curl -X POST localhost:10000/telegram/webhook \
+#        -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -H "Content-Type: application/json" -d @update.json
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # مثال: https://qaher-bot.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# يُضبط في main() عند تشغيل وضع الـ webhook فقط
+_webhook_updater = None
+
+
+@app.route(WEBHOOK_PATH, methods=["POST"])
+def telegram_webhook():
+    updater = _webhook_updater
+    if updater is None:
+        return "webhook mode is off", 404
+
+    token = request.headers.get(SECRET_HEADER, "")
+    # compare_digest على str يرمي TypeError لو فيها غير ASCII، فنقارن bytes
+    if not hmac.compare_digest(token.encode("utf-8"), WEBHOOK_SECRET.encode("utf-8")):
+        logger.warning(f"Rejected webhook call from {request.remote_addr}: bad secret")
+        return "forbidden", 403
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return "bad request", 400
+
+    updater.update_queue.put(Update.de_json(payload, updater.bot))
+    return "", 200
+
+
+def start_dispatcher(updater: Updater):
+    """تشغيل job_queue والـ dispatcher بدون polling (webhook / عامل)."""
+    updater.running = True
+    updater.job_queue.start()
+    dispatcher_ready = Event()
+    Thread(
+        target=updater.dispatcher.start,
+        kwargs={"ready": dispatcher_ready},
+        name="dispatcher",
+        daemon=True,
+    ).start()
+    dispatcher_ready.wait()
+
+
+def start_webhook(updater: Updater):
+    """تشغيل الـ dispatcher وتسجيل الـ webhook بدل start_polling."""
+    global _webhook_updater
+
+    start_dispatcher(updater)
+    _webhook_updater = updater
+
+    url = WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH
+    # لا نحذف الـ webhook عند الإيقاف: تليجرام يحتفظ بالتحديثات ويعيد
+    # المحاولة حتى يرجع البوت بعد إعادة التشغيل.
+    updater.bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET)
+    logger.info(f"Webhook set to {url}")
+
+# =================== العمليات المتعددة ===================
+#
+# WORKER_PROCESSES=N (> 1) يشغّل عملية أمامية + N عامل (multiprocessing/spawn):
+#   • الأمامية تستقبل التحديثات (polling أو webhook) ولا تلمس البيانات؛
+#     route_update يرسل كل تحديث لطابور العامل user_id % N.
+#   • كل عامل عملية Python كاملة (GIL مستقل) فيها store وANALYTICS
+#     وCONVERSATIONS والفهارس لشارده فقط، داخل WORKERS_DIR/<رقم>، ويرد
+#     على المستخدمين مباشرة. تحديثات نفس المستخدم تصل لنفس العامل بالترتيب.
+#   • العمليات المشتركة تمر على call_workers: الإحصائيات ومقاييس /metrics
+#     وقائمة المستخدمين للرسالة الجماعية (التي تشتغل في عامل الأدمن) تُجمع
+#     من كل العمال، وmark_unreachable يُرسل للعامل صاحب المستخدم.
+#   • OUTBOUND_BUCKET مشترك بين العمال (shared memory) فيبقى الحد العام
+#     لتيليجرام كما هو مهما كان عدد العمال.
+# أول تشغيل بهذا الوضع يوزّع بيانات المجلد الحالي على العمال مرة واحدة؛
+# تغيير N بعدها يحتاج إعادة توزيع يدوية.
+#
+# الرسائل بين العمليات (tuples على multiprocessing.Queue):
+#   ("update", dict)                        → تحديث للعامل
+#   ("call", call_id, reply_to, name, args) → تنفيذ FAN_OUT_CALLS[name]
+#   ("result", call_id, worker, ok, value)  → رد على call
+#   ("stop",)
+
+FAN_OUT_TIMEOUT = float(os.getenv("FAN_OUT_TIMEOUT", "30"))
+WORKERS_SPLIT_META_KEY = "workers_split"
+
+# طابور لكل عامل، وآخرها للعملية الأمامية؛ فارغة بدون عمال
+_PROCESS_INBOXES = []
+_rpc_calls = {}  # call_id → {"done", "expected", "results"}
+_rpc_lock = Lock()
+_rpc_next_id = 0
+_RPC_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rpc")
+
+
+def worker_for(user_id: int) -> int:
+    return user_id % WORKER_PROCESSES
+
+
+def owns_user(user_id: int) -> bool:
+    return WORKER_INDEX is None or worker_for(user_id) == WORKER_INDEX
+
+
+def call_workers(name, *args, timeout=FAN_OUT_TIMEOUT):
+    """ينفّذ FAN_OUT_CALLS[name] في كل عامل ويرجع النتائج مرتبة حسب رقم العامل.
+
+    بدون عمال = استدعاء محلي واحد. العامل الذي لا يرد خلال timeout ثانية
+    يُستبعد من النتائج.
+    """
+    global _rpc_next_id
+    if not _PROCESS_INBOXES:
+        return [FAN_OUT_CALLS[name](*args)]
+
+    me = WORKER_PROCESSES if WORKER_INDEX is None else WORKER_INDEX
+    remote = [i for i in range(WORKER_PROCESSES) if i != WORKER_INDEX]
+    call = {"done": Event(), "expected": len(remote), "results": {}}
+    with _rpc_lock:
+        call_id = _rpc_next_id
+        _rpc_next_id += 1
+        _rpc_calls[call_id] = call
+    for i in remote:
+        _PROCESS_INBOXES[i].put(("call", call_id, me, name, args))
+
+    results = {}
+    if WORKER_INDEX is not None:
+        results[WORKER_INDEX] = FAN_OUT_CALLS[name](*args)
+    answered = call["done"].wait(timeout)
+    with _rpc_lock:
+        del _rpc_calls[call_id]
+        results.update(call["results"])
+    if not answered:
+        logger.warning(f"Fan-out {name}: {len(remote) + 1 - len(results)} workers did not answer")
+    return [results[i] for i in sorted(results)]
+
+
+def cast_to_owner(user_id, name, *args):
+    """تنفيذ FAN_OUT_CALLS[name] في عامل صاحب user_id بدون انتظار رد."""
+    _PROCESS_INBOXES[worker_for(user_id)].put(("call", None, None, name, args))
+
+
+def _answer_call(call_id, reply_to, name, args):
+    try:
+        ok, value = True, FAN_OUT_CALLS[name](*args)
+    except Exception as e:
+        logger.error(f"Error in fan-out call {name}: {e}")
+        ok, value = False, None
+    if call_id is not None:
+        _PROCESS_INBOXES[reply_to].put(("result", call_id, WORKER_INDEX, ok, value))
+
+
+def _deliver_result(call_id, worker, ok, value):
+    with _rpc_lock:
+        call = _rpc_calls.get(call_id)
+        if call is None:
+            return  # انتهت المهلة
+        if ok:
+            call["results"][worker] = value
+        call["expected"] -= 1
+        if call["expected"] == 0:
+            call["done"].set()
+
+
+def serve_inbox(inbox, updater, stop: Event):
+    """حلقة طابور العملية حتى ("stop",) أو stop.set()."""
+    while not stop.is_set():
+        try:
+            message = inbox.get(timeout=1)
+        except Empty:
+            continue
+        kind = message[0]
+        if kind == "update":
+            updater.update_queue.put(Update.de_json(message[1], updater.bot))
+        elif kind == "call":
+            _RPC_EXECUTOR.submit(_answer_call, *message[1:])
+        elif kind == "result":
+            _deliver_result(*message[1:])
+        elif kind == "stop":
+            stop.set()
+
+
+def route_update(update: Update, context: CallbackContext):
+    """العملية الأمامية: تحويل التحديث لعامل صاحبه (بدون أي معالجة هنا)."""
+    user = update.effective_user
+    worker = worker_for(user.id) if user else 0
+    _PROCESS_INBOXES[worker].put(("update", update.to_dict()))
+
+
+FAN_OUT_CALLS = {
+    "reachable_user_ids": lambda: store.reachable_user_ids(),
+    "count_reachable": lambda: store.count_reachable(),
+    "stats": local_stats,
+    "metric_blocks": lambda: metric_blocks(str(WORKER_INDEX)),
+    "mark_unreachable": mark_unreachable,
+    "export": export_shard,
+    "segment": _local_segment,
+    "support_thread": remember_support_thread,
+}
+
+
+def split_into_workers():
+    """أول تشغيل بالعمال: يوزّع بيانات BASE_DIR على مجلدات العمال مرة واحدة."""
+    split = store.get_meta(WORKERS_SPLIT_META_KEY)
+    if split is not None:
+        if split != WORKER_PROCESSES:
+            raise SystemExit(
+                f"Data is split across {split} workers; "
+                f"WORKER_PROCESSES={WORKER_PROCESSES} needs a manual re-split"
+            )
+        return
+
+    source = create_store(BASE_DIR)
+    targets = []
+    for i in range(WORKER_PROCESSES):
+        worker_dir = os.path.join(WORKERS_DIR, str(i))
+        os.makedirs(worker_dir, exist_ok=True)
+        targets.append(create_store(worker_dir))
+    counts = [0] * WORKER_PROCESSES
+    try:
+        for record in source.iter_records():
+            i = worker_for(record.user_id)
+            targets[i].create(record.user_id, record)
+            counts[i] += 1
+    finally:
+        source.close()
+        for target in targets:
+            target.close()
+    store.set_meta(WORKERS_SPLIT_META_KEY, WORKER_PROCESSES)
+    logger.info(f"Split users from {BASE_DIR} across workers: {counts}")
+
+
+def worker_main(index, inboxes, bucket_state):
+    """نقطة دخول العامل (الموديول مستورد من جديد داخل مجلد العامل)."""
+    global OUTBOUND_BUCKET
+
+    stop = Event()
+    # Ctrl-C يصل لكل المجموعة؛ نوقف بنفس ترتيب الإيقاف العادي
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    _PROCESS_INBOXES[:] = inboxes
+    OUTBOUND_BUCKET = TokenBucket(BROADCAST_RATE, shared=bucket_state)
+
+    updater = Updater(bot=make_bot(), use_context=True)
+    register_handlers(updater)
+    start_flusher()
+    start_dispatcher(updater)
+    if index == worker_for(ADMIN_ID):
+        resume_broadcast(updater.bot)
+    logger.info(f"Worker {index} ready with {store.count()} users")
+    try:
+        serve_inbox(inboxes[index], updater, stop)
+    finally:
+        updater.stop()
+        shutdown_storage()
+
+
+def run_front():
+    """العملية الأمامية: تشغيل العمال ثم استقبال التحديثات وتوزيعها."""
+    split_into_workers()
+
+    mp = multiprocessing.get_context("spawn")
+    inboxes = [mp.Queue() for _ in range(WORKER_PROCESSES + 1)]
+    bucket_state = TokenBucket.shared_state(mp, BROADCAST_RATE)
+    processes = []
+    for i in range(WORKER_PROCESSES):
+        os.environ["QAHER_WORKER_INDEX"] = str(i)
+        process = mp.Process(
+            target=worker_main, args=(i, inboxes, bucket_state), name=f"worker-{i}"
+        )
+        process.start()
+        processes.append(process)
+    del os.environ["QAHER_WORKER_INDEX"]
+    _PROCESS_INBOXES[:] = inboxes
+
+    stop = Event()
+    Thread(
+        target=serve_inbox,
+        args=(inboxes[WORKER_PROCESSES], None, stop),
+        name="front-inbox",
+        daemon=True,
+    ).start()
+
+    updater = Updater(bot=make_bot(), use_context=True)
+    updater.dispatcher.add_handler(TypeHandler(Update, route_update))
+    Thread(target=run_flask, daemon=True).start()
+    start_updates(updater)
+    try:
+        updater.idle()
+    finally:
+        stop.set()
+        for inbox in inboxes[:WORKER_PROCESSES]:
+            inbox.put(("stop",))
+        for process in processes:
+            process.join(30)
+        logger.info("All workers stopped")
 
 # =================== تشغيل البوت ===================
 
 
-def main():
-    if not BOT_TOKEN:
-        raise RuntimeError("BOT_TOKEN غير موجود في متغيرات البيئة!")
+def make_bot():
+    return MeteredBot(
+        BOT_TOKEN,
+        base_url=TELEGRAM_BASE_URL,
+        request=Request(con_pool_size=WORKERS + 4),
+    )
+
 
-    updater = Updater(BOT_TOKEN, use_context=True)
+def register_handlers(updater: Updater):
+    """الهاندلرات والمهام الدورية (البوت العادي وكل عامل)."""
     dp = updater.dispatcher
     job_queue = updater.job_queue
 
     # أوامر
-    dp.add_handler(CommandHandler("start", start_command))
-    dp.add_handler(CommandHandler("help", help_command))
+    dp.add_handler(CommandHandler("start", run_per_user(start_command)))
+    dp.add_handler(CommandHandler("help", run_per_user(help_command)))
+    dp.add_handler(CommandHandler("stats", run_per_user(handle_stats_button)))
+    dp.add_handler(CommandHandler("profile", run_per_user(profile_command)))
+    dp.add_handler(CommandHandler("export", run_per_user(export_command)))
+
+    # أزرار صفحات الملاحظات (inline)
+    dp.add_handler(
+        CallbackQueryHandler(run_per_user(handle_notes_callback), pattern=r"^notes:")
+    )
 
     # جميع الرسائل النصية
     dp.add_handler(
-        MessageHandler(Filters.text & ~Filters.command, handle_text_message)
+        MessageHandler(
+            Filters.text & ~Filters.command, run_per_user(handle_text_message)
+        )
     )
 
-    # تذكير يومي الساعة 20:00 بتوقيت UTC
+    # تذكير يومي (الافتراضي الساعة 20:00 بتوقيت UTC)
+    hour, minute = (int(part) for part in DAILY_REMINDER_TIME.split(":"))
     job_queue.run_daily(
         send_daily_reminders,
-        time=time(hour=20, minute=0, tzinfo=pytz.UTC),
+        time=time(hour=hour, minute=minute, tzinfo=pytz.UTC),
         name="daily_reminders",
     )
 
+    # فحص دوري للإحصائيات التراكمية (وبناؤها أول مرة لو غير محفوظة)
+    job_queue.run_repeating(
+        check_analytics,
+        interval=ANALYTICS_CHECK_INTERVAL,
+        first=10 if not ANALYTICS.loaded else ANALYTICS_CHECK_INTERVAL,
+        name="analytics_check",
+    )
+
+    # تنظيف حالات المحادثة المتروكة
+    job_queue.run_repeating(expire_states, interval=300, first=300, name="expire_states")
+
+    # تهنئة مراحل الثبات: job واحد على موعد أقرب مرحلة فقط
+    MILESTONES.attach(job_queue)
+
+    # تذكير من غاب 3 / 7 / 30 يوم
+    job_queue.run_repeating(
+        re_engage_inactive,
+        interval=RE_ENGAGE_INTERVAL,
+        first=RE_ENGAGE_INTERVAL,
+        name="re_engage",
+    )
+
+
+def start_updates(updater: Updater):
+    if WEBHOOK_URL:
+        if not WEBHOOK_SECRET:
+            raise RuntimeError("WEBHOOK_SECRET مطلوب عند تفعيل WEBHOOK_URL!")
+        logger.info("Bot is starting in webhook mode...")
+        start_webhook(updater)
+    else:
+        logger.info("Bot is starting in polling mode...")
+        updater.start_polling()
+
+
+def shutdown_storage():
+    UPDATE_EXECUTOR.shutdown()
+    stop_broadcast()
+    flushed = flush_pending()
+    save_meta()
+    save_support_threads()
+    store.close()
+    logger.info(f"Flushed {flushed} pending records on shutdown")
+
+
+def main():
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN غير موجود في متغيرات البيئة!")
+
+    if WORKER_PROCESSES > 1:
+        if PROCESS_DIR is None:
+            raise RuntimeError("وضع العمال يحتاج التشغيل كبرنامج: python bot.py")
+        logger.info(f"Starting front process with {WORKER_PROCESSES} workers...")
+        run_front()
+        return
+
+    updater = Updater(bot=make_bot(), use_context=True)
+    register_handlers(updater)
+
     # تشغيل Flask في ثريد منفصل
     Thread(target=run_flask, daemon=True).start()
+    start_flusher()
 
-    logger.info("Bot is starting...")
-    updater.start_polling()
-    updater.idle()
+    start_updates(updater)
+    resume_broadcast(updater.bot)
+    try:
+        # idle() يرجع عند SIGINT / SIGTERM / SIGABRT
+        updater.idle()
+    finally:
+        shutdown_storage()
 
 
 if __name__ == "__main__":
-    main()
+    # STORAGE_BACKEND=sqlite python bot.py import-json [user_data.json]
+    # → نقل البيانات إلى الخلفية المختارة مرة واحدة
+    if len(sys.argv) > 1 and sys.argv[1] == "import-json":
+        if isinstance(store, JsonStore):
+            raise SystemExit("Set STORAGE_BACKEND=sqlite or sharded to import into it")
+        import_json(sys.argv[2] if len(sys.argv) > 2 else DATA_FILE, store)
+        store.close()
+    else:
+        main()